@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""SSDP traffic captured on the field, used by the benchmarks
+
+Responses are the vendor devices shown on README.md.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+from protocols.networking import UdpPackage
+
+M_SEARCH = (b'M-SEARCH * HTTP/1.1\r\n'
+            b'HOST: 239.255.255.250:1900\r\n'
+            b'MAN: "ssdp:discover"\r\n'
+            b'ST: ssdp:all\r\n'
+            b'MX: 5\r\n'
+            b'USER-AGENT: Simple Network Framework / 0.1\r\n'
+            b'\r\n')
+
+LG_RESPONSE = (b'HTTP/1.1 200 OK\r\n'
+               b'Location: http://172.16.47.72:1850/\r\n'
+               b'Cache-Control: max-age=1800\r\n'
+               b'Server: Linux/i686 UPnP/1.0 DLNADOC/1.50 Platinum/1.0.3.0\r\n'
+               b'USN: uuid:d093c502-b0ca-e13c-2f0a-609cbefe3080::urn:lge-com:device:SSTDevice:1\r\n'
+               b'ST: urn:lge-com:device:SSTDevice:1\r\n'
+               b'EXT: \r\n'
+               b'\r\n')
+
+SAMSUNG_RESPONSE = (b'HTTP/1.1 200 OK\r\n'
+                    b'CACHE-CONTROL: max-age=1800\r\n'
+                    b'LOCATION: http://172.16.47.68:7676/smp_11_\r\n'
+                    b'ST: urn:schemas-upnp-org:service:ConnectionManager:1\r\n'
+                    b'SERVER: SHP, UPnP/1.0, Samsung UPnP SDK/1.0\r\n'
+                    b'USN: uuid:0c845881-00d2-1000-9130-ccb11a7ca518::urn:schemas-upnp-org:service:ConnectionManager:1\r\n'
+                    b'EXT: \r\n'
+                    b'\r\n')
+
+SONY_RESPONSE = (b'HTTP/1.1 200 OK\r\n'
+                 b'CACHE-CONTROL: max-age=1800\r\n'
+                 b'LOCATION: http://172.16.47.60:52323/dmr.xml\r\n'
+                 b'ST: urn:schemas-upnp-org:service:ConnectionManager:1\r\n'
+                 b'SERVER: Linux/2.6 UPnP/1.0 KDL-32W605A/1.7\r\n'
+                 b'USN: uuid:00000000-0000-1010-8000-d8d43c469f0b::urn:schemas-upnp-org:service:ConnectionManager:1\r\n'
+                 b'X-AV-Physical-Unit-Info: pa="BRAVIA KDL-32W605A";\r\n'
+                 b'X-AV-Server-Info: av=5.0; cn="Sony Corporation"; mn="BRAVIA KDL-32W605A"; mv="1.7";\r\n'
+                 b'EXT: \r\n'
+                 b'\r\n')
+
+NOTIFY_ALIVE = (b'NOTIFY * HTTP/1.1\r\n'
+                b'HOST: 239.255.255.250:1900\r\n'
+                b'CACHE-CONTROL: max-age=1800\r\n'
+                b'LOCATION: http://172.16.47.60:52323/dmr.xml\r\n'
+                b'NT: upnp:rootdevice\r\n'
+                b'NTS: ssdp:alive\r\n'
+                b'SERVER: Linux/2.6 UPnP/1.0 KDL-32W605A/1.7\r\n'
+                b'USN: uuid:00000000-0000-1010-8000-d8d43c469f0b::upnp:rootdevice\r\n'
+                b'\r\n')
+
+MALFORMED = (b'GET / HTTP/1.1\r\nHost: 172.16.47.1\r\n\r\n',
+             b'HTTP/1.1 200 OK',
+             b'M-SEARCH * HTTP/1.1\r\nno colon here\r\n\r\n',
+             b'\x00\x01\x02\x03' * 64)
+
+OVERSIZED = (b'HTTP/1.1 200 OK\r\n' +
+             b''.join(b'X-VENDOR-' + str(i).encode('ascii') + b': ' + b'v' * 96 + b'\r\n' for i in range(48)) +
+             b'ST: upnp:rootdevice\r\n\r\n')
+
+# Traffic seen by a daemon running an ssdp:all search on a busy segment
+CAPTURE = [UdpPackage(M_SEARCH, '172.16.19.100', 54899),
+           UdpPackage(LG_RESPONSE, '172.16.47.72', 1900),
+           UdpPackage(SAMSUNG_RESPONSE, '172.16.47.68', 1900),
+           UdpPackage(SONY_RESPONSE, '172.16.47.60', 1900),
+           UdpPackage(NOTIFY_ALIVE, '172.16.47.60', 1900)]
+
+MALFORMED_CAPTURE = [UdpPackage(data, '172.16.47.1', 1900) for data in MALFORMED]
+
+OVERSIZED_CAPTURE = [UdpPackage(OVERSIZED, '172.16.47.99', 1900),
+                     UdpPackage(OVERSIZED * 2, '172.16.47.99', 1900)]
+
+# Search targets as seen on M-SEARCH requests, valid and invalid
+SEARCH_TARGETS = ['ssdp:all', 'upnp:rootdevice',
+                  'uuid:00000000-0000-1010-8000-d8d43c469f0b',
+                  'urn:schemas-upnp-org:device:MediaRenderer:1',
+                  'urn:schemas-upnp-org:service:ConnectionManager:1',
+                  'urn:lge-com:device:SSTDevice:1',
+                  'urn:schemas-upnp-org:device', 'uuid:short', 'ssdp:alive', '']
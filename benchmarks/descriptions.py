@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Description fetch benchmark against a local HTTP stand-in server
+
+DescriptionServer serves generated UPnP descriptions on 127.0.0.1 with keep-alive,
+ETag/Last-Modified validators and an optional per request delay (a slow device).
+The same devices are fetched:
+    serial   - one at a time, a new connection per request and a full parse, the way
+               the consumers of the framework used to do it
+    cold     - description.DescriptionFetcher, empty cache
+    warm     - again with the descriptions cached, revalidated with 304 Not Modified
+
+Usage:
+    python -m benchmarks.descriptions --devices 200 --delay 0.01 --workers 8
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from xml.etree import ElementTree
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen
+from protocols.description import DescriptionFetcher, FETCHED, NOT_MODIFIED
+from protocols.metrics import MetricsRegistry
+
+LAST_MODIFIED = 'Sat, 17 Oct 2026 00:00:00 GMT'
+DESCRIPTION = ('<?xml version="1.0"?>\n'
+               '<root xmlns="urn:schemas-upnp-org:device-1-0">\n'
+               '<specVersion><major>1</major><minor>1</minor></specVersion>\n'
+               '<device>\n'
+               '<deviceType>urn:schemas-upnp-org:device:MediaServer:1</deviceType>\n'
+               '<friendlyName>Stand-in {index}</friendlyName>\n'
+               '<manufacturer>Simple Network Framework</manufacturer>\n'
+               '<modelName>Stand-in</modelName>\n'
+               '<UDN>uuid:{index:08x}-0000-4000-8000-000000000000</UDN>\n'
+               '<serviceList>\n{services}</serviceList>\n'
+               '<presentationURL>/</presentationURL>\n'
+               '</device>\n'
+               '</root>\n')
+SERVICE = ('<service><serviceType>urn:schemas-upnp-org:service:Stub{number}:1</serviceType>'
+           '<serviceId>urn:upnp-org:serviceId:Stub{number}</serviceId><SCPDURL>/scpd/{number}.xml</SCPDURL>'
+           '<controlURL>/control/{number}</controlURL><eventSubURL>/event/{number}</eventSubURL></service>\n')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, keep-alive would wait on the delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.delay:
+            time.sleep(server.delay)
+        try:
+            index = int(self.path.rsplit('/', 1)[-1].split('.')[0])
+            body = server.descriptions[index]
+        except (ValueError, IndexError):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"{}"'.format(index)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+class DescriptionServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP stand-in for the devices, descriptions at /device/<index>.xml
+
+    Attributes:
+        requests - requests served
+        connections - TCP connections accepted
+    """
+
+    daemon_threads = True
+
+    def __init__(self, devices, services=4, delay=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.delay = delay
+        self.requests = self.connections = 0
+        body = ''.join(SERVICE.format(number=number) for number in range(services))
+        self.descriptions = [DESCRIPTION.format(index=index, services=body).encode('utf-8')
+                             for index in range(devices)]
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    def location(self, index):
+        return 'http://127.0.0.1:{}/device/{}.xml'.format(self.server_address[1], index)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def serial(server, devices):
+    parsed = 0
+    for index in range(devices):
+        response = urlopen(server.location(index))
+        try:
+            root = ElementTree.fromstring(response.read())
+        finally:
+            response.close()
+        parsed += root.find('.//{urn:schemas-upnp-org:device-1-0}device') is not None
+    return parsed
+
+
+def pooled(fetcher, server, devices, wanted):
+    for index in range(devices):
+        fetcher.submit(server.location(index))
+    parsed = 0
+    for _ in range(devices):
+        result = fetcher.results_out_q.get(timeout=30)
+        parsed += result.status == wanted
+    return parsed
+
+
+def run(devices, services, delay, workers):
+    server = DescriptionServer(devices, services, delay)
+    server.start()
+    results = {'devices': devices, 'delay ms': delay * 1000, 'workers': workers}
+    try:
+        for name, function in (('serial', lambda: serial(server, devices)),
+                               ('cold', lambda: pooled(fetcher, server, devices, FETCHED)),
+                               ('warm', lambda: pooled(fetcher, server, devices, NOT_MODIFIED))):
+            if name == 'cold':
+                fetcher = DescriptionFetcher(workers=workers, max_per_host=workers, fresh_for=0,
+                                             queue_size=devices, metrics=MetricsRegistry())
+                fetcher.start()
+            requests, connections = server.requests, server.connections
+            started = time.time()
+            parsed = function()
+            elapsed = time.time() - started
+            results['{} /s'.format(name)] = round(devices / elapsed, 1)
+            results['{} ok'.format(name)] = parsed
+            results['{} connections'.format(name)] = server.connections - connections
+            results['{} requests'.format(name)] = server.requests - requests
+        fetcher.join()
+    finally:
+        server.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Description fetch benchmark')
+    parser.add_argument('--devices', type=int, default=200, help='descriptions served')
+    parser.add_argument('--services', type=int, default=4, help='services per description')
+    parser.add_argument('--delay', type=float, default=0.005, help='seconds the server waits per request')
+    parser.add_argument('--workers', type=int, default=8, help='DescriptionFetcher workers')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    options = parser.parse_args(argv)
+    logging.disable(logging.CRITICAL)
+    results = run(options.devices, options.services, options.delay, options.workers)
+    if options.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        for name in sorted(results):
+            print('{:<22}{}'.format(name, results[name]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
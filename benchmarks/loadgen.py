@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Loopback load generator for SSDPDaemon
+
+Simulated devices and control points run on a separate process, each with its own
+DatagramSocket bound to a distinct 127.x.y.z address, against a real SSDPDaemon.
+
+Scenarios:
+    ingest - devices unicast M-SEARCH responses to a searching daemon, measures the
+             responses ingested per second and the datagrams lost on the way
+    storm  - control points multicast M-SEARCH, mixed with device NOTIFY, to a
+             responding daemon, measures the answers per second, loss and latency
+
+Usage:
+    python -m benchmarks.loadgen ingest --devices 5000 --rate 20000 --duration 5
+    python -m benchmarks.loadgen storm --senders 256 --rate 2000 --notify-ratio 0.2 --mx 0
+
+Note:
+    Reply latency includes the random MX delay of the daemon, use --mx 0 to measure
+    the processing time only. Each control point always searches the same ST, answers
+    are matched to its oldest pending request (ssdp:all by its SERVER_USN answer),
+    requests coalesced or rate limited by the daemon count as lost.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import multiprocessing
+from collections import deque
+from protocols import upnp
+from protocols.discovery import SSDPDaemon
+from protocols.metrics import MetricsRegistry, clock
+from protocols.networking import DatagramSocket, SocketSelector, InterfaceTable, UnicastException
+
+PROTOCOL = 'LoadGenerator'
+# Datagrams are sent on ticks of this many seconds
+TICK = 0.001
+# Simulated devices share at most this many sockets
+MAX_SOCKETS = 256
+SERVER_USN = 'urn:schemas-upnp-org:service:LoadTest:1'
+SERVER_UUID = 'uuid:10ad7e57-0000-4000-8000-000000000000'
+
+RESPONSE = ('HTTP/1.1 200 OK\r\n'
+            'CACHE-CONTROL: max-age=1800\r\n'
+            'EXT:\r\n'
+            'LOCATION: http://{address}:8000/device/{index}.xml\r\n'
+            'SERVER: Linux/4.0 UPnP/1.1 LoadGenerator/0.1\r\n'
+            'ST: urn:schemas-upnp-org:device:Simulated:1\r\n'
+            'USN: uuid:{index:08x}-0000-4000-8000-000000000000::urn:schemas-upnp-org:device:Simulated:1\r\n'
+            '\r\n')
+NOTIFY = ('NOTIFY * HTTP/1.1\r\n'
+          'HOST: 239.255.255.250:1900\r\n'
+          'CACHE-CONTROL: max-age=1800\r\n'
+          'LOCATION: http://{address}:8000/device/{index}.xml\r\n'
+          'NT: upnp:rootdevice\r\n'
+          'NTS: ssdp:alive\r\n'
+          'SERVER: Linux/4.0 UPnP/1.1 LoadGenerator/0.1\r\n'
+          'USN: uuid:{index:08x}-0000-4000-8000-000000000000::upnp:rootdevice\r\n'
+          '\r\n')
+M_SEARCH = ('M-SEARCH * HTTP/1.1\r\n'
+            'HOST: 239.255.255.250:1900\r\n'
+            'MAN: "ssdp:discover"\r\n'
+            'ST: {st}\r\n'
+            'MX: {mx}\r\n'
+            'USER-AGENT: LoadGenerator/0.1\r\n'
+            '\r\n')
+# Search targets answered by the daemon under test
+SEARCH_TARGETS = ('ssdp:all', 'upnp:rootdevice', SERVER_USN, SERVER_UUID)
+# ST of the answer matched to a search, ssdp:all gets one answer per advertisement
+ANSWER_TARGETS = (SERVER_USN, 'upnp:rootdevice', SERVER_USN, SERVER_UUID)
+
+
+def simulated_address(index):
+    """Loopback address of a simulated host, 127.0.1.2 onwards"""
+    return '127.{}.{}.{}'.format(index // 64516 % 256, index // 254 % 254 + 1, index % 254 + 2)
+
+
+def percentile(ordered, ratio):
+    """Nearest rank percentile of a sorted list, None if empty"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(ratio * len(ordered)))]
+
+
+def udp_receive_drops():
+    """Kernel UDP RcvbufErrors counter, None where /proc/net/snmp doesn't exist"""
+    try:
+        with open('/proc/net/snmp') as snmp:
+            rows = [line.split() for line in snmp if line.startswith('Udp:')]
+        return int(rows[1][rows[0].index('RcvbufErrors')])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def _open_sockets(count, port, interface_of):
+    """DatagramSockets for the simulated hosts, registered on the LoadGenerator selector"""
+    sockets = []
+    for index in range(count):
+        sockets.append(DatagramSocket(socket_type=DatagramSocket.CLIENT, implemented_protocol=PROTOCOL,
+                                      logger_name='Load Generator', group=upnp.MULTICAST_GROUP, port=port,
+                                      ttl=1, interface=interface_of(index), metrics=MetricsRegistry()))
+    return sockets
+
+
+def _paced(rate, duration):
+    """Yields (message number, count) batches following the target rate"""
+    started = clock()
+    sent = 0
+    total = int(rate * duration)
+    while sent < total:
+        due = min(total, int((clock() - started) * rate) + 1)
+        if due > sent:
+            yield sent, due - sent
+            sent = due
+        else:
+            time.sleep(TICK)
+
+
+def _generate(scenario, options, target, results):
+    """Generator process entry point, puts a dict with its counters on results"""
+    # Inherited through fork, the daemon selectors belong to the parent
+    SocketSelector._instance = None
+    InterfaceTable._instance = None
+    if scenario == 'ingest':
+        results.put(_ingest(options, target))
+    else:
+        results.put(_storm(options))
+
+
+def _ingest(options, target):
+    devices = options['devices']
+    sockets = _open_sockets(min(devices, MAX_SOCKETS), upnp.MULTICAST_PORT, simulated_address)
+    payloads = [RESPONSE.format(address=simulated_address(index), index=index).encode('ascii')
+                for index in range(devices)]
+    sent = 0
+    started = clock()
+    for first, count in _paced(options['rate'], options['duration']):
+        batches = {}
+        for number in range(first, first + count):
+            batches.setdefault(number % len(sockets), []).append((payloads[number % devices], target))
+        for index, messages in batches.items():
+            sent += len(messages) - len(sockets[index].send_batch(messages))
+    return {'sent': sent, 'elapsed': clock() - started}
+
+
+def _storm(options):
+    sockets = _open_sockets(options['senders'], upnp.MULTICAST_PORT, simulated_address)
+    group = (upnp.MULTICAST_GROUP, upnp.MULTICAST_PORT)
+    # (sender index, st) -> send times of the requests waiting for an answer
+    pending = {}
+    latencies = []
+
+    def handler(index):
+        try:
+            packages = sockets[index].recv_batch()
+        except UnicastException:
+            return
+        now = clock()
+        for package in packages:
+            message = upnp.parse_message(package)
+            waiting = pending.get((index, message.get('st'))) if message is not None else None
+            if waiting:
+                latencies.append(now - waiting.popleft())
+
+    for index, sock in enumerate(sockets):
+        sock.handler = (lambda index: lambda: handler(index))(index)
+    searches = [M_SEARCH.format(st=st, mx=options['mx']).encode('ascii') for st in SEARCH_TARGETS]
+    notifies = [NOTIFY.format(address=simulated_address(index), index=index).encode('ascii')
+                for index in range(len(sockets))]
+    chooser = random.Random(options['seed'])
+    sent = {'m-search': 0, 'notify': 0}
+    started = clock()
+    for first, count in _paced(options['rate'], options['duration']):
+        now = clock()
+        for number in range(first, first + count):
+            index = number % len(sockets)
+            if chooser.random() < options['notify_ratio']:
+                sockets[index].send_batch([(notifies[index], group)])
+                sent['notify'] += 1
+            else:
+                which = index % len(SEARCH_TARGETS)
+                if not sockets[index].send_batch([(searches[which], group)]):
+                    pending.setdefault((index, ANSWER_TARGETS[which]), deque()).append(now)
+                    sent['m-search'] += 1
+        SocketSelector.dispatch(PROTOCOL, 0)
+    elapsed = clock() - started
+    # Stragglers, answers are delayed up to MX seconds
+    deadline = clock() + options['mx'] + 1.0
+    while clock() < deadline:
+        SocketSelector.dispatch(PROTOCOL, 0.05)
+    return {'sent': sent['m-search'], 'notify': sent['notify'], 'answers': len(latencies),
+            'latencies': latencies, 'elapsed': elapsed}
+
+
+def _counter(metrics, name, interface, kind):
+    return metrics.counter(name, protocol=SSDPDaemon.__name__, interface=interface, socket=kind).value
+
+
+def run(scenario, options):
+    """Runs a scenario against a fresh SSDPDaemon, returns the report dict"""
+    interface = options['interface']
+    metrics = MetricsRegistry()
+    # Every datagram is logged at DEBUG and every NOTIFY as a warning
+    logging.getLogger('Load Test Daemon').setLevel(logging.ERROR)
+    logging.getLogger('Load Generator').setLevel(logging.ERROR)
+    daemon = SSDPDaemon(server_usn=SERVER_USN, server_uuid=SERVER_UUID, m_search_timeout=0,
+                        logger_name='Load Test Daemon', raw_responses=False, queue_size=1024,
+                        interfaces=[interface], metrics=metrics, ignore_local=False)
+    daemon.start()
+    target = (interface, daemon.client.transport.getsockname()[1])
+    drops = udp_receive_drops()
+    results = multiprocessing.Queue()
+    generator = multiprocessing.Process(target=_generate, args=(scenario, options, target, results))
+    generator.start()
+    outcome = results.get()
+    generator.join()
+    if scenario == 'ingest':
+        # Let the daemon drain its socket buffer
+        previous = -1
+        while previous != _counter(metrics, 'snf_packets_received_total', interface, 'client'):
+            previous = _counter(metrics, 'snf_packets_received_total', interface, 'client')
+            time.sleep(0.2)
+    daemon.join()
+    report = {'scenario': scenario, 'offered rate': options['rate'], 'elapsed': outcome['elapsed'],
+              'sent': outcome['sent']}
+    if scenario == 'ingest':
+        received = _counter(metrics, 'snf_packets_received_total', interface, 'client')
+        report.update({'received': received, 'devices registered': len(daemon.registry)})
+    else:
+        received = outcome['answers']
+        latencies = sorted(outcome['latencies'])
+        report.update({'notify sent': outcome['notify'], 'answered': received,
+                       'server received': _counter(metrics, 'snf_packets_received_total', interface, 'server'),
+                       'daemon replies': daemon.stats()['replies'],
+                       'p50 ms': _milliseconds(percentile(latencies, 0.5)),
+                       'p99 ms': _milliseconds(percentile(latencies, 0.99)),
+                       'p999 ms': _milliseconds(percentile(latencies, 0.999))})
+    report['throughput/s'] = received / outcome['elapsed'] if outcome['elapsed'] else 0.0
+    report['loss %'] = 100.0 * (outcome['sent'] - received) / outcome['sent'] if outcome['sent'] else 0.0
+    if drops is not None:
+        report['kernel rcvbuf drops'] = udp_receive_drops() - drops
+    return report
+
+
+def _milliseconds(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Loopback SSDP load generator')
+    parser.add_argument('scenario', choices=('ingest', 'storm'))
+    parser.add_argument('--rate', type=float, default=5000.0, help='datagrams per second offered')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of load')
+    parser.add_argument('--devices', type=int, default=5000, help='simulated devices (ingest)')
+    parser.add_argument('--senders', type=int, default=256, help='simulated control points (storm)')
+    parser.add_argument('--notify-ratio', type=float, default=0.0, help='share of NOTIFY on the storm')
+    parser.add_argument('--mx', type=int, default=1, help='MX of the M-SEARCH storm, 0 for no delay')
+    parser.add_argument('--interface', default='127.0.0.1', help='local address the daemon listens on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+    options = {'rate': args.rate, 'duration': args.duration, 'devices': args.devices, 'senders': args.senders,
+               'notify_ratio': args.notify_ratio, 'mx': args.mx, 'interface': args.interface, 'seed': args.seed}
+    report = run(args.scenario, options)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return 0
+    for name in sorted(report):
+        value = report[name]
+        print('{:<22}{}'.format(name, '{:,.3f}'.format(value) if isinstance(value, float) else value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""Compares upnp.parse against upnp.parse_message on captured traffic
+
+Usage:
+    python -m benchmarks.parse
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import timeit
+from protocols import upnp
+from benchmarks.corpus import CAPTURE, MALFORMED_CAPTURE
+
+ROUNDS = 5000
+
+
+def _bench(func, packages):
+    """Returns packages parsed per second"""
+    elapsed = min(timeit.repeat(lambda: [func(package) for package in packages], number=ROUNDS, repeat=3))
+    return ROUNDS * len(packages) / elapsed
+
+
+def main():
+    cases = [('parse', upnp.parse),
+             ('parse_message', upnp.parse_message),
+             ('parse_message + st', lambda package: upnp.parse_message(package).get('st')),
+             ('parse_message + to_dict', lambda package: upnp.parse_message(package).to_dict())]
+    print('{:<28}{:>16}'.format('captured traffic', 'msgs/sec'))
+    for name, func in cases:
+        print('{:<28}{:>16,.0f}'.format(name, _bench(func, CAPTURE)))
+    print('{:<28}{:>16}'.format('malformed traffic', 'msgs/sec'))
+    for name, func in cases[:2]:
+        print('{:<28}{:>16,.0f}'.format(name, _bench(func, MALFORMED_CAPTURE)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Replays a capture through the SSDPDaemon handlers, for offline profiling
+
+The capture is recorded with capture.PacketRecorder (or tcpdump -w on udp port 1900)
+and fed to a daemon that's never started, so parsing, the registry, the searches
+answers and the subscriptions run without waiting on the network. Without a capture
+file one is generated from the benchmark corpus.
+
+Usage:
+    python -m benchmarks.replay --packets 50000              # generated capture
+    python -m benchmarks.replay ssdp.pcap --speed 1           # original pace
+    python -m benchmarks.replay ssdp.snfc --profile 20        # top 20 functions by cumulative time
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import time
+import pstats
+import logging
+import argparse
+import tempfile
+import cProfile
+from protocols.capture import CapturedPacket, Replayer, read_capture, encode_record, file_header, \
+    CLIENT, COMPACT, PCAP
+from protocols.discovery import SSDPDaemon
+from protocols.metrics import MetricsRegistry
+from benchmarks.corpus import CAPTURE, M_SEARCH, NOTIFY_ALIVE
+
+
+def generate(path, packets, fmt=COMPACT, rate=1000.0):
+    """Writes a capture of the corpus traffic from packets / len(CAPTURE) senders"""
+    started = time.time()
+    with open(path, 'wb') as handle:
+        handle.write(file_header(fmt))
+        for index in range(packets):
+            package = CAPTURE[index % len(CAPTURE)]
+            sender = index // len(CAPTURE)
+            host = '10.{}.{}.{}'.format(sender >> 16 & 0xff, sender >> 8 & 0xff, sender & 0xff)
+            # Requests and announcements arrive on the group, answers on the client socket
+            flags = 0 if package.data in (M_SEARCH, NOTIFY_ALIVE) else CLIENT
+            local = ('239.255.255.250', 1900) if flags == 0 else ('10.255.255.1', 50000)
+            handle.write(encode_record(CapturedPacket(started + index / rate, flags, host, package.port,
+                                                      local[0], local[1], package.data), fmt))
+
+
+def run(path, speed, profile):
+    daemon = SSDPDaemon(server_uuid='uuid:00000000-0000-4000-8000-00000000beef', m_search_timeout=0,
+                        raw_responses=False, notify=False, metrics=MetricsRegistry())
+    daemon.add_m_search('ssdp:all')
+    replayer = Replayer(daemon, address='10.255.255.1')
+    profiler = cProfile.Profile() if profile else None
+    try:
+        packets = list(read_capture(path))
+        if profiler is not None:
+            profiler.enable()
+        results = replayer.replay(packets, speed)
+        if profiler is not None:
+            profiler.disable()
+    finally:
+        # Never started, there's no thread to join
+        for link in daemon.links:
+            link.destroy()
+    results['elapsed'] = round(results['elapsed'], 3)
+    results['rate'] = round(results['rate'], 1)
+    if profiler is not None:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(profile)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SSDP capture replay')
+    parser.add_argument('capture', nargs='?', help='COMPACT or pcap capture, generated when missing')
+    parser.add_argument('--packets', type=int, default=50000, help='datagrams of the generated capture')
+    parser.add_argument('--format', choices=(COMPACT, PCAP), default=COMPACT, help='generated capture format')
+    parser.add_argument('--speed', type=float, default=None, help='1 for the original pace, default as fast as possible')
+    parser.add_argument('--profile', type=int, default=0, metavar='LINES', help='print a cProfile report')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    options = parser.parse_args(argv)
+    logging.disable(logging.CRITICAL)
+    path = options.capture
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.' + options.format)
+        os.close(handle)
+        generate(path, options.packets, options.format)
+    try:
+        results = run(path, options.speed, options.profile)
+    finally:
+        if options.capture is None:
+            os.remove(path)
+    if options.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        for name in sorted(results):
+            print('{:<12}{}'.format(name, results[name]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks of the protocol hot paths with stored baselines
+
+Reports operations per second and, on Python 3, the memory blocks each operation
+leaves allocated (its result included) and its peak traced memory. Results are
+compared against benchmarks/baselines.json, stored per Python version.
+
+Usage:
+    python -m benchmarks.suite                  # run and compare against the baseline
+    python -m benchmarks.suite --save           # run and store as the new baseline
+    python -m benchmarks.suite --filter parse   # only the cases containing 'parse'
+
+Exits with status 1 when a case got slower than the tolerance or allocates more.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import socket
+import timeit
+import argparse
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, allocations are not reported
+    tracemalloc = None
+from protocols import upnp
+from protocols.advertising import AdvertisementRegistry
+from protocols.networking import DatagramSocket, SocketSelector, NetworkConfigurationError
+from benchmarks.corpus import CAPTURE, MALFORMED_CAPTURE, OVERSIZED_CAPTURE, SEARCH_TARGETS
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+# Slower than baseline * (1 - TOLERANCE) is a regression
+TOLERANCE = 0.2
+# Seconds each timing run should last, the best of REPEAT runs is kept
+MIN_TIME = 0.2
+REPEAT = 5
+# Calls measured for the retained allocations
+ALLOC_CALLS = 200
+USER_AGENT = 'Simple Network Framework / 0.1'
+USN = 'urn:schemas-upnp-org:service:SimpleNetworkFramework:1'
+# Virtual devices advertised by the registry cases
+VIRTUAL_DEVICES = 500
+
+
+def python_version():
+    """Baselines key, numbers are only comparable on the same interpreter"""
+    return 'python {}.{}'.format(*sys.version_info[:2])
+
+
+def _loopback_socket(pending):
+    """Client socket on loopback, with a datagram waiting to be read if pending"""
+    sock = DatagramSocket(socket_type=DatagramSocket.CLIENT, implemented_protocol='Benchmark',
+                          logger_name='Benchmark', group=upnp.MULTICAST_GROUP, port=upnp.MULTICAST_PORT,
+                          interface='127.0.0.1')
+    if pending:
+        sock.transport.sendto(CAPTURE[0].data, sock.transport.getsockname())
+    return sock
+
+
+def _advertisements():
+    """Registry with VIRTUAL_DEVICES devices of a service each, and one MediaServer"""
+    registry = AdvertisementRegistry()
+    for index in range(VIRTUAL_DEVICES):
+        registry.add_device('uuid:00000000-0000-4000-8000-{:012d}'.format(index), 'urn:x-test:device:Virtual:1',
+                            ['urn:x-test:service:Virtual:1'], root=False)
+    registry.add_device('uuid:00000000-0000-4000-8000-ffffffffffff', 'urn:schemas-upnp-org:device:MediaServer:2')
+    return registry
+
+
+def cases():
+    """List of (name, callable, operations per call)"""
+    advertisements = _advertisements()
+    selected = [
+        ('upnp.parse capture', lambda: [upnp.parse(package) for package in CAPTURE], len(CAPTURE)),
+        ('upnp.parse oversized', lambda: [upnp.parse(package) for package in OVERSIZED_CAPTURE],
+         len(OVERSIZED_CAPTURE)),
+        ('upnp.parse_message capture', lambda: [upnp.parse_message(package) for package in CAPTURE],
+         len(CAPTURE)),
+        ('upnp.parse_message malformed', lambda: [upnp.parse_message(package) for package in MALFORMED_CAPTURE],
+         len(MALFORMED_CAPTURE)),
+        ('upnp.parse_message oversized', lambda: [upnp.parse_message(package) for package in OVERSIZED_CAPTURE],
+         len(OVERSIZED_CAPTURE)),
+        ('upnp.m_search', lambda: upnp.m_search('ssdp:all', 5, USER_AGENT), 1),
+        ('upnp.is_valid_search_target', lambda: [upnp.is_valid_search_target(st) for st in SEARCH_TARGETS],
+         len(SEARCH_TARGETS)),
+        ('AdvertisementRegistry.match urn', lambda: advertisements.match('urn:schemas-upnp-org:device:MediaServer:1'),
+         1),
+        ('AdvertisementRegistry.match uuid', lambda: advertisements.match('uuid:00000000-0000-4000-8000-000000000007'),
+         1),
+    ]
+    try:
+        upnp.answer('service', 'ssdp:all', USN)
+    except NetworkConfigurationError:
+        # No default route, the answers can't be rendered
+        pass
+    else:
+        builder = upnp.AnswerBuilder()
+        selected.extend([
+            ('upnp.answer', lambda: upnp.answer('service', 'ssdp:all', USN), 1),
+            ('AnswerBuilder.render', lambda: builder.render('ssdp:all', USN), 1),
+        ])
+    # An idle socket and a ready one, both stay registered on the selector until exit
+    _loopback_socket(pending=False)
+    _loopback_socket(pending=True)
+    selected.append(('SocketSelector.select_protocol', lambda: SocketSelector.select_protocol('Benchmark', 0), 1))
+    return selected
+
+
+def ops_per_second(func, operations):
+    """Best of REPEAT runs, each calling func for at least MIN_TIME seconds"""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(MIN_TIME / elapsed) + 1))
+    best = min([elapsed] + timeit.repeat(func, number=number, repeat=REPEAT - 1))
+    return number * operations / best
+
+
+def allocations(func, operations):
+    """(blocks retained, peak bytes) per operation, (None, None) without tracemalloc"""
+    if tracemalloc is None:
+        return None, None
+    func()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    results = [None] * ALLOC_CALLS
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        for index in range(ALLOC_CALLS):
+            results[index] = func()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    tracemalloc.start()
+    try:
+        current = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return float(blocks) / ALLOC_CALLS / operations, float(peak) / operations
+
+
+def load_baselines(path=BASELINES):
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (IOError, ValueError):
+        return {}
+
+
+def compare(result, baseline, tolerance):
+    """Regression description of a result, empty string if it's fine"""
+    if not baseline:
+        return 'new'
+    problems = []
+    if result['ops'] < baseline['ops'] * (1 - tolerance):
+        problems.append('SLOWER')
+    if result.get('blocks') is not None and baseline.get('blocks') is not None and \
+            result['blocks'] > baseline['blocks'] + 0.5:
+        problems.append('ALLOCATES MORE')
+    return ' '.join(problems)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Protocol hot path microbenchmarks')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--baselines', default=BASELINES, help='baselines JSON file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='accepted slowdown ratio, default {}'.format(TOLERANCE))
+    parser.add_argument('--filter', default='', help='only run the cases containing this text')
+    args = parser.parse_args(argv)
+
+    stored = load_baselines(args.baselines)
+    baselines = stored.get(python_version(), {})
+    results = {}
+    regressions = 0
+    print('{} ({})'.format(python_version(), socket.gethostname()))
+    print('{:<32}{:>14}{:>14}{:>9}{:>12}{:>12}  {}'.format('case', 'ops/sec', 'baseline', 'change',
+                                                          'blocks/op', 'peak B/op', 'status'))
+    for name, func, operations in cases():
+        if args.filter not in name:
+            continue
+        ops = ops_per_second(func, operations)
+        blocks, peak = allocations(func, operations)
+        result = results[name] = {'ops': ops, 'blocks': blocks, 'peak': peak}
+        baseline = baselines.get(name)
+        status = compare(result, baseline, args.tolerance)
+        if status and status != 'new':
+            regressions += 1
+        print('{:<32}{:>14,.0f}{:>14}{:>9}{:>12}{:>12}  {}'.format(
+            name, ops,
+            '{:,.0f}'.format(baseline['ops']) if baseline else '-',
+            '{:+.1%}'.format(ops / baseline['ops'] - 1) if baseline else '-',
+            '-' if blocks is None else '{:.2f}'.format(blocks),
+            '-' if peak is None else '{:.0f}'.format(peak),
+            status or 'ok'))
+    if args.save:
+        baselines.update(results)
+        stored[python_version()] = baselines
+        with open(args.baselines, 'w') as handle:
+            json.dump(stored, handle, indent=2, sort_keys=True, separators=(',', ': '))
+            handle.write('\n')
+        print('Baseline stored on {}'.format(args.baselines))
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""Devices and services advertised by SSDPDaemon
+
+The registry is indexed by exact notification type, by device/service type (the URN
+without its version) and by device UUID, so an M-SEARCH resolves to its replies
+without looking at the advertisements that don't match. NotifyScheduler announces
+them with NOTIFY ssdp:alive, spread over the refresh interval.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import threading
+from collections import deque
+from .upnp import ALIVE, BYEBYE
+
+ROOT_DEVICE = 'upnp:rootdevice'
+ALL = 'ssdp:all'
+DEFAULT_MAX_AGE = 1800
+
+
+def split_type(target):
+    """(type prefix, version) of an URN target, (None, None) for the others
+
+    i.e. urn:schemas-upnp-org:device:MediaServer:2 -> (urn:schemas-upnp-org:device:MediaServer, 2)
+    """
+    if not target.startswith('urn:'):
+        return None, None
+    prefix, _, version = target.rpartition(':')
+    try:
+        return prefix, int(version)
+    except ValueError:
+        return None, None
+
+
+def search_matches(search_target, target):
+    """True if an M-SEARCH for search_target is answered by the notification type target
+
+    ssdp:all takes everything, an URN the same type with an equal or higher version and
+    the other search targets the exact notification type.
+    """
+    if search_target == ALL or search_target == target:
+        return True
+    prefix, version = split_type(search_target)
+    if prefix is None:
+        return False
+    target_prefix, target_version = split_type(target)
+    return target_prefix == prefix and target_version >= version
+
+
+def uuid_of(usn):
+    """Device UUID of an USN, i.e. uuid:1234::upnp:rootdevice -> uuid:1234"""
+    if not usn.startswith('uuid:'):
+        return None
+    return usn.split('::', 1)[0]
+
+
+class Advertisement(object):
+    """An advertised notification type
+
+    Attributes:
+        target - NT/ST it's advertised as, i.e. upnp:rootdevice or an URN
+        usn - unique service name, i.e. uuid:1234::upnp:rootdevice
+        location - LOCATION URL, '{address}' is replaced by the interface address,
+            None advertises http://{address}
+        max_age - CACHE-CONTROL max-age in seconds
+    """
+
+    __slots__ = ('target', 'usn', 'location', 'max_age', 'uuid', 'prefix', 'version')
+
+    def __init__(self, target, usn, location=None, max_age=DEFAULT_MAX_AGE):
+        self.target = target
+        self.usn = usn
+        self.location = location
+        self.max_age = max_age
+        self.uuid = uuid_of(usn)
+        self.prefix, self.version = split_type(target)
+
+    @property
+    def key(self):
+        return self.target, self.usn
+
+    def __repr__(self):
+        return '<Advertisement {} {}>'.format(self.target, self.usn)
+
+
+class AdvertisementRegistry(object):
+    """Advertised devices and services, matched against the M-SEARCH targets
+
+    add/remove are O(1) and match is O(replies): ssdp:all walks every advertisement,
+    an URN only the advertisements of its type and anything else its exact target.
+
+    Attributes:
+        generation - incremented on every change, i.e. to rebuild derived schedules
+
+    Note:
+        Thread safe, services are added by the application while the daemon matches.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.generation = 0
+        # (target, usn) -> Advertisement
+        self._entries = {}
+        # target -> {key: Advertisement}
+        self._by_target = {}
+        # URN prefix -> {key: Advertisement}
+        self._by_type = {}
+        # uuid:X -> {key: Advertisement}
+        self._by_uuid = {}
+        self._subscribers = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries.values()))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def subscribe(self, callback):
+        """Registers a callable(registry) called after every change"""
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Removes a callable registered with subscribe"""
+        try:
+            self._subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def _changed(self):
+        for callback in list(self._subscribers):
+            callback(self)
+
+    @staticmethod
+    def _index(index, name, advertisement):
+        if name is not None:
+            index.setdefault(name, {})[advertisement.key] = advertisement
+
+    @staticmethod
+    def _unindex(index, name, key):
+        bucket = index.get(name)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del index[name]
+
+    def add(self, target, usn, location=None, max_age=DEFAULT_MAX_AGE):
+        """Advertises a notification type, replacing the one with the same target and USN
+
+        Returns:
+            Advertisement
+        """
+        advertisement = Advertisement(target, usn, location, max_age)
+        with self._lock:
+            self._remove(advertisement.key)
+            self._entries[advertisement.key] = advertisement
+            self._index(self._by_target, target, advertisement)
+            self._index(self._by_type, advertisement.prefix, advertisement)
+            self._index(self._by_uuid, advertisement.uuid, advertisement)
+            self.generation += 1
+        self._changed()
+        return advertisement
+
+    def remove(self, target, usn):
+        """Stops advertising a notification type, returns the removed Advertisement or None"""
+        with self._lock:
+            advertisement = self._remove((target, usn))
+            if advertisement is not None:
+                self.generation += 1
+        if advertisement is not None:
+            self._changed()
+        return advertisement
+
+    def _remove(self, key):
+        advertisement = self._entries.pop(key, None)
+        if advertisement is not None:
+            self._unindex(self._by_target, advertisement.target, key)
+            self._unindex(self._by_type, advertisement.prefix, key)
+            self._unindex(self._by_uuid, advertisement.uuid, key)
+        return advertisement
+
+    def add_device(self, uuid, device_type, services=(), root=True, location=None, max_age=DEFAULT_MAX_AGE):
+        """Advertises a device the way UPnP describes it
+
+        Args:
+            :param uuid: uuid:device-UUID
+            :param device_type: device URN, i.e. urn:schemas-upnp-org:device:MediaServer:1
+            :param services: service URNs of the device
+            :param root: also advertise it as upnp:rootdevice
+            :param location: description URL, see Advertisement
+            :param max_age: CACHE-CONTROL max-age in seconds
+
+        Returns:
+            List of the Advertisement added
+        """
+        targets = ([ROOT_DEVICE] if root else []) + [uuid, device_type] + list(services)
+        return [self.add(target, uuid if target == uuid else '{}::{}'.format(uuid, target), location, max_age)
+                for target in targets]
+
+    def remove_device(self, uuid):
+        """Stops advertising everything of a device UUID, returns the removed Advertisement list"""
+        with self._lock:
+            keys = list(self._by_uuid.get(uuid, ()))
+            removed = [self._remove(key) for key in keys]
+            if removed:
+                self.generation += 1
+        if removed:
+            self._changed()
+        return removed
+
+    def device(self, uuid):
+        """Advertisement list of a device UUID"""
+        with self._lock:
+            return list(self._by_uuid.get(uuid, {}).values())
+
+    def match(self, search_target):
+        """Replies owed to an M-SEARCH
+
+        ssdp:all is answered with the target of each advertisement, an URN by the
+        advertisements of the same type and an equal or higher version (UPnP 1.1) and
+        the rest by exact target, all of these with the search target as ST.
+
+        Returns:
+            List of (ST, Advertisement)
+        """
+        with self._lock:
+            if search_target == ALL:
+                return [(advertisement.target, advertisement) for advertisement in self._entries.values()]
+            prefix, version = split_type(search_target)
+            if prefix is not None:
+                return [(search_target, advertisement) for advertisement in self._by_type.get(prefix, {}).values()
+                        if advertisement.version >= version]
+            return [(search_target, advertisement) for advertisement in self._by_target.get(search_target, {}).values()]
+
+
+class NotifyScheduler(object):
+    """Spreads the NOTIFY ssdp:alive of the advertisements over the refresh interval
+
+    Every advertisement is announced once per interval (REFRESH_RATIO of the smallest
+    max-age), one every interval / N seconds instead of N at once. Advertisements added
+    or removed are announced (alive/byebye) right away, BURST of them every PACE seconds.
+
+    The daemon asks for the due notifications and renders them, see
+    upnp.AnswerBuilder.render_notify, so payloads are rendered once and reused.
+    """
+
+    # Share of max-age between two announcements, UPnP asks for less than half
+    REFRESH_RATIO = 0.4
+    # Announcements of added or removed advertisements sent every PACE seconds
+    BURST = 20
+    PACE = 0.05
+
+    def __init__(self, registry, clock=time.time):
+        """NotifyScheduler constructor
+
+        Args:
+            :param registry: AdvertisementRegistry to announce
+            :param clock: time source, time.time by default
+        """
+        self.registry = registry
+        self.clock = clock
+        self.interval = DEFAULT_MAX_AGE * self.REFRESH_RATIO
+        self.sent = {ALIVE: 0, BYEBYE: 0}
+        self._generation = None
+        # key -> Advertisement as last seen on the registry
+        self._known = {}
+        # Periodic rotation, keys in announcement order
+        self._order = []
+        self._position = 0
+        self._next = None
+        # (nts, Advertisement) announced before the rotation gets to them
+        self._urgent = deque()
+        self._next_urgent = 0.0
+
+    def _sync(self, now):
+        """Catches up with the registry, O(advertisements) only when it changed"""
+        if self.registry.generation == self._generation:
+            return
+        self._generation = self.registry.generation
+        current = dict((advertisement.key, advertisement) for advertisement in self.registry)
+        for key, advertisement in current.items():
+            known = self._known.get(key)
+            if known is None:
+                self._order.append(key)
+            if known is not advertisement:
+                self._urgent.append((ALIVE, advertisement))
+        removed = [advertisement for key, advertisement in self._known.items() if key not in current]
+        if removed:
+            self._urgent.extend((BYEBYE, advertisement) for advertisement in removed)
+            self._order = [key for key in self._order if key in current]
+            self._position = min(self._position, len(self._order))
+        self._known = current
+        if current:
+            self.interval = min(advertisement.max_age for advertisement in current.values()) * self.REFRESH_RATIO
+        if self._next is None and self._order:
+            self._next = now + self._spacing()
+
+    def _spacing(self):
+        return self.interval / max(1, len(self._order))
+
+    def due(self, now=None):
+        """Notifications to send now
+
+        Returns:
+            List of (nts, Advertisement), nts is upnp.ALIVE or upnp.BYEBYE
+        """
+        now = self.clock() if now is None else now
+        self._sync(now)
+        notifications = []
+        if self._urgent and now >= self._next_urgent:
+            for _ in range(min(self.BURST, len(self._urgent))):
+                notifications.append(self._urgent.popleft())
+            self._next_urgent = now + self.PACE
+        order = self._order
+        if order and self._next is not None:
+            spacing = self._spacing()
+            periodic = 0
+            while self._next <= now and periodic < len(order):
+                if self._position >= len(order):
+                    self._position = 0
+                notifications.append((ALIVE, self._known[order[self._position]]))
+                self._position += 1
+                self._next += spacing
+                periodic += 1
+            if self._next <= now:
+                # A whole cycle late (i.e. the host was suspended), don't burst to catch up
+                self._next = now + spacing
+        for nts, _ in notifications:
+            self.sent[nts] += 1
+        return notifications
+
+    def next_due(self, now=None):
+        """Seconds until the next notification, None if there's nothing to announce"""
+        now = self.clock() if now is None else now
+        self._sync(now)
+        delays = []
+        if self._urgent:
+            delays.append(max(0.0, self._next_urgent - now))
+        if self._order and self._next is not None:
+            delays.append(max(0.0, self._next - now))
+        return min(delays) if delays else None
+
+    def goodbye(self):
+        """ssdp:byebye of every advertisement, i.e. when the daemon stops
+
+        Returns:
+            List of (upnp.BYEBYE, Advertisement)
+        """
+        self._sync(self.clock())
+        self._urgent.clear()
+        notifications = [(BYEBYE, advertisement) for advertisement in self._known.values()]
+        self.sent[BYEBYE] += len(notifications)
+        return notifications
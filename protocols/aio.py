@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""asyncio counterparts of DatagramSocket and SSDPDaemon
+
+Lets many SSDP searches and responders share a single event loop instead of
+running one SSDPDaemon thread each.
+
+Note:
+    Requires Python 3.6+ (asyncio and asynchronous generators), the threaded
+    implementation in discovery.py remains available for Python 2.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import socket
+import struct
+import asyncio
+import logging
+from . import upnp
+from .discovery import SSDPException
+from .networking import DatagramSocket, UdpPackage, MulticastException, UnicastException, \
+    JoinGroupError, ProtocolError, InterfaceTable, NetworkConfigurationError, to_bytes
+
+
+class AsyncDatagramSocket(asyncio.DatagramProtocol):
+    """asyncio DatagramProtocol with the same multicast semantics of DatagramSocket
+
+    Use AsyncDatagramSocket.create to build it, received datagrams are handed to the
+    handler callable as networking.UdpPackage objects.
+    """
+
+    def __init__(self, socket_type, implemented_protocol, logger_name, group, port, ttl=None,
+                 handler=None):
+        """AsyncDatagramSocket constructor
+
+        Args:
+            :param socket_type: DatagramSocket.CLIENT or DatagramSocket.SERVER
+            :param implemented_protocol: Protocol name that you're implementing
+            :param logger_name: Valid logger name.
+            :param group: multicast address.
+            :param port: multicast port.
+            :param ttl: time to live, datagram package hops.
+            :param handler: callable receiving a UdpPackage for every datagram
+        """
+        assert (ttl is None or 255 >= ttl >= 1), "TTL of {} is invalid".format(ttl)
+        self.socket_type = socket_type
+        self.implemented_protocol = implemented_protocol
+        self.logging = logging.getLogger(logger_name)
+        self.group = group
+        self.port = port
+        self.sock_ttl = ttl or 1
+        self.handler = handler
+        self.transport = None
+        self.closed = None
+
+    @classmethod
+    async def create(cls, socket_type, implemented_protocol, logger_name, group, port, ttl=None,
+                     handler=None, loop=None):
+        """Builds the socket and attaches it to the event loop
+
+        Raises:
+            JoinGroupError - Socket level errors for multicast membership
+            ProtocolError - Unknown socket type
+
+        :return AsyncDatagramSocket:
+        """
+        loop = loop or asyncio.get_event_loop()
+        protocol = cls(socket_type, implemented_protocol, logger_name, group, port, ttl, handler)
+        sock = protocol.build_protocol()
+        if socket_type == DatagramSocket.SERVER:
+            protocol.join_group(sock)
+            sock.bind(('0.0.0.0', port))
+        elif socket_type != DatagramSocket.CLIENT:
+            sock.close()
+            raise ProtocolError("Unkown protocol type")
+        protocol.closed = loop.create_future()
+        await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+        return protocol
+
+    def build_protocol(self):
+        """Builds a non-blocking UDP socket supporting the bases of multicast"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.sock_ttl)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        except AttributeError:
+            self.logging.warning('Re-use address is not supported')
+        return sock
+
+    def join_group(self, sock):
+        """Joins the target multicast group
+
+        Note:
+            We're using INADDR_ANY
+        """
+        try:
+            host = struct.pack('4sl', socket.inet_aton(self.group), socket.INADDR_ANY)
+            sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.INADDR_ANY)
+            sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, host)
+        except (socket.error, AttributeError, TypeError) as error:
+            error_msg = 'Could not join multicast group {}:{} \n{}' \
+                .format(self.group, self.port, error)
+            self.logging.error(error_msg)
+            sock.close()
+            raise JoinGroupError(error_msg)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.handler is not None:
+            self.handler(UdpPackage(data, addr[0], addr[1]))
+
+    def error_received(self, exc):
+        self.logging.error('Error receiving socket data: {}'.format(exc))
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    def send_multicast(self, msg):
+        """Multicast a message over the group.
+
+        Raises:
+            MulticastException - transport is closed
+        """
+        if self.transport is None:
+            raise MulticastException("Cant send, not connected")
+        if len(msg) > 0:
+            self.transport.sendto(to_bytes(msg), (self.group, self.port))
+
+    def send_unicast(self, msg, *address):
+        """Unicast sender
+
+        Raises:
+            UnicastException - transport is closed
+        """
+        if self.transport is None:
+            raise UnicastException("Cant send, not connected")
+        self.transport.sendto(to_bytes(msg), address)
+
+    def destroy(self):
+        """Closes the transport, pending datagrams are dropped"""
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AsyncSSDP(object):
+    """asyncio SSDP client, every search shares one socket and event loop
+
+    Example:
+        client = await AsyncSSDP.create()
+        devices = await client.search('ssdp:all', 2)
+        async for response in client.responses('upnp:rootdevice', 2):
+            ...
+    """
+
+    def __init__(self, user_agent=None, logger_name='SSDP Client'):
+        """Use AsyncSSDP.create to get a connected client
+
+        :param user_agent: HTTP like browser agent, or any of your preference.
+        :param logger_name: String logger name, default: 'SSDP Client'.
+        """
+        self.user_agent = user_agent or 'Simple Network Framework / 0.1'
+        self.logger_name = logger_name
+        self.logging = logging.getLogger(logger_name)
+        self.client = None
+        # Search target -> set of asyncio.Queue listening for responses
+        self._listeners = {}
+
+    @classmethod
+    async def create(cls, user_agent=None, logger_name='SSDP Client', loop=None):
+        """Builds the client socket on the running event loop
+
+        :return AsyncSSDP:
+        """
+        self = cls(user_agent, logger_name)
+        self.client = await AsyncDatagramSocket.create(socket_type=DatagramSocket.CLIENT,
+                                                       implemented_protocol=cls.__name__,
+                                                       logger_name=logger_name,
+                                                       group=upnp.MULTICAST_GROUP,
+                                                       port=upnp.MULTICAST_PORT,
+                                                       ttl=upnp.MULTICAST_TTL,
+                                                       handler=self._on_datagram,
+                                                       loop=loop)
+        return self
+
+    def _on_datagram(self, package):
+        """Routes a response to the searches waiting for its ST"""
+        message = upnp.parse_message(package)
+        if message is None or not len(message):
+            return
+        payload = None
+        for target in (message.get('st'), 'ssdp:all'):
+            for queue in self._listeners.get(target, ()):
+                if payload is None:
+                    payload = message.to_dict()
+                queue.put_nowait(payload)
+
+    async def responses(self, search_target, max_wait=5):
+        """Sends an M-SEARCH and yields the parsed responses as they arrive
+
+        Args:
+            :param search_target: String containing ST tag according to UPnP documentation.
+            :param max_wait: MX parameter, responses are collected for max_wait seconds
+
+        Raises:
+            SSDPException - invalid search target or MX
+        """
+        msg = upnp.m_search(search_target, max_wait, self.user_agent)
+        if not msg:
+            raise SSDPException("Invalid M-SEARCH parameters ST={} MX={}".format(search_target, max_wait))
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        self._listeners.setdefault(search_target, set()).add(queue)
+        try:
+            self.client.send_multicast(msg)
+            deadline = loop.time() + max_wait
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    yield await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            listeners = self._listeners[search_target]
+            listeners.discard(queue)
+            if not listeners:
+                del self._listeners[search_target]
+
+    async def search(self, search_target, max_wait=5):
+        """Sends an M-SEARCH and collects every response received within MX seconds
+
+        :return list: parsed responses, see upnp.parse
+        """
+        return [response async for response in self.responses(search_target, max_wait)]
+
+    def close(self):
+        """Closes the client socket"""
+        if self.client is not None:
+            self.client.destroy()
+
+
+class AsyncSSDPResponder(object):
+    """asyncio SSDP responder, answers M-SEARCH for the registered USN and UUID
+
+    Mirrors SSDPDaemon.handle_server without a dedicated thread.
+    """
+
+    def __init__(self, server_usn='urn:schemas-upnp-org:service:SimpleNetworkFramework:1',
+                 server_uuid='uuid:xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx',
+                 logger_name='SSDP Responder', on_message=None):
+        """Use AsyncSSDPResponder.create to get a listening responder
+
+        Args:
+            :param server_usn: register your service tag to be found on network
+            :param server_uuid: register your device tag to be found on network
+            :param logger_name: String logger name, default: 'SSDP Responder'.
+            :param on_message: optional callable receiving every parsed multicast message
+        """
+        self.server_usn = server_usn
+        self.server_uuid = server_uuid
+        self.on_message = on_message
+        # Cached local addresses and pre-rendered answers for the registered tags
+        self.interfaces = InterfaceTable.get_instance()
+        self.answers = upnp.AnswerBuilder(self.interfaces)
+        self.logging = logging.getLogger(logger_name)
+        self.server = None
+
+    @classmethod
+    async def create(cls, loop=None, **kwargs):
+        """Joins the SSDP multicast group on the running event loop
+
+        Raises:
+            JoinGroupError - Socket level errors for multicast will be raised on creation
+
+        :return AsyncSSDPResponder:
+        """
+        self = cls(**kwargs)
+        self.server = await AsyncDatagramSocket.create(socket_type=DatagramSocket.SERVER,
+                                                       implemented_protocol=cls.__name__,
+                                                       logger_name=self.logging.name,
+                                                       group=upnp.MULTICAST_GROUP,
+                                                       port=upnp.MULTICAST_PORT,
+                                                       ttl=upnp.MULTICAST_TTL,
+                                                       handler=self._on_datagram,
+                                                       loop=loop)
+        return self
+
+    def _on_datagram(self, package):
+        """Answers the registered tag, ssdp:all and upnp:rootdevice"""
+        message = upnp.parse_message(package)
+        if message is None:
+            return
+        if self.on_message is not None:
+            self.on_message(message.to_dict())
+        if message.method != 'M-SEARCH' or 'st' not in message or self.interfaces.is_local(message.host):
+            return
+        search_target = message['st']
+        if search_target == self.server_usn or search_target == 'ssdp:all':
+            identifier = self.server_usn
+        elif search_target == self.server_uuid or search_target == 'upnp:rootdevice':
+            identifier = self.server_uuid
+        else:
+            return
+        try:
+            answer = self.answers.render(search_target, identifier)
+        except NetworkConfigurationError as error:
+            # Listening on INADDR_ANY, without a default route there's no LOCATION to answer with
+            self.logging.warning('Cannot answer {}:{}: {}'.format(message.host, message.port, error))
+            return
+        try:
+            self.server.send_unicast(answer, message.host, message.port)
+        except UnicastException as uni_error:
+            self.logging.error("Error sending unicast:\n{}".format(uni_error))
+
+    def close(self):
+        """Leaves the group and closes the listener socket"""
+        self.answers.close()
+        if self.server is not None:
+            self.server.destroy()
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Datagram capture and offline replay
+
+PacketRecorder is given to DatagramSocket (or SSDPDaemon) and records every datagram
+received and sent, with its time and addresses. The sockets only append to a bounded
+ring buffer, a background thread writes it to the file, so a slow disk drops the
+oldest unwritten datagrams instead of slowing the daemon down.
+
+Formats:
+    COMPACT - 'SNFC' header, then per datagram: time, flags (sent, client socket),
+              remote address/port, local address/port, length and the payload
+    PCAP    - libpcap, LINKTYPE_RAW with IPv4/UDP headers rebuilt from the addresses,
+              opens in Wireshark/tcpdump. Sent datagrams have IP identification SENT_ID
+
+Replayer feeds a capture (either format, or a tcpdump capture of Ethernet/Linux
+cooked frames) through upnp.parse_message and the SSDPDaemon handlers, at the
+original pace or as fast as possible, without receiving from the sockets.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import socket
+import struct
+import logging
+import threading
+from collections import namedtuple, deque
+from .networking import ProtocolError, UdpPackage
+from .scheduling import ResponseScheduler
+from .discovery import InterfaceLink
+
+COMPACT = 'compact'
+PCAP = 'pcap'
+# Record flags
+SENT = 0x01
+CLIENT = 0x02
+# IP identification of the datagrams sent, on PCAP captures
+SENT_ID = 0x534e
+
+COMPACT_MAGIC = b'SNFC'
+COMPACT_VERSION = 1
+_COMPACT_HEADER = struct.Struct('!4sH')
+_COMPACT_RECORD = struct.Struct('!dB4sH4sHI')
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+_PCAP_HEADER = struct.Struct('<IHHiIII')
+_PCAP_RECORD = struct.Struct('<IIII')
+_IPV4 = struct.Struct('!BBHHHBBH4s4s')
+_UDP = struct.Struct('!HHHH')
+
+# timestamp is time.time(), flags a combination of SENT and CLIENT, host/port the remote
+# end and local_host/local_port the socket end
+CapturedPacket = namedtuple('captured_packet', 'timestamp flags host port local_host local_port data')
+
+
+class CaptureError(ProtocolError):
+    """Unreadable capture file"""
+    pass
+
+
+def _packed(host):
+    try:
+        return socket.inet_aton(host or '0.0.0.0')
+    except (socket.error, TypeError, ValueError):
+        return b'\x00' * 4
+
+
+def _checksum(header):
+    total = sum(struct.unpack('!10H', header))
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def _ip_udp(packet):
+    """IPv4 + UDP frame of a CapturedPacket, as it was on the wire"""
+    remote, local = (_packed(packet.host), packet.port), (_packed(packet.local_host), packet.local_port)
+    (source, source_port), (destination, destination_port) = (local, remote) if packet.flags & SENT else (remote, local)
+    length = _IPV4.size + _UDP.size + len(packet.data)
+    identification = SENT_ID if packet.flags & SENT else 0
+    header = _IPV4.pack(0x45, 0, length, identification, 0, 64, socket.IPPROTO_UDP, 0, source, destination)
+    header = header[:10] + struct.pack('!H', _checksum(header)) + header[12:]
+    return header + _UDP.pack(source_port, destination_port, _UDP.size + len(packet.data), 0) + packet.data
+
+
+def encode_record(packet, fmt):
+    """Bytes of a CapturedPacket in the COMPACT or PCAP record format"""
+    if fmt == PCAP:
+        frame = _ip_udp(packet)
+        seconds = int(packet.timestamp)
+        return _PCAP_RECORD.pack(seconds, int((packet.timestamp - seconds) * 1000000), len(frame), len(frame)) + frame
+    return _COMPACT_RECORD.pack(packet.timestamp, packet.flags, _packed(packet.host), packet.port,
+                                _packed(packet.local_host), packet.local_port, len(packet.data)) + packet.data
+
+
+def file_header(fmt, snaplen=65535):
+    if fmt == PCAP:
+        return _PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, snaplen, LINKTYPE_RAW)
+    return _COMPACT_HEADER.pack(COMPACT_MAGIC, COMPACT_VERSION)
+
+
+class PacketRecorder(object):
+    """Records the datagrams of DatagramSocket into a capture file
+
+    record is called by the sockets and only appends to a ring buffer of capacity
+    datagrams, a thread writes it every flush_interval seconds. Datagrams that didn't
+    make it to the file before the ring was full are counted on dropped.
+
+    Basic usage:
+        recorder = PacketRecorder('/tmp/ssdp.pcap', PCAP)
+        recorder.start()
+        daemon = SSDPDaemon(recorder=recorder)
+        ...
+        recorder.join()
+
+    Attributes:
+        recorded - datagrams handed to record
+        written - datagrams written to the file
+        dropped - datagrams overwritten on the ring before being written
+    """
+
+    def __init__(self, path, fmt=COMPACT, capacity=65536, flush_interval=1.0, snaplen=65535,
+                 logger_name='Packet Recorder'):
+        """PacketRecorder constructor
+
+        Args:
+            :param path: capture file, truncated on start
+            :param fmt: COMPACT or PCAP
+            :param capacity: datagrams kept on the ring buffer until written
+            :param flush_interval: seconds between two writes
+            :param snaplen: payload bytes kept per datagram
+            :param logger_name: String logger name, default: 'Packet Recorder'.
+        """
+        assert (fmt in (COMPACT, PCAP)), "Invalid capture format {}".format(fmt)
+        self.path = path
+        self.fmt = fmt
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.snaplen = snaplen
+        self.logging = logging.getLogger(logger_name)
+        self.recorded = self.written = self.dropped = 0
+        # Appended by the sockets and popped by the writer, both atomic on a deque
+        self._ring = deque(maxlen=capacity)
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def record(self, flags, data, host, port, local):
+        """Records a datagram, called by DatagramSocket
+
+        Args:
+            :param flags: SENT and/or CLIENT
+            :param data: payload, bytes or a memoryview that's copied here
+            :param host: remote address
+            :param port: remote port
+            :param local: (address, port) of the socket
+        """
+        if isinstance(data, memoryview):
+            data = data[:self.snaplen].tobytes()
+        elif len(data) > self.snaplen:
+            data = data[:self.snaplen]
+        ring = self._ring
+        if len(ring) == self.capacity:
+            self.dropped += 1
+        ring.append(CapturedPacket(time.time(), flags, host, port, local[0], local[1], data))
+        self.recorded += 1
+
+    def start(self):
+        """Opens the capture file and starts the writer thread"""
+        self._file = open(self.path, 'wb')
+        self._file.write(file_header(self.fmt, self.snaplen))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.logging.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """Writes what's on the ring buffer, returns the datagrams written"""
+        ring = self._ring
+        chunk = []
+        fmt = self.fmt
+        try:
+            while True:
+                chunk.append(encode_record(ring.popleft(), fmt))
+        except IndexError:
+            pass
+        if chunk and self._file is not None:
+            try:
+                self._file.write(b''.join(chunk))
+                self._file.flush()
+            except (IOError, OSError, ValueError) as error:
+                self.logging.error('Cannot write {}: {}'.format(self.path, error))
+                return 0
+            self.written += len(chunk)
+        return len(chunk)
+
+    def join(self, timeout=None):
+        """Writes the remaining datagrams and closes the file"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        """Snapshot of the recorder counters"""
+        return {'recorded': self.recorded, 'written': self.written, 'dropped': self.dropped,
+                'pending': len(self._ring)}
+
+
+def _read_exact(handle, size):
+    data = handle.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def _read_compact(handle):
+    while True:
+        header = _read_exact(handle, _COMPACT_RECORD.size)
+        if header is None:
+            return
+        timestamp, flags, host, port, local_host, local_port, length = _COMPACT_RECORD.unpack(header)
+        data = _read_exact(handle, length)
+        if data is None:
+            raise CaptureError('Truncated capture record')
+        yield CapturedPacket(timestamp, flags, socket.inet_ntoa(host), port, socket.inet_ntoa(local_host),
+                             local_port, data)
+
+
+def _frame_ipv4(frame, linktype):
+    """Offset of the IPv4 header of a link layer frame, None if it's not IPv4"""
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return 0
+    if linktype == LINKTYPE_ETHERNET:
+        offset, ethertype = 14, frame[12:14]
+        while ethertype in (b'\x81\x00', b'\x88\xa8'):
+            # 802.1Q/802.1ad VLAN tags
+            ethertype = frame[offset + 2:offset + 4]
+            offset += 4
+        return offset if ethertype == b'\x08\x00' else None
+    if linktype == LINKTYPE_LINUX_SLL:
+        return 16 if frame[14:16] == b'\x08\x00' else None
+    raise CaptureError('Unsupported pcap link type {}'.format(linktype))
+
+
+def _read_pcap(handle, header):
+    magic, = struct.unpack('<I', header[:4])
+    order = '<' if magic in (0xa1b2c3d4, 0xa1b23c4d) else '>'
+    nanoseconds = magic in (0xa1b23c4d, 0x4d3cb2a1)
+    linktype = struct.unpack(order + 'I', header[20:24])[0] & 0xffff
+    record = struct.Struct(order + 'IIII')
+    while True:
+        data = _read_exact(handle, record.size)
+        if data is None:
+            return
+        seconds, fraction, length, _ = record.unpack(data)
+        frame = _read_exact(handle, length)
+        if frame is None:
+            raise CaptureError('Truncated pcap record')
+        offset = _frame_ipv4(frame, linktype)
+        if offset is None or len(frame) < offset + _IPV4.size or ord(frame[offset:offset + 1]) >> 4 != 4:
+            continue
+        ip_header = _IPV4.unpack_from(frame, offset)
+        if ip_header[6] != socket.IPPROTO_UDP or ip_header[4] & 0x3fff:
+            # Not UDP or an IP fragment
+            continue
+        udp = offset + (ip_header[0] & 0x0f) * 4
+        if len(frame) < udp + _UDP.size:
+            continue
+        source_port, destination_port, udp_length, _ = _UDP.unpack_from(frame, udp)
+        payload = frame[udp + _UDP.size:udp + max(udp_length, _UDP.size)]
+        source, destination = socket.inet_ntoa(ip_header[8]), socket.inet_ntoa(ip_header[9])
+        timestamp = seconds + fraction / (1e9 if nanoseconds else 1e6)
+        if ip_header[3] == SENT_ID:
+            yield CapturedPacket(timestamp, SENT, destination, destination_port, source, source_port, payload)
+        else:
+            # Anything not sent to the SSDP port came back to a client socket
+            flags = 0 if destination_port == 1900 else CLIENT
+            yield CapturedPacket(timestamp, flags, source, source_port, destination, destination_port, payload)
+
+
+def read_capture(path):
+    """CapturedPacket generator of a COMPACT or pcap capture file
+
+    Raises:
+        CaptureError - unknown or truncated file
+    """
+    with open(path, 'rb') as handle:
+        header = handle.read(_PCAP_HEADER.size)
+        if header[:4] == COMPACT_MAGIC:
+            _, version = _COMPACT_HEADER.unpack(header[:_COMPACT_HEADER.size])
+            if version != COMPACT_VERSION:
+                raise CaptureError('Unsupported capture version {}'.format(version))
+            handle.seek(_COMPACT_HEADER.size)
+            for packet in _read_compact(handle):
+                yield packet
+        elif len(header) == _PCAP_HEADER.size and header[:4] in (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4',
+                                                                  b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'):
+            for packet in _read_pcap(handle, header):
+                yield packet
+        else:
+            raise CaptureError('{} is not a capture file'.format(path))
+
+
+class _ReplaySocket(object):
+    """Stands for a DatagramSocket of the replayed link, recv_batch returns the queued packets"""
+
+    def __init__(self):
+        self.pending = []
+        self.sent = 0
+
+    def recv_batch(self, max_packets=None):
+        packages, self.pending = self.pending, []
+        return packages
+
+    def send_batch(self, messages):
+        self.sent += len(messages)
+        return []
+
+
+class Replayer(object):
+    """Feeds a capture through the handlers of a discovery.SSDPDaemon, for offline profiling
+
+    The datagrams received by the capture go to handle_server (group traffic) or
+    handle_client (unicast answers) in batches like recv_batch returns them, the
+    datagrams sent are skipped. The daemon doesn't have to be started, its registry,
+    subscriptions and queues are updated as if the traffic was live. Answers to the
+    replayed M-SEARCH are rendered and counted but never sent.
+    """
+
+    def __init__(self, daemon, address=None, batch_size=64):
+        """Replayer constructor
+
+        Args:
+            :param daemon: discovery.SSDPDaemon to feed
+            :param address: local address advertised on the answers, default is the first link's
+            :param batch_size: datagrams handed to a handler at once at full speed
+        """
+        self.daemon = daemon
+        self.batch_size = batch_size
+        # Capture time of the datagrams being handled, so the answer rate limits see the
+        # original pace. Answers are due right away and counted instead of sent
+        self._now = 0.0
+        self.link = InterfaceLink(address if address is not None else daemon.links[0].address,
+                                  ResponseScheduler(clock=lambda: self._now, uniform=lambda low, high: 0.0))
+        self.link.client = _ReplaySocket()
+        self.link.server = _ReplaySocket()
+
+    def replay(self, packets, speed=None):
+        """Replays CapturedPacket, i.e. from read_capture
+
+        Args:
+            :param packets: iterable of CapturedPacket
+            :param speed: None for as fast as possible, 1.0 for the original pace, 2.0 twice as fast
+
+        Returns:
+            dict with the datagrams replayed, skipped, answers rendered, elapsed seconds and rate
+        """
+        link = self.link
+        daemon = self.daemon
+        replayed = skipped = 0
+        first = None
+        started = time.time()
+        for packet in packets:
+            if packet.flags & SENT:
+                skipped += 1
+                continue
+            if speed:
+                if first is None:
+                    first = packet.timestamp
+                delay = started + (packet.timestamp - first) / speed - time.time()
+                if delay > 0:
+                    self._dispatch()
+                    time.sleep(delay)
+            self._now = packet.timestamp
+            socket_ = link.client if packet.flags & CLIENT else link.server
+            socket_.pending.append(UdpPackage(packet.data, packet.host, packet.port))
+            replayed += 1
+            if speed or len(socket_.pending) >= self.batch_size:
+                self._dispatch()
+        self._dispatch()
+        elapsed = time.time() - started
+        return {'replayed': replayed, 'skipped': skipped, 'answers': link.client.sent,
+                'devices': len(daemon.registry), 'elapsed': elapsed,
+                'rate': replayed / elapsed if elapsed > 0 else 0.0}
+
+    def _dispatch(self):
+        link = self.link
+        if link.server.pending:
+            self.daemon.handle_server(link)
+        if link.client.pending:
+            self.daemon.handle_client(link)
+        replies = link.scheduler.due()
+        if replies:
+            link.client.send_batch(replies)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Bounded delivery queues and filtered subscriptions for the discovery daemons
+
+A slow consumer must not make the daemon memory grow without limits, queues are
+bounded with an explicit overflow policy and count what they had to drop.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import logging
+import threading
+from collections import OrderedDict, deque
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+# Overflow policies
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+COALESCE = 'coalesce'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK, COALESCE)
+
+
+def usn_key(item):
+    """Default coalescing key, the USN of a parsed message or a registry event"""
+    entry = getattr(item, 'entry', None)
+    if entry is not None:
+        return entry.usn
+    try:
+        return item.get('usn')
+    except AttributeError:
+        return None
+
+
+class DeliveryQueue(Queue.Queue):
+    """Queue.Queue with an overflow policy
+
+    Policies (used when maxsize is reached):
+        DROP_OLDEST - the oldest pending item is discarded
+        DROP_NEWEST - the item being put is discarded
+        BLOCK - put blocks like a regular Queue.Queue, pushing back on the producer
+        COALESCE - a pending item with the same key (USN) is replaced in place, a new
+                   key on a full queue discards the oldest item
+
+    Attributes:
+        dropped - items discarded by the policy
+        coalesced - items replaced by a newer one with the same key
+    """
+
+    def __init__(self, maxsize=0, policy=DROP_OLDEST, key=usn_key):
+        """DeliveryQueue constructor
+
+        Args:
+            :param maxsize: max pending items, 0 is unbounded
+            :param policy: one of DROP_OLDEST, DROP_NEWEST, BLOCK or COALESCE
+            :param key: callable returning the coalescing key of an item (COALESCE only)
+        """
+        assert (policy in POLICIES), "Invalid overflow policy {}".format(policy)
+        self.policy = policy
+        self.key = key
+        self.dropped = 0
+        self.coalesced = 0
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        if self.policy == COALESCE:
+            # key -> item, insertion ordered
+            self.queue = OrderedDict()
+        else:
+            self.queue = deque()
+
+    def _put(self, item):
+        if self.policy == COALESCE:
+            key = self.key(item)
+            self.queue[object() if key is None else key] = item
+        else:
+            self.queue.append(item)
+
+    def _get(self):
+        if self.policy == COALESCE:
+            return self.queue.popitem(last=False)[1]
+        return self.queue.popleft()
+
+    def put(self, item, block=True, timeout=None):
+        """Puts an item applying the overflow policy, only BLOCK ever blocks or raises Full"""
+        if self.policy == BLOCK:
+            return Queue.Queue.put(self, item, block, timeout)
+        with self.not_full:
+            if self.policy == COALESCE:
+                key = self.key(item)
+                if key is not None and key in self.queue:
+                    self.queue[key] = item
+                    self.coalesced += 1
+                    return
+            if 0 < self.maxsize <= self._qsize():
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                self._get()
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def stats(self):
+        """Snapshot of the queue counters"""
+        return {'size': self.qsize(), 'maxsize': self.maxsize, 'policy': self.policy,
+                'dropped': self.dropped, 'coalesced': self.coalesced}
+
+
+class Subscription(object):
+    """A consumer registered on a SubscriptionIndex
+
+    Attributes:
+        queue - DeliveryQueue receiving the matching items
+        pattern - ST pattern, None matches everything
+        predicate - optional callable(item) filtering the items that matched the pattern
+    """
+
+    __slots__ = ('queue', 'pattern', 'predicate')
+
+    def __init__(self, queue, pattern=None, predicate=None):
+        self.queue = queue
+        self.pattern = pattern
+        self.predicate = predicate
+
+    def get(self, block=True, timeout=None):
+        """Shortcut to queue.get"""
+        return self.queue.get(block, timeout)
+
+
+class SubscriptionIndex(object):
+    """Routes items only to the subscriptions interested on their ST
+
+    Patterns:
+        None - every item
+        'urn:schemas-upnp-org:device:MediaServer:1' - exact ST, dict lookup
+        'urn:schemas-upnp-org:device:*' - ST prefix, must end with ':*', looked up once
+                                          per ':' of the ST being published
+    """
+
+    def __init__(self, logger_name='Subscriptions'):
+        self.logging = logging.getLogger(logger_name)
+        self._lock = threading.Lock()
+        self._exact = {}
+        self._prefix = {}
+        self._any = []
+
+    def __len__(self):
+        return len(self._any) + sum(len(subs) for subs in self._exact.values()) + \
+            sum(len(subs) for subs in self._prefix.values())
+
+    def subscribe(self, pattern=None, predicate=None, maxsize=1024, policy=DROP_OLDEST, queue=None):
+        """Registers a consumer
+
+        Args:
+            :param pattern: ST pattern, see class docstring
+            :param predicate: optional callable(item) returning True for the wanted items
+            :param maxsize: max pending items of the created queue
+            :param policy: overflow policy of the created queue
+            :param queue: deliver to this queue instead of creating a DeliveryQueue
+
+        Returns:
+            Subscription
+        """
+        if queue is None:
+            queue = DeliveryQueue(maxsize, policy)
+        subscription = Subscription(queue, pattern, predicate)
+        with self._lock:
+            self._bucket(pattern, create=True).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a Subscription, pending items stay on its queue"""
+        with self._lock:
+            bucket = self._bucket(subscription.pattern)
+            if bucket is not None and subscription in bucket:
+                bucket.remove(subscription)
+                if not bucket and subscription.pattern is not None:
+                    index, key = self._key(subscription.pattern)
+                    del index[key]
+
+    def _key(self, pattern):
+        if pattern.endswith(':*'):
+            return self._prefix, pattern[:-1]
+        return self._exact, pattern
+
+    def _bucket(self, pattern, create=False):
+        if pattern is None:
+            return self._any
+        index, key = self._key(pattern)
+        if create:
+            return index.setdefault(key, [])
+        return index.get(key)
+
+    def matches(self, st):
+        """Subscriptions whose pattern matches the ST, predicates are not evaluated"""
+        matched = list(self._any)
+        if st:
+            matched.extend(self._exact.get(st, ()))
+            if self._prefix:
+                colon = st.find(':')
+                while colon >= 0:
+                    matched.extend(self._prefix.get(st[:colon + 1], ()))
+                    colon = st.find(':', colon + 1)
+        return matched
+
+    def publish(self, st, item):
+        """Delivers an item to the interested subscriptions
+
+        Args:
+            :param st: search target / notification type of the item
+            :param item: anything, passed to the predicates and queues as is
+
+        Returns:
+            Number of subscriptions the item was delivered to
+        """
+        delivered = 0
+        for subscription in self.matches(st):
+            if subscription.predicate is not None:
+                try:
+                    if not subscription.predicate(item):
+                        continue
+                except Exception as error:
+                    self.logging.error('Subscription predicate failed: {}'.format(error))
+                    continue
+            subscription.queue.put(item)
+            delivered += 1
+        return delivered
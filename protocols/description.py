@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+"""UPnP device description fetcher
+    - http://upnp.org/specs/arch/UPnP-arch-DeviceArchitecture-v1.1.pdf (2.3)
+
+Fetches the description XML found at the LOCATION of the discovered devices and
+parses it into compact Device/Service records:
+    - a bounded pool of worker threads, LOCATIONs shared by several USNs (the root
+      device and its services) are fetched once
+    - keep-alive HTTP/1.1 connections pooled per host
+    - descriptions cached by LOCATION and revalidated with ETag/Last-Modified
+    - streaming parse (ElementTree.iterparse), the document is never kept whole
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import socket
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+from xml.etree import ElementTree
+try:
+    import httplib
+    from urlparse import urljoin, urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urljoin, urlsplit
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+from .registry import DeviceRegistry
+from .metrics import METRICS, clock
+from .delivery import DeliveryQueue, COALESCE, DROP_OLDEST
+from .networking import ProtocolError
+
+# Result status
+FETCHED = 'fetched'
+NOT_MODIFIED = 'not-modified'
+FRESH = 'fresh'
+FAILED = 'failed'
+
+USER_AGENT = 'Simple Network Framework / 0.1 UPnP/1.1'
+# Descriptions are small, anything larger is refused
+MAX_SIZE = 1024 * 1024
+
+Service = namedtuple('service', 'service_type service_id scpd_url control_url event_sub_url')
+Device = namedtuple('device', 'udn device_type friendly_name manufacturer model_name model_number '
+                              'serial_number presentation_url services devices')
+DeviceDescription = namedtuple('device_description', 'location spec_version url_base device')
+# status is one of FETCHED, NOT_MODIFIED, FRESH or FAILED, description is None on FAILED
+DescriptionResult = namedtuple('description_result', 'location status description error')
+
+_DEVICE_FIELDS = {'UDN': 'udn', 'deviceType': 'device_type', 'friendlyName': 'friendly_name',
+                  'manufacturer': 'manufacturer', 'modelName': 'model_name', 'modelNumber': 'model_number',
+                  'serialNumber': 'serial_number', 'presentationURL': 'presentation_url'}
+_SERVICE_FIELDS = {'serviceType': 'service_type', 'serviceId': 'service_id', 'SCPDURL': 'scpd_url',
+                   'controlURL': 'control_url', 'eventSubURL': 'event_sub_url'}
+_URL_FIELDS = ('presentation_url', 'scpd_url', 'control_url', 'event_sub_url')
+
+
+class DescriptionError(ProtocolError):
+    """The description couldn't be fetched or isn't a valid UPnP description"""
+    pass
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+class _LimitedReader(object):
+    """File-like wrapper refusing to read more than limit bytes"""
+
+    __slots__ = ('stream', 'remaining')
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.remaining = limit
+
+    def read(self, size=-1):
+        size = 64 * 1024 if size is None or size < 0 else size
+        data = self.stream.read(min(size, self.remaining + 1))
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            raise DescriptionError('Description larger than the size limit')
+        return data
+
+
+def _drain(stream, limit):
+    """Reads the rest of a response body, False if more than limit bytes were left"""
+    reader = _LimitedReader(stream, limit)
+    try:
+        while reader.read():
+            pass
+    except DescriptionError:
+        return False
+    return True
+
+
+def parse_description(stream, location, max_size=MAX_SIZE):
+    """Streaming parse of a device description
+
+    Elements are discarded as soon as their device/service record is built, so memory
+    stays proportional to the records and not to the document. Relative URLs are
+    resolved against URLBase, or the location when there's none.
+
+    Args:
+        :param stream: file-like object with the XML, i.e. an HTTP response
+        :param location: URL the description was fetched from
+        :param max_size: bytes read at most
+
+    Returns:
+        DeviceDescription
+
+    Raises:
+        DescriptionError - malformed XML, unknown encoding, larger than max_size or without
+            a root device
+    """
+    spec_version = [None, None]
+    url_base = None
+    root = None
+    # Device fields being built, innermost last
+    devices = []
+    service = None
+    path = []
+    try:
+        for event, element in ElementTree.iterparse(_LimitedReader(stream, max_size), events=('start', 'end')):
+            name = _local_name(element.tag)
+            if event == 'start':
+                path.append(name)
+                if name == 'device':
+                    devices.append({'services': [], 'devices': []})
+                elif name == 'service' and devices:
+                    service = {}
+                continue
+            path.pop()
+            parent = path[-1] if path else None
+            text = (element.text or '').strip()
+            if name == 'device' and devices:
+                fields = devices.pop()
+                device = Device(*[fields.get(field) for field in Device._fields[:-2]],
+                                services=tuple(fields['services']), devices=tuple(fields['devices']))
+                if devices:
+                    devices[-1]['devices'].append(device)
+                elif root is None:
+                    root = device
+                element.clear()
+            elif name == 'service' and service is not None:
+                devices[-1]['services'].append(Service(*[service.get(field) for field in Service._fields]))
+                service = None
+                element.clear()
+            elif parent == 'service' and service is not None and name in _SERVICE_FIELDS:
+                service[_SERVICE_FIELDS[name]] = text
+            elif parent == 'device' and devices and name in _DEVICE_FIELDS:
+                devices[-1][_DEVICE_FIELDS[name]] = text
+            elif parent == 'specVersion' and name in ('major', 'minor'):
+                spec_version[name == 'minor'] = text
+            elif name == 'URLBase' and parent == 'root':
+                url_base = text or None
+    except DescriptionError:
+        raise
+    except (ElementTree.ParseError, SyntaxError, LookupError, ValueError) as error:
+        # LookupError is an unknown encoding on the XML declaration
+        raise DescriptionError('Invalid description at {}: {}'.format(location, error))
+    if root is None:
+        raise DescriptionError('No root device at {}'.format(location))
+    base = url_base or location
+    version = '.'.join(part for part in spec_version if part is not None) or None
+    return DeviceDescription(location, version, url_base, _resolve(root, base))
+
+
+def _resolve(device, base):
+    """Device with its URLs made absolute"""
+    services = tuple(service._replace(**dict((field, urljoin(base, getattr(service, field)))
+                                             for field in _URL_FIELDS
+                                             if field in service._fields and getattr(service, field)))
+                     for service in device.services)
+    presentation_url = urljoin(base, device.presentation_url) if device.presentation_url else None
+    return device._replace(presentation_url=presentation_url, services=services,
+                           devices=tuple(_resolve(child, base) for child in device.devices))
+
+
+class ConnectionPool(object):
+    """Idle keep-alive HTTP connections by (scheme, host, port)
+
+    Note:
+        Thread safe, a connection is used by a single thread between get and put.
+    """
+
+    def __init__(self, max_per_host=2, timeout=5.0):
+        """ConnectionPool constructor
+
+        Args:
+            :param max_per_host: idle connections kept per host, the others are closed
+            :param timeout: socket timeout of the connections in seconds
+        """
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        # key -> list of idle connections
+        self._idle = {}
+
+    def get(self, key):
+        """Returns (connection, reused) for a (scheme, host, port) key"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.created += 1
+        scheme, host, port = key
+        factory = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return factory(host, port, timeout=self.timeout), False
+
+    def put(self, key, connection):
+        """Gives a connection back after its response was read to the end"""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Closes every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def stats(self):
+        """Snapshot of the pool counters"""
+        with self._lock:
+            return {'idle': sum(len(connections) for connections in self._idle.values()),
+                    'created': self.created, 'reused': self.reused}
+
+
+class CachedDescription(object):
+    """A description with the validators of the response it came from"""
+
+    __slots__ = ('description', 'etag', 'last_modified', 'fetched')
+
+    def __init__(self, description, etag, last_modified, fetched):
+        self.description = description
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+
+
+class DescriptionCache(object):
+    """Least recently used descriptions by LOCATION"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, location):
+        """CachedDescription of a location or None"""
+        with self._lock:
+            cached = self._entries.pop(location, None)
+            if cached is not None:
+                self._entries[location] = cached
+            return cached
+
+    def put(self, location, cached):
+        with self._lock:
+            self._entries.pop(location, None)
+            self._entries[location] = cached
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, location):
+        with self._lock:
+            self._entries.pop(location, None)
+
+
+def _location_key(item):
+    """Coalescing key of the fetch requests, LOCATION of an event or the location itself"""
+    entry = getattr(item, 'entry', None)
+    if entry is not None:
+        return entry.location
+    return item[0] if isinstance(item, tuple) else None
+
+
+class DescriptionFetcher(object):
+    """Fetches and parses the descriptions of discovered devices on a pool of threads
+
+    Locations come from submit or from the registry events of the daemons given to
+    attach, results go to results_out_q (or a callback). A fresh cached description
+    is returned without any request, an older one is revalidated with If-None-Match /
+    If-Modified-Since and a registry update (i.e. a new CONFIGID.UPNP.ORG) always
+    revalidates.
+
+    Basic usage:
+        fetcher = DescriptionFetcher()
+        fetcher.attach(daemon)
+        fetcher.start()
+        result = fetcher.results_out_q.get()
+    """
+
+    def __init__(self, workers=4, max_per_host=2, timeout=5.0, fresh_for=60.0, cache_size=1024,
+                 max_size=MAX_SIZE, queue_size=1024, overflow_policy=DROP_OLDEST, callback=None,
+                 logger_name='Description Fetcher', metrics=METRICS):
+        """DescriptionFetcher constructor
+
+        Args:
+            :param workers: threads fetching concurrently
+            :param max_per_host: idle keep-alive connections kept per host
+            :param timeout: HTTP timeout in seconds
+            :param fresh_for: seconds a description is used without revalidation
+            :param cache_size: descriptions cached, least recently used are evicted
+            :param max_size: largest description accepted in bytes
+            :param queue_size: max pending locations and results
+            :param overflow_policy: overflow policy of results_out_q, see delivery.DeliveryQueue
+            :param callback: optional callable(DescriptionResult) called by the workers
+                instead of putting the result on results_out_q
+            :param logger_name: String logger name, default: 'Description Fetcher'.
+            :param metrics: metrics.MetricsRegistry for the fetcher metrics, default is the shared one
+        """
+        self.logging = logging.getLogger(logger_name)
+        self.workers = workers
+        self.fresh_for = fresh_for
+        self.max_size = max_size
+        self.callback = callback
+        self.pool = ConnectionPool(max_per_host, timeout)
+        self.cache = DescriptionCache(cache_size)
+        # Pending locations, coalesced by LOCATION so a device is fetched once
+        self.requests = DeliveryQueue(queue_size, COALESCE, key=_location_key)
+        self.results_out_q = DeliveryQueue(queue_size, overflow_policy)
+        self._threads = []
+        self._stop = threading.Event()
+        # Locations being fetched, another request for them while in flight is dropped
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self.coalesced = 0
+        self._results = dict((status, metrics.counter('snf_description_fetch_total', 'Description requests',
+                                                      fetcher=logger_name, status=status))
+                             for status in (FETCHED, NOT_MODIFIED, FRESH, FAILED))
+        self._latency = metrics.histogram('snf_description_fetch_seconds', 'Seconds to fetch and parse a description',
+                                          fetcher=logger_name)
+
+    def start(self):
+        """Starts the worker threads"""
+        self._stop.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name='{}-{}'.format(self.logging.name, index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self, timeout=None):
+        """Stops the workers, pending locations are discarded"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self.pool.close()
+
+    def attach(self, daemon, pattern=None):
+        """Fetches the description of the devices added or updated on a discovery.SSDPDaemon
+
+        Args:
+            :param daemon: SSDPDaemon whose registry events are followed
+            :param pattern: ST pattern, see SSDPDaemon.subscribe
+
+        Returns:
+            delivery.Subscription, give it to daemon.unsubscribe to detach
+        """
+        return daemon.subscribe(pattern, predicate=self._wanted, queue=self.requests)
+
+    @staticmethod
+    def _wanted(event):
+        return event.action in (DeviceRegistry.ADDED, DeviceRegistry.UPDATED) and bool(event.entry.location)
+
+    def submit(self, location, revalidate=False):
+        """Queues a location to be fetched by the workers
+
+        Args:
+            :param location: description URL
+            :param revalidate: ignore fresh_for, the cached description is revalidated
+        """
+        self.requests.put((location, revalidate))
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                item = self.requests.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            entry = getattr(item, 'entry', None)
+            if entry is not None:
+                location, revalidate = entry.location, item.action == DeviceRegistry.UPDATED
+            else:
+                location, revalidate = item
+            with self._lock:
+                if location in self._inflight:
+                    self.coalesced += 1
+                    continue
+                self._inflight.add(location)
+            try:
+                result = self.fetch(location, revalidate)
+            except Exception:
+                # Never ends the worker, nothing would restart it
+                self.logging.exception('Unexpected error fetching {}'.format(location))
+                continue
+            finally:
+                with self._lock:
+                    self._inflight.discard(location)
+            if self.callback is not None:
+                try:
+                    self.callback(result)
+                except Exception:
+                    self.logging.exception('Description callback failed for {}'.format(location))
+            else:
+                self.results_out_q.put(result)
+
+    def fetch(self, location, revalidate=False):
+        """Fetches a description on the calling thread, see the class docstring for the caching
+
+        Returns:
+            DescriptionResult, errors are reported on it and not raised
+        """
+        started = clock()
+        cached = self.cache.get(location)
+        if cached is not None and not revalidate and time.time() - cached.fetched < self.fresh_for:
+            self._results[FRESH].value += 1
+            return DescriptionResult(location, FRESH, cached.description, None)
+        try:
+            status, description = self._request(location, cached)
+        except (DescriptionError, httplib.HTTPException, socket.error, ValueError) as error:
+            self.logging.debug('Cannot fetch {}: {}'.format(location, error))
+            self._results[FAILED].value += 1
+            return DescriptionResult(location, FAILED, None, error)
+        self._results[status].value += 1
+        self._latency.observe(clock() - started)
+        return DescriptionResult(location, status, description, None)
+
+    def _request(self, location, cached):
+        """Returns (FETCHED or NOT_MODIFIED, DeviceDescription), a reused connection closed
+        by the server is retried once on a new one"""
+        parts = urlsplit(location)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise DescriptionError('Unsupported location {}'.format(location))
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = {'User-Agent': USER_AGENT, 'Accept': 'text/xml, application/xml'}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        while True:
+            connection, reused = self.pool.get(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            break
+        try:
+            if response.status == 304 and cached is not None:
+                status, description = NOT_MODIFIED, cached.description
+            elif response.status == 200:
+                status, description = FETCHED, parse_description(response, location, self.max_size)
+            else:
+                # The body isn't read, the connection is closed instead
+                raise DescriptionError('HTTP {} from {}'.format(response.status, location))
+            # The connection is only reusable at the end of the body, whatever the parser left
+            drained = _drain(response, self.max_size)
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close or not drained:
+            connection.close()
+        else:
+            self.pool.put(key, connection)
+        if status == NOT_MODIFIED:
+            cached.fetched = time.time()
+        else:
+            self.cache.put(location, CachedDescription(description, response.getheader('etag'),
+                                                       response.getheader('last-modified'), time.time()))
+        return status, description
+
+    def stats(self):
+        """Snapshot of the fetcher counters"""
+        return {'cached': len(self.cache), 'pending': self.requests.qsize(), 'pool': self.pool.stats(),
+                'coalesced': self.coalesced + self.requests.coalesced,
+                'results': dict((status, counter.value) for status, counter in self._results.items())}
@@ -1,22 +1,37 @@
 # -*- coding: utf-8 -*-
 """Implementation of network discovery protocols
 Done:
-    - UPnP/SSDP
-To-do:
-    - SLP
-    - mDNS
+    - UPnP/SSDP, device descriptions (see description.py)
+    - mDNS (see mdns.py)
+    - SLP (see slp.py)
 """
 
 __author__ = 'douglasvinter'
 __version__ = '0.1'
 
-import upnp
 import time
-import Queue
 import logging
 import threading
-from networking import DatagramSocket, SocketSelector, \
-    MulticastException, UnicastException, get_host_address
+import zlib
+import socket
+import functools
+import itertools
+import random
+import struct
+from collections import OrderedDict
+from . import upnp
+from .advertising import AdvertisementRegistry, NotifyScheduler, ROOT_DEVICE, search_matches
+from . import snapshot
+from .registry import DeviceRegistry
+from .scheduling import ResponseScheduler, SearchScheduler, RefreshScheduler
+from .metrics import METRICS, clock
+from .delivery import DeliveryQueue, SubscriptionIndex, DROP_OLDEST
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+from .networking import DatagramSocket, SocketSelector, InterfaceTable, to_bytes, \
+    MulticastException, UnicastException, JoinGroupError, NetworkConfigurationError
 
 # Logging for debugging
 logging.basicConfig(level=logging.DEBUG,
@@ -49,7 +64,7 @@ class SSDP(object):
         """
 
         self.client = DatagramSocket(socket_type=DatagramSocket.CLIENT,
-                                     implemented_protocol=SSDP.__class__.__name__,
+                                     implemented_protocol=SSDP.__name__,
                                      logger_name=logger_name,
                                      group=upnp.MULTICAST_GROUP,
                                      port=upnp.MULTICAST_PORT,
@@ -98,6 +113,39 @@ class SSDP(object):
         return payload
 
 
+def shard_of(host, count):
+    """Worker index of a sender address, stable across processes (unlike hash)"""
+    return (zlib.crc32(to_bytes(host)) & 0xffffffff) % count
+
+
+class InterfaceLink(object):
+    """Client and server sockets of SSDPDaemon bound to a single local interface
+
+    Attributes:
+        address - local IPv4 address, None for the legacy INADDR_ANY pair
+        client - DatagramSocket sending M-SEARCH and answers out of the interface
+        server - DatagramSocket receiving only the group traffic of the interface
+        scheduler - scheduling.ResponseScheduler of the answers sent from this interface
+    """
+
+    __slots__ = ('address', 'client', 'server', 'scheduler')
+
+    def __init__(self, address, scheduler):
+        self.address = address
+        self.scheduler = scheduler
+        self.client = None
+        self.server = None
+
+    def __repr__(self):
+        return '<InterfaceLink {}>'.format(self.address or 'INADDR_ANY')
+
+    def destroy(self):
+        """Closes both sockets"""
+        for sock in (self.client, self.server):
+            if sock is not None:
+                sock.destroy()
+
+
 class SSDPDaemon(threading.Thread):
     """Simple Service Discovery Protocol for services and devices.
 
@@ -109,8 +157,8 @@ class SSDPDaemon(threading.Thread):
     Note:
         Its pretty common to send a UPnP 1.1 protocol scan and receive
         an UPnP 1.0 response, since they're pretty  much equal.
-        *Only M - SEARCH and NOTIFY will be available for now,
-        The service wont advertise its presence on the LAN.
+        Advertisements are answered to M-SEARCH and announced with NOTIFY ssdp:alive
+        (ssdp:byebye on join), see advertising.NotifyScheduler.
 
     The searchTarget supports a series of payload
 
@@ -128,7 +176,12 @@ class SSDPDaemon(threading.Thread):
         |_____________________|                       |___________________|
     """
 
-    
+    # Search targets restored from the snapshot are searched once, within this many seconds
+    WARM_SEARCH_SPREAD = 10.0
+    # Seconds between two attempts to reopen the sockets of an interface
+    RELINK_RETRY = 10.0
+    # Seconds after which an unchanged registry is saved anyway, for the refreshed expiries
+    SNAPSHOT_REFRESH = 600.0
 
     def add_m_search(self, search_target,  max_wait=5):
         """ Builds SSDP M-SEARCH payload and add to search strings, won't accept the same search_target
@@ -140,85 +193,216 @@ class SSDPDaemon(threading.Thread):
         :return bool:
         """
 
-        for i in xrange(len(self._search_strings)):
-            if self._search_strings[i].find(search_target) > -1:
-                self.logging.info("ST: {} already registered, not added.".format(search_target))
-                return False
+        if search_target in self._search_strings:
+            self.logging.info("ST: {} already registered, not added.".format(search_target))
+            return False
         if upnp.is_valid_search_target(search_target) and upnp.is_valid_max_wait(max_wait):
-            self._search_strings.append(upnp.m_search(search_target, max_wait, self.user_agent))
+            search_strings = self._search_strings.copy()
+            search_strings[search_target] = upnp.m_search(search_target, max_wait, self.user_agent)
+            self._search_strings = search_strings
+            if self._restored and any(search_matches(search_target, entry.st) for entry in self.registry):
+                # Known from the snapshot, a single search revalidates it, spread so a fleet
+                # restarting together doesn't search at once
+                self.searches.add(search_target, delay=random.uniform(0, self.WARM_SEARCH_SPREAD), retries=1)
+            else:
+                self.searches.add(search_target)
+            SocketSelector.wakeup(self._selector)
             self.logging.debug('Added new M-SEARCH for target: {}'.format(search_target))
             return True
         return False
 
+    def watch(self, search_target):
+        """Keeps the NOTIFY announcements a search target asks for, without sending its M-SEARCH
+
+        i.e. on the SSDPWorkerPool workers, only one of them searches but each one gets the
+        announcements of its own shard.
+        """
+        self._watched = self._watched | frozenset([search_target])
+
     def remove_m_search(self, search_target):
-        """Removes all search parameters that contains the informed string
+        """Removes the M-SEARCH of a search target
 
         Args:
-            :param search_target: search target string to be removed from list
+            :param search_target: search target string to be removed, a target that was never
+                added removes every target containing it instead (previous behaviour)
         """
-        idx = []
-        for i in xrange(len(self._search_strings)):
-            if self._search_strings[i].find(search_target) > -1:
-                idx.append(i)
-                self.logging.debug('Removed M-SEARCH for target: {}'.format(self._search_strings[i]))
-        self._search_strings = [v for k, v in enumerate(self._search_strings) if k not in idx]
+        search_strings = self._search_strings.copy()
+        if search_strings.pop(search_target, None) is None:
+            for target in [target for target in search_strings if search_target in target]:
+                del search_strings[target]
+        self._search_strings = search_strings
+        for target in [target for target in self.searches.targets() if target not in search_strings]:
+            self.searches.remove(target)
+        self.logging.debug('Removed M-SEARCH for target: {}'.format(search_target))
+
+    def advertise(self, target, usn, location=None, max_age=1800):
+        """Answers the M-SEARCH for a notification type, see advertising.AdvertisementRegistry.add"""
+        return self.advertisements.add(target, usn, location, max_age)
+
+    def withdraw(self, target, usn):
+        """Stops answering for a notification type, see advertising.AdvertisementRegistry.remove"""
+        return self.advertisements.remove(target, usn)
 
 
 
     def __init__(self, server_usn='urn:schemas-upnp-org:service:SimpleNetworkFramework:1',
                  server_uuid='uuid:xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx',
                  user_agent= 'Simple Network Framework / 0.1', m_search_timeout=100.0,
-                 logger_name='SSDP Agent', monitoring=False):
+                 logger_name='SSDP Agent', monitoring=False, raw_responses=True, queue_size=0,
+                 overflow_policy=DROP_OLDEST, interfaces=None, reuse_port=False, shard=None, metrics=None,
+                 ignore_local=True, notify=False, passive=False, stale_after=None, snapshot=None,
+                 snapshot_interval=60.0, refresh=False, recorder=None):
         """Creates an SSDPDaemon agent to keep sending and receiving SSDP messages
 
         Args:
-            :param server_usn: register your service tag to be found on network
-            :param server_uuid: register your device tag to be found on network
-            :param m_search_timeout: timeout to send m search strings in seconds
+            :param server_usn: register your service tag to be found on network, None for none
+            :param server_uuid: register your device tag to be found on network, None for none.
+                More devices and services are added to the advertisements registry, see advertise
+            :param m_search_timeout: timeout to send m search strings in seconds, the shortest
+                interval between the searches of a target, it grows while the results are stable
+                (see scheduling.SearchScheduler), 0 disables the periodic and startup searches
             :param logger_name: String logger name, default: 'SSDP Daemon'.
             :param monitoring: Change this flag to true if you want all the data to be in the Queue -
                 server_out_q
+            :param raw_responses: Set to False to stop pushing every response to client_out_q,
+                de-duplicated add/update/expire events are always available on discovery_out_q
+            :param queue_size: max pending items on each output queue, default 0 is unbounded
+            :param overflow_policy: what a full output queue does, see delivery.DeliveryQueue
+            :param interfaces: None for a single socket pair on INADDR_ANY, 'all' for a socket
+                pair on every non loopback interface or a list of interface names / addresses,
+                see networking.InterfaceTable.resolve
+            :param reuse_port: bind the listeners with SO_REUSEPORT, see workers.SSDPWorkerPool
+            :param shard: (index, count) tuple, only the multicast senders whose shard_of is index
+                are handled by this daemon, the others are left to its sibling processes
+            :param metrics: metrics.MetricsRegistry for the daemon and socket metrics, default is the
+                shared one, labelled with the logger_name. The gauges are only registered by the
+                first live daemon of a logger_name
+            :param ignore_local: don't answer M-SEARCH sent from this host, set to False to answer
+                local control points too (only our own searches are ignored then)
+            :param notify: multicast NOTIFY ssdp:alive for the advertisements, spread over a
+                fraction of their max-age, and ssdp:byebye on join. Off by default, control points
+                must not announce the placeholder server_usn/server_uuid
+            :param passive: rely on the NOTIFY announcements of the devices, M-SEARCH is only sent
+                when a search target is added, again when nothing was heard for stale_after seconds
+                and after a device is lost, m_search_timeout is not used then
+            :param stale_after: seconds of silence after which the passive view is refreshed with
+                an M-SEARCH, default is half of the registry default max-age
+            :param snapshot: path of the registry snapshot, loaded here and saved every
+                snapshot_interval seconds and on join, see snapshot.py. The restored devices are
+                on the registry right away and their events are published on start
+            :param snapshot_interval: seconds between two snapshot saves
+            :param refresh: re-confirm the known devices nearing their expiry with an unicast
+                M-SEARCH to their address (UPnP 1.1), see scheduling.RefreshScheduler. Multicast
+                searches are then only sped up by byebyes, an expiry means the device
+                didn't answer
+            :param recorder: capture.PacketRecorder given to every socket of the daemon, to
+                replay the traffic offline with capture.Replayer
 
         Note:
             The client will NOT start sending M-SEARCH strings unless you call the method
-            add_m_search first.
+            add_m_search first. NOTIFY announcements update the registry in both modes, only
+            the ones matching a search target are kept.
+            With interfaces, M-SEARCH is sent out of every interface and answers advertise
+            the address of the interface the request arrived on. The sockets follow the
+            interfaces being added and removed.
 
         Raises:
             JoinGroupError - Socket level errors for multicast will be raised on the instantiation
             SSDPException - Wrong parameters will result on a exception
         """
-        self._search_strings = []
+        # search target -> M-SEARCH payload, replaced on change so m_search reads it lock free
+        self._search_strings = OrderedDict()
+        # Targets whose NOTIFY are kept without searching them, see watch
+        self._watched = frozenset()
+        # Selector and wake-up pair of this daemon's sockets only
+        self._selector = SocketSelector.new_key(SSDPDaemon.__name__)
         # Queue to get all responses and parse to your component
-        self.client_out_q = Queue.Queue()
+        self.client_out_q = DeliveryQueue(queue_size, overflow_policy)
         # Note the server out q will only populate if monitoring is set
-        self.server_out_q = Queue.Queue()
+        self.server_out_q = DeliveryQueue(queue_size, overflow_policy)
         self.monitoring = monitoring
+        self.raw_responses = raw_responses
+        self.ignore_local = ignore_local
+        # Devices found, keyed by USN and expired by max-age, changes go to discovery_out_q
+        self.registry = DeviceRegistry()
+        self.discovery_out_q = DeliveryQueue(queue_size, overflow_policy)
+        # Filtered consumers of registry events and raw responses, see subscribe
+        self._event_subscriptions = SubscriptionIndex()
+        self._response_subscriptions = SubscriptionIndex()
         # Flags for upnp:rootdevice and ssdp:all
         self.server_usn = server_usn
         self.server_uuid = server_uuid
+        # Everything answered to M-SEARCH, indexed by target, type and UUID
+        self.advertisements = AdvertisementRegistry()
+        if server_usn:
+            self.advertisements.add(server_usn, server_usn)
+        if server_uuid:
+            self.advertisements.add(server_uuid, server_uuid)
+            self.advertisements.add(ROOT_DEVICE, server_uuid)
+        self.notifier = NotifyScheduler(self.advertisements) if notify else None
+        self.advertisements.subscribe(self._on_advertisements_changed)
         self.user_agent = user_agent
+        # Cached local addresses and pre-rendered answers for the registered tags
+        self.interfaces = InterfaceTable.get_instance()
+        self.answers = upnp.AnswerBuilder(self.interfaces)
         self.logging = logging.getLogger(logger_name)
         # Event M-SEARCH timeout in seconds
         assert (type(m_search_timeout) in [float, int]), \
             "Invalid type periodic_search_time {}".format(m_search_timeout)
         self.task_interval = m_search_timeout
+        self.passive = passive
+        self.stale_after = stale_after or DeviceRegistry.DEFAULT_MAX_AGE / 2.0
+        # When each target is searched, searches of every target are paced together
+        if passive:
+            self.searches = SearchScheduler(None)
+        elif m_search_timeout > 0:
+            self.searches = SearchScheduler(m_search_timeout)
+        else:
+            self.searches = SearchScheduler(None, retries=0)
+        # time.time() of the last announcement or answer heard, the passive view freshness
+        self._last_heard = 0.0
+        # Unicast M-SEARCH to the devices about to expire
+        self.refresher = RefreshScheduler(self.registry) if refresh else None
+        # Warm start, events of the devices restored from the snapshot are published on start
+        self.snapshot_path = snapshot
+        self.snapshot_interval = snapshot_interval
+        # Registry generation on the snapshot file, periodic saves are skipped until it changes
+        self._saved_generation = None
+        self._saved_at = 0.0
+        self._restored = self.load_snapshot() if snapshot else []
         # Main loop
         self.__is_running = True
         self.main_loop = lambda: self.__is_running
-        # Unicast socket
-        self.client = DatagramSocket(socket_type=DatagramSocket.CLIENT,
-                                     implemented_protocol=SSDPDaemon.__class__.__name__,
-                                     logger_name=logger_name,
-                                     group=upnp.MULTICAST_GROUP,
-                                     port=upnp.MULTICAST_PORT,
-                                     ttl=upnp.MULTICAST_TTL)
-        # Multicast socket, listener only
-        self.server = DatagramSocket(socket_type=DatagramSocket.SERVER,
-                                     implemented_protocol=SSDPDaemon.__class__.__name__,
-                                     logger_name=logger_name,
-                                     group=upnp.MULTICAST_GROUP,
-                                     port=upnp.MULTICAST_PORT,
-                                     ttl=upnp.MULTICAST_TTL)
+        self._logger_name = logger_name
+        self._interface_spec = interfaces
+        self.reuse_port = reuse_port
+        self.recorder = recorder
+        self.shard = shard
+        self._register_metrics(metrics or METRICS)
+        self._links_changed = False
+        # time.time() of the next attempt to recover the links that failed, see update_links
+        self._relink_at = None
+        # One client/server pair per interface, see InterfaceLink
+        self.links = []
+        try:
+            if interfaces is None:
+                self.links.append(self._open_link(None))
+            else:
+                for address in self.interfaces.resolve(interfaces):
+                    self.links.append(self._open_link(address))
+                if not self.links:
+                    raise SSDPException('No usable interface in {}'.format(interfaces))
+        except Exception:
+            # The gauges are exclusive, don't keep the logger_name taken
+            self._remove_gauges()
+            for link in self.links:
+                link.destroy()
+            raise
+        # First link sockets, kept for the single interface API
+        self.client = self.links[0].client
+        self.server = self.links[0].server
+        self.reply_scheduler = self.links[0].scheduler
+        self.interfaces.subscribe(self.on_interfaces_changed)
         threading.Thread.__init__(self)
         self.daemon = True
         
@@ -233,20 +417,102 @@ class SSDPDaemon(threading.Thread):
         self.logging.info('ST={}'.format(self.server_usn))
         self.logging.info('UUID={}'.format(self.server_uuid))
         self.logging.info('USER_AGENT={}'.format(self.user_agent))
-        event_time = time.time()
+        last_search = last_save = time.time()
+        for event in self._restored:
+            self.publish_event(event)
         self.logging.info("UPnP server and client is running")
         while self.main_loop():
-            for sock in SocketSelector.select_protocol(SSDPDaemon.__class__.__name__):
-                if self.client.transport == sock:
-                    self.handle_client()
-                elif self.server.transport == sock:
-                    self.handle_server()
+            # Sleeps until a datagram arrives, the next timer is due or join() wakes us up
+            if self._links_changed or (self._relink_at is not None and time.time() >= self._relink_at):
+                self.update_links()
+            timeout = None
+            cost = max(1, len(self.links))
+            delays = [self.searches.next_due(cost=cost), self._next_refresh(last_search, time.time()),
+                      self.registry.next_expiry()]
+            if self.snapshot_path:
+                delays.append(max(0.0, last_save + self.snapshot_interval - time.time()))
+            if self.refresher is not None:
+                delays.append(self.refresher.next_due())
+            if self._relink_at is not None:
+                delays.append(max(0.0, self._relink_at - time.time()))
+            delays.extend(link.scheduler.next_due() for link in self.links)
+            if self.notifier is not None:
+                delays.append(self.notifier.next_due())
+            for delay in delays:
+                if delay is not None and (timeout is None or delay < timeout):
+                    timeout = delay
+            SocketSelector.dispatch(self._selector, timeout)
+            self.send_replies()
+            if self.notifier is not None:
+                self.send_notifies(self.notifier.due())
+            for event in self.registry.expire():
+                self.publish_event(event)
+            if self._next_refresh(last_search, time.time()) == 0:
+                # Every target is due now and sent as the token bucket allows, see searches.next_due
+                self.searches.refresh()
+                last_search = time.time()
             # Can be done via threading.Timer as well
             # But here we`ve a easy way to control the timer
-            if (time.time() - event_time) >= self.task_interval > 0:
+            search_targets = self.searches.due(cost=cost)
+            if search_targets:
                 self.logging.debug('sending M-SEARCH messages...')
-                self.m_search()
-                event_time = time.time()
+                self.m_search(search_targets)
+                last_search = time.time()
+            if self.refresher is not None:
+                self.refresh_devices(self.refresher.due())
+            if self.snapshot_path and time.time() - last_save >= self.snapshot_interval:
+                self.save_snapshot(changed_only=True)
+                last_save = time.time()
+
+    def load_snapshot(self):
+        """Restores the devices of the snapshot file on the registry, the expired ones are dropped
+
+        Returns:
+            List of the registry DiscoveryEvent ADDED, empty if there's no usable snapshot
+        """
+        now = time.time()
+        try:
+            entries = snapshot.load(self.snapshot_path, now)
+        except snapshot.SnapshotError as error:
+            self.logging.warning('Ignoring snapshot {}: {}'.format(self.snapshot_path, error))
+            return []
+        events = [self.registry.restore(headers, expires, now) for expires, _, headers in entries]
+        events = [event for event in events if event is not None]
+        self.logging.info('Restored {} devices from {}'.format(len(events), self.snapshot_path))
+        # The file already holds what was just restored
+        self._saved_generation = self.registry.generation
+        self._saved_at = now
+        return events
+
+    def save_snapshot(self, changed_only=False):
+        """Writes the registry to the snapshot file
+
+        Args:
+            :param changed_only: skip the write when no device was added, updated or dropped since
+                the last save, unless SNAPSHOT_REFRESH seconds went by
+
+        Returns:
+            The bytes written, 0 when skipped or None on error
+        """
+        now = time.time()
+        # Read before the entries, a change while they're copied is saved next time
+        generation = self.registry.generation
+        if changed_only and generation == self._saved_generation and now - self._saved_at < self.SNAPSHOT_REFRESH:
+            return 0
+        try:
+            written = snapshot.save(self.snapshot_path, list(self.registry), now)
+        except (IOError, OSError) as error:
+            self.logging.warning('Cannot save snapshot {}: {}'.format(self.snapshot_path, error))
+            return None
+        self._saved_generation = generation
+        self._saved_at = now
+        return written
+
+    def _next_refresh(self, last_search, now):
+        """Seconds until the passive view goes stale, None if it's not passive"""
+        if not self.passive or not self._search_strings:
+            return None
+        return max(0.0, max(self._last_heard, last_search) + self.stale_after - now)
 
     def __del__(self):
         """Destructor method
@@ -254,66 +520,490 @@ class SSDPDaemon(threading.Thread):
         Note:
             Not closing sockets may lead to a socket backlog problem on your host/embedded device
         """
-        self.client.destroy()
-        self.server.destroy()
+        for link in self.links:
+            link.destroy()
+
+    def _open_link(self, address):
+        """Creates the client/server sockets of an interface
+
+        Args:
+            :param address: local IPv4 address of the interface, None for INADDR_ANY
 
-    def handle_server(self):
+        Returns:
+            InterfaceLink
+        """
+        # Delays and rate limits the answers to M-SEARCH
+        link = InterfaceLink(address, ResponseScheduler(latency=self._reply_latency))
+        # Unicast socket
+        link.client = DatagramSocket(socket_type=DatagramSocket.CLIENT,
+                                     implemented_protocol=SSDPDaemon.__name__,
+                                     logger_name=self._logger_name,
+                                     group=upnp.MULTICAST_GROUP,
+                                     port=upnp.MULTICAST_PORT,
+                                     ttl=upnp.MULTICAST_TTL,
+                                     handler=functools.partial(self.handle_client, link),
+                                     interface=address,
+                                     selector=self._selector,
+                                     metrics=self.metrics,
+                                     recorder=self.recorder)
+        # Multicast socket, listener only
+        try:
+            link.server = DatagramSocket(socket_type=DatagramSocket.SERVER,
+                                         implemented_protocol=SSDPDaemon.__name__,
+                                         logger_name=self._logger_name,
+                                         group=upnp.MULTICAST_GROUP,
+                                         port=upnp.MULTICAST_PORT,
+                                         ttl=upnp.MULTICAST_TTL,
+                                         handler=functools.partial(self.handle_server, link),
+                                         interface=address,
+                                         reuse_port=self.reuse_port,
+                                         selector=self._selector,
+                                         metrics=self.metrics,
+                                         recorder=self.recorder)
+        except Exception:
+            link.client.destroy()
+            raise
+        return link
+
+    def _register_metrics(self, metrics):
+        """Creates the daemon metrics, queue depths are gauges only read on snapshots"""
+        self.metrics = metrics
+        name = self._logger_name
+        self._parse_time = metrics.histogram('snf_ssdp_parse_seconds', 'upnp.parse_message time per datagram',
+                                             daemon=name)
+        self._server_time = metrics.histogram('snf_ssdp_handler_seconds', 'Time spent per handler wake-up',
+                                              daemon=name, handler='server')
+        self._client_time = metrics.histogram('snf_ssdp_handler_seconds', 'Time spent per handler wake-up',
+                                              daemon=name, handler='client')
+        self._server_invalid = metrics.counter('snf_ssdp_parse_failures_total', 'Datagrams that are not SSDP',
+                                               daemon=name, socket='server')
+        self._client_invalid = metrics.counter('snf_ssdp_parse_failures_total', 'Datagrams that are not SSDP',
+                                               daemon=name, socket='client')
+        self._notifies = dict((nts, metrics.counter('snf_ssdp_notify_total', 'NOTIFY announcements applied to '
+                                                    'the registry', daemon=name, nts=nts))
+                              for nts in (upnp.ALIVE, upnp.BYEBYE, upnp.UPDATE))
+        self._unicast_refresh = metrics.counter('snf_ssdp_unicast_refresh_total', 'Unicast M-SEARCH sent to '
+                                                'known devices', daemon=name)
+        self._searches_sent = metrics.counter('snf_ssdp_m_search_rounds_total', 'M-SEARCH rounds sent', daemon=name)
+        self._reply_latency = metrics.histogram('snf_ssdp_reply_latency_seconds',
+                                                'Time between an M-SEARCH and its answers, MX delay included',
+                                                daemon=name)
+        self._gauges = []
+        try:
+            for queue_name in ('client_out_q', 'server_out_q', 'discovery_out_q'):
+                queue = getattr(self, queue_name)
+                self._gauge('snf_queue_depth', queue.qsize, 'Items waiting on an output queue', queue=queue_name)
+                self._gauge('snf_queue_dropped', lambda queue=queue: queue.dropped,
+                            'Items discarded by the queue overflow policy', queue=queue_name)
+            self._gauge('snf_ssdp_pending_replies', lambda: sum(len(link.scheduler) for link in self.links),
+                        'Answers waiting for their MX delay')
+            self._gauge('snf_ssdp_devices', lambda: len(self.registry), 'Devices on the registry')
+        except ValueError as error:
+            # Another live daemon with the same logger_name owns them, replacing their callables
+            # would report this daemon instead and our join would remove them
+            self._remove_gauges()
+            self.logging.warning('Gauges not registered, use a unique logger_name: {}'.format(error))
+
+    def _gauge(self, name, function, help_text, **labels):
+        labels['daemon'] = self._logger_name
+        self.metrics.gauge(name, function, help_text, exclusive=True, **labels)
+        self._gauges.append((name, labels))
+
+    def _remove_gauges(self):
+        # Gauges hold references to this daemon
+        for name, labels in self._gauges:
+            self.metrics.remove(name, **labels)
+        self._gauges = []
+
+    def update_links(self):
+        """Opens and closes the interface sockets to match the current local addresses
+
+        Called from the daemon thread when networking.InterfaceTable reports a change, and
+        again every RELINK_RETRY seconds while a link can't join the group.
+        """
+        self._links_changed = False
+        self._relink_at = None
+        if self._interface_spec is None:
+            # Single INADDR_ANY pair, only the membership is renewed
+            self.logging.info('Local addresses changed, re-joining {}'.format(upnp.MULTICAST_GROUP))
+            self._recover_link(self.links[0])
+            return
+        wanted = self.interfaces.resolve(self._interface_spec)
+        links = []
+        for link in self.links:
+            if link.address in wanted:
+                # The membership is lost when the interface goes down
+                self._recover_link(link)
+                links.append(link)
+            else:
+                self.logging.info('Interface {} is gone, closing its sockets'.format(link.address))
+                link.destroy()
+        known = set(link.address for link in links)
+        for address in wanted:
+            if address not in known:
+                self.logging.info('Joining {} on {}'.format(upnp.MULTICAST_GROUP, address))
+                try:
+                    links.append(self._open_link(address))
+                except (NetworkConfigurationError, JoinGroupError, MulticastException) as error:
+                    self.logging.error('Cannot open the sockets of {}, retrying in {}s: {}'
+                                       .format(address, self.RELINK_RETRY, error))
+                    self._relink_at = time.time() + self.RELINK_RETRY
+        self.links = links
+        if links:
+            self.client, self.server, self.reply_scheduler = links[0].client, links[0].server, links[0].scheduler
+
+    def _recover_link(self, link):
+        """Renews the group membership of a link, reopening its listener if a join failed before"""
+        try:
+            link.server.recover()
+        except (NetworkConfigurationError, JoinGroupError, MulticastException) as error:
+            self.logging.error('Cannot join {} on {}, retrying in {}s: {}'
+                               .format(upnp.MULTICAST_GROUP, link.address or 'INADDR_ANY', self.RELINK_RETRY, error))
+            self._relink_at = time.time() + self.RELINK_RETRY
+            return False
+        return True
+
+    def handle_server(self, link=None):
         """Handles multicasts messages on the group
 
-        This will simply reply when receives the registered tag, ssdp:all and upnp:rootdevice
+        Drains every datagram queued on the listener in a single wake-up,
+        see handle_search for the reply rules.
+
+        Args:
+            :param link: InterfaceLink the messages arrived on, default is the first one
+        """
+        link = link or self.links[0]
+        started = clock()
+        try:
+            packages = link.server.recv_batch()
+        except UnicastException:
+            return
+        shard = self.shard
+        parse_time = self._parse_time
+        for package in packages:
+            if shard is not None and shard_of(package.host, shard[1]) != shard[0]:
+                # Multicast is copied to every SO_REUSEPORT socket, a sibling handles it
+                continue
+            parsing = clock()
+            message = upnp.parse_message(package)
+            parse_time.observe(clock() - parsing)
+            if message is None:
+                self._server_invalid.value += 1
+                if self.monitoring:
+                    # Not SSDP, still handed over as the legacy parse output
+                    self.server_out_q.put(upnp.parse(package))
+                continue
+            if message.method == 'NOTIFY':
+                self.handle_notify(message)
+                continue
+            replies = self.handle_search(message, link.address)
+            if replies:
+                # Answered at a random time within MX, see scheduling.ResponseScheduler
+                link.scheduler.schedule((message.host, message.port), message.get('st'),
+                                        replies, message.get('mx'))
+        self._server_time.observe(clock() - started)
+
+    def send_replies(self):
+        """Sends every scheduled answer whose delay elapsed, out of the interface it was asked on"""
+        for link in self.links:
+            replies = link.scheduler.due()
+            if replies:
+                try:
+                    link.client.send_batch(replies)
+                except MulticastException:
+                    pass
+
+    def send_notifies(self, notifications):
+        """Multicasts NOTIFY messages out of every interface
+
+        Args:
+            :param notifications: list of (nts, Advertisement), see NotifyScheduler.due
         """
-        msg = ''
-        payload = self.server.recv_dgram()
-        payload = upnp.parse(payload)
-        self.logging.debug('Parsed payload:\n{}'.format(payload))
-        if self.monitoring:
-            self.server_out_q.put_nowait(payload)
-        self.logging.debug('get_host_address()->{}-{}'.format(get_host_address(), payload['sender'][0]))
-        if payload['sender'][0] != get_host_address():
+        if not notifications:
+            return
+        group = (upnp.MULTICAST_GROUP, upnp.MULTICAST_PORT)
+        render = self.answers.render_notify
+        for link in self.links:
             try:
-                upnp.is_valid_search_target(payload['st'])
-            except SSDPException:
+                messages = [(render(nts, advertisement.target, advertisement.usn, link.address,
+                                    advertisement.location, advertisement.max_age), group)
+                            for nts, advertisement in notifications]
+                link.client.send_batch(messages)
+            except (MulticastException, NetworkConfigurationError) as error:
+                self.logging.debug('NOTIFY not sent out of {}: {}'.format(link.address, error))
+
+    def _on_advertisements_changed(self, advertisements):
+        """AdvertisementRegistry subscriber, new advertisements are announced without waiting"""
+        if self.notifier is not None:
+            SocketSelector.wakeup(self._selector)
+
+    def handle_search(self, message, address=None):
+        """Handles a parsed multicast message
+
+        Replies for every advertisement matching the search target, see AdvertisementRegistry.match
+
+        Args:
+            :param message: upnp.SSDPMessage returned by upnp.parse_message
+            :param address: local address advertised on LOCATION, default is the default route one
+
+        Returns:
+            List of (answer, sender) pairs to be unicasted, see DatagramSocket.send_batch
+        """
+        replies = []
+        debug = self.logging.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logging.debug('Parsed payload:\n{}'.format(message.to_dict()))
+        if self.monitoring:
+            self.server_out_q.put(message.to_dict())
+        if debug:
+            self.logging.debug('local addresses->{}-{}'.format(sorted(self.interfaces.addresses), message.host))
+        if not self.is_own_message(message):
+            search_target = message.get('st')
+            if message.method != 'M-SEARCH' or not upnp.is_valid_search_target(search_target or ''):
                 # Invalid flag will be log as a warning
                 self.logging.warning('Detected a message out of standard from: {}:{}'
-                                     .format(payload['sender'][0], payload['sender'][1]))
+                                     .format(message.host, message.port))
             else:
-                if payload['st'] == self.server_usn or payload['st'] == 'ssdp:all':
-                    self.client.send_unicast(upnp.answer('device', payload['st'], self.server_usn),
-                                             *payload['sender'])
-                elif payload['st'] == self.server_uuid or payload['st'] == 'upnp:rootdevice':
-                    self.client.send_unicast(upnp.answer('device', payload['st'], self.server_uuid),
-                                             *payload['sender'])
-
-    def handle_client(self):
-        """Handles unicast received from a UPnP service/device"""
+                sender = (message.host, message.port)
+                render = self.answers.render
+                try:
+                    for target, advertisement in self.advertisements.match(search_target):
+                        replies.append((render(target, advertisement.usn, address, advertisement.location,
+                                               advertisement.max_age), sender))
+                except NetworkConfigurationError as error:
+                    # INADDR_ANY link on a host without default route, nothing to advertise
+                    self.logging.warning('Cannot answer {}:{}: {}'.format(message.host, message.port, error))
+        return replies
+
+    def handle_notify(self, message):
+        """Applies a NOTIFY announcement to the registry
+
+        ssdp:alive and ssdp:update add or refresh the device, ssdp:byebye removes it. Only
+        the notification types a registered search target asks for are kept.
+
+        Args:
+            :param message: upnp.SSDPMessage returned by upnp.parse_message
+
+        Returns:
+            True if the registry was updated
+        """
+        if self.monitoring:
+            self.server_out_q.put(message.to_dict())
+        nts = message.get('nts')
+        usn = message.get('usn')
+        notification_type = message.get('nt')
+        if not usn or not notification_type or nts not in self._notifies or self.is_own_message(message) or \
+                not self.is_wanted(notification_type):
+            return False
+        self._notifies[nts].value += 1
+        self._last_heard = time.time()
+        if nts == upnp.BYEBYE:
+            event = self.registry.remove(usn)
+        else:
+            event = self.registry.update(message)
+        if event is not None:
+            self.publish_event(event)
+        return True
+
+    def is_wanted(self, notification_type):
+        """True if a registered search target asks for this NT
+
+        ssdp:all takes everything, an URN search the same type with an equal or higher
+        version and the other targets the exact NT.
+        """
+        search_strings = self._search_strings
+        watched = self._watched
+        if 'ssdp:all' in search_strings or notification_type in search_strings or \
+                'ssdp:all' in watched or notification_type in watched:
+            return True
+        return any(search_matches(search_target, notification_type)
+                   for search_target in itertools.chain(search_strings, watched))
+
+    def is_own_message(self, message):
+        """True for a message sent by this host, or only by this daemon if ignore_local is False"""
+        if not self.interfaces.is_local(message.host):
+            return False
+        if self.ignore_local:
+            return True
+        for link in self.links:
+            try:
+                if link.client.transport.getsockname()[1] == message.port:
+                    return True
+            except (AttributeError, socket.error):
+                continue
+        return False
+
+    def handle_client(self, link=None):
+        """Handles unicast received from a UPnP service/device
+
+        Drains every response queued on the client socket in a single wake-up.
+
+        Args:
+            :param link: InterfaceLink the responses arrived on, default is the first one
+        """
+        link = link or self.links[0]
+        started = clock()
         try:
-            payload = self.client.recv_dgram()
-            payload = upnp.parse(payload)
-            if len(payload.keys()) > 1:
-                self.client_out_q.put_nowait(payload)
+            packages = link.client.recv_batch()
+        except UnicastException:
+            return
+        parse_time = self._parse_time
+        for package in packages:
+            parsing = clock()
+            message = upnp.parse_message(package)
+            parse_time.observe(clock() - parsing)
+            if message is None:
+                self._client_invalid.value += 1
+            if message is not None and len(message):
+                self._last_heard = time.time()
+                event = self.registry.update(message)
+                if event is not None:
+                    self.publish_event(event)
+                if self.raw_responses or self._response_subscriptions:
+                    payload = message.to_dict()
+                    if self.raw_responses:
+                        self.client_out_q.put(payload)
+                    self._response_subscriptions.publish(payload.get('st'), payload)
             # Will add any sort of network response on this group
             elif self.monitoring:
-                self.client_out_q.put_nowait(payload)
-        except UnicastException:
-            pass
+                self.client_out_q.put(upnp.parse(package))
+        self._client_time.observe(clock() - started)
+
+    def stats(self):
+        """Snapshot of the daemon counters, answers are summed over the interfaces"""
+        replies = {}
+        for link in self.links:
+            for name, value in link.scheduler.stats().items():
+                replies[name] = replies.get(name, 0) + value
+        return {'devices': len(self.registry), 'interfaces': len(self.links), 'replies': replies,
+                'notify': dict(self.notifier.sent) if self.notifier is not None else {},
+                'search': self.searches.stats(), 'restored': len(self._restored),
+                'refresh': self.refresher.stats() if self.refresher is not None else {},
+                'client_out_q': self.client_out_q.stats(), 'server_out_q': self.server_out_q.stats(),
+                'discovery_out_q': self.discovery_out_q.stats()}
+
+    def subscribe(self, pattern=None, predicate=None, deltas=True, maxsize=1024, policy=DROP_OLDEST, queue=None):
+        """Registers a consumer interested only on some search targets
+
+        Args:
+            :param pattern: ST to match, exact or a prefix ending with ':*' i.e.
+                'urn:schemas-upnp-org:device:*', None matches everything
+            :param predicate: optional callable(item) returning True for the wanted items
+            :param deltas: True for registry DiscoveryEvents, False for every raw response dict
+            :param maxsize: max pending items on the subscription queue
+            :param policy: overflow policy of the subscription queue, see delivery.DeliveryQueue
+            :param queue: deliver to this queue instead, i.e. description.DescriptionFetcher.requests
+
+        Returns:
+            delivery.Subscription, read the items with subscription.get()
+        """
+        index = self._event_subscriptions if deltas else self._response_subscriptions
+        return index.subscribe(pattern, predicate, maxsize, policy, queue)
+
+    def unsubscribe(self, subscription):
+        """Removes a subscription created with subscribe"""
+        self._event_subscriptions.unsubscribe(subscription)
+        self._response_subscriptions.unsubscribe(subscription)
+
+    def publish_event(self, event):
+        """Delivers a registry DiscoveryEvent to discovery_out_q and the interested subscriptions"""
+        self.discovery_out_q.put(event)
+        self._event_subscriptions.publish(event.entry.st, event)
+        # Arrivals and departures speed the searches of the target up, see scheduling.SearchScheduler
+        if event.action == DeviceRegistry.UPDATED:
+            return
+        lost = event.action == DeviceRegistry.REMOVED or \
+            (event.action == DeviceRegistry.EXPIRED and self.refresher is None)
+        self.searches.observe(event.entry.st, lost)
+
+    def on_interfaces_changed(self, interfaces):
+        """InterfaceTable subscriber, renews the group membership for the new addresses"""
+        # Sockets are opened, re-joined and closed by the daemon thread, see update_links
+        self._links_changed = True
+        SocketSelector.wakeup(self._selector)
+
+    def refresh_devices(self, entries):
+        """Sends an unicast M-SEARCH for each registry entry, their answer refreshes them
+
+        The search goes to the LOCATION address, on the SEARCHPORT.UPNP.ORG port if the device
+        announced one, from the interface with the closest address. Entries without an IPv4
+        LOCATION are skipped.
+
+        Args:
+            :param entries: list of registry.DeviceEntry, see scheduling.RefreshScheduler.due
+        """
+        batches = {}
+        for entry in entries:
+            try:
+                host = urlsplit(entry.location or '').hostname
+                packed = socket.inet_aton(host)
+            except (TypeError, ValueError, socket.error):
+                continue
+            try:
+                port = int(entry.headers.get('searchport.upnp.org') or upnp.MULTICAST_PORT)
+            except ValueError:
+                port = upnp.MULTICAST_PORT
+            payload = upnp.m_search_unicast(entry.st, host, port, self.user_agent)
+            if payload:
+                batches.setdefault(self._link_for(packed), []).append((payload, (host, port)))
+        for link, messages in batches.items():
+            self._unicast_refresh.value += len(messages)
+            try:
+                link.client.send_batch(messages)
+            except MulticastException:
+                pass
+
+    def _link_for(self, packed):
+        """Link whose address shares the longest prefix with a packed IPv4 address"""
+        if len(self.links) == 1:
+            return self.links[0]
+        address, = struct.unpack('!I', packed)
 
-    def m_search(self):
-        """Sends m-search strings registered on search strings"""
+        def distance(link):
+            try:
+                return struct.unpack('!I', socket.inet_aton(link.address))[0] ^ address
+            except (TypeError, socket.error):
+                return 0xffffffff
+        return min(self.links, key=distance)
+
+    def m_search(self, search_targets=None):
+        """Sends m-search strings registered on search strings in a single batch per interface
+
+        Args:
+            :param search_targets: only search these registered targets, default is all of them
+        """
         # avoid atomic operation problems on remove_m_search method
         search_strings = self._search_strings
-        for payload in search_strings:
+        group = (upnp.MULTICAST_GROUP, upnp.MULTICAST_PORT)
+        if search_targets is None:
+            messages = [(payload, group) for payload in search_strings.values()]
+        else:
+            messages = [(search_strings[target], group) for target in search_targets if target in search_strings]
+        if not messages:
+            return
+        self._searches_sent.value += 1
+        for link in self.links:
             try:
-                self.client.send_multicast(payload)
-                self.logging.debug('Sending M-SEARCH: \n{}'.format(payload))
+                link.client.send_batch(messages)
             except MulticastException:
                 pass
 
     def join(self, timeout=None):
         """Wrapper of threading.Thread.join method"""
         self.__is_running = False
+        self.interfaces.unsubscribe(self.on_interfaces_changed)
+        self.answers.close()
+        self._remove_gauges()
+        SocketSelector.wakeup(self._selector)
         threading.Thread.join(self, timeout=timeout)
+        self.advertisements.unsubscribe(self._on_advertisements_changed)
+        if self.notifier is not None:
+            self.send_notifies(self.notifier.goodbye())
+        if self.snapshot_path:
+            self.save_snapshot()
         self.logging.info("SSDP Daemon stopped")
-        self.client.destroy()
-        self.server.destroy()
+        for link in self.links:
+            link.destroy()
+        SocketSelector.release(self._selector)
         # Call destructor
         del self
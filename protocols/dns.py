@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""DNS wire format codec, as used by mDNS/DNS-SD
+    - https://tools.ietf.org/html/rfc1035
+    - https://tools.ietf.org/html/rfc6762 (mDNS)
+    - https://tools.ietf.org/html/rfc6763 (DNS-SD)
+
+Names are text with a trailing dot, i.e. 'Printer._ipp._tcp.local.', they're compressed
+on encoding and compared case insensitively (see DNSRecord.key). Dots and backslashes
+inside a label are escaped as '\\.' and '\\\\', i.e. the DNS-SD instance 'Printer v1.2'
+is 'Printer v1\\.2._ipp._tcp.local.' (RFC 6763 4.3), see escape_label. Labels that aren't
+UTF-8 keep their bytes (surrogate escapes on Python 3), so a decoded name encodes back
+to the same wire labels.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import socket
+import struct
+from .networking import ProtocolError
+
+# Record types
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_SRV = 33
+TYPE_NSEC = 47
+TYPE_ANY = 255
+CLASS_IN = 1
+# Top bit of the class, cache-flush on records and unicast-response on questions
+CLASS_UNIQUE = 0x8000
+CLASS_MASK = 0x7fff
+# Header flags
+FLAG_RESPONSE = 0x8000
+FLAG_AUTHORITATIVE = 0x0400
+FLAG_TRUNCATED = 0x0200
+
+MAX_NAME_LENGTH = 255
+MAX_LABEL_LENGTH = 63
+# Pointers followed while decoding a single name
+MAX_POINTERS = 32
+
+_HEADER = struct.Struct('!HHHHHH')
+_QUESTION = struct.Struct('!HH')
+_RECORD = struct.Struct('!HHLH')
+_SRV = struct.Struct('!HHH')
+_SHORT = struct.Struct('!H')
+
+
+class DNSError(ProtocolError):
+    """Malformed DNS message"""
+    pass
+
+
+def _lower(name):
+    return name.lower()
+
+
+if bytes is str:
+    def _label_text(raw):
+        return raw
+
+    def _label_bytes(label):
+        return label.encode('utf-8') if not isinstance(label, bytes) else label
+else:
+    def _label_text(raw):
+        return raw.decode('utf-8', 'surrogateescape')
+
+    def _label_bytes(label):
+        return label.encode('utf-8', 'surrogateescape')
+
+
+class DNSQuestion(object):
+    """Question section entry
+
+    Attributes:
+        name - queried name
+        rtype - queried type, i.e. TYPE_PTR
+        rclass - class without the unicast-response bit
+        unicast - QU question, the querier asks for an unicast response
+    """
+
+    __slots__ = ('name', 'rtype', 'rclass', 'unicast')
+
+    def __init__(self, name, rtype, rclass=CLASS_IN, unicast=False):
+        self.name = name
+        self.rtype = rtype
+        self.rclass = rclass
+        self.unicast = unicast
+
+    @property
+    def key(self):
+        return _lower(self.name), self.rtype, self.rclass
+
+    def __eq__(self, other):
+        return isinstance(other, DNSQuestion) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return '<DNSQuestion {} type {}{}>'.format(self.name, self.rtype, ' QU' if self.unicast else '')
+
+    def answered_by(self, record):
+        """True if the record answers this question"""
+        return (self.rtype in (record.rtype, TYPE_ANY) and self.rclass == record.rclass and
+                _lower(self.name) == _lower(record.name))
+
+
+class DNSRecord(object):
+    """Resource record
+
+    Attributes:
+        name - owner name
+        rtype - record type
+        rclass - class without the cache-flush bit
+        ttl - seconds, 0 on goodbye packets
+        rdata - parsed data:
+            A/AAAA - address text
+            PTR - target name
+            SRV - (priority, weight, port, target name)
+            TXT - tuple of bytes strings
+            others - raw bytes
+        cache_flush - unique record, older cached copies must be flushed
+    """
+
+    __slots__ = ('name', 'rtype', 'rclass', 'ttl', 'rdata', 'cache_flush')
+
+    def __init__(self, name, rtype, rdata, ttl=120, rclass=CLASS_IN, cache_flush=False):
+        self.name = name
+        self.rtype = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        self.rdata = rdata
+        self.cache_flush = cache_flush
+
+    @property
+    def key(self):
+        """Identity of the record, the TTL isn't part of it"""
+        rdata = self.rdata
+        if self.rtype == TYPE_PTR:
+            rdata = _lower(rdata)
+        elif self.rtype == TYPE_SRV:
+            rdata = rdata[:3] + (_lower(rdata[3]),)
+        return _lower(self.name), self.rtype, self.rclass, rdata
+
+    def __eq__(self, other):
+        return isinstance(other, DNSRecord) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return '<DNSRecord {} type {} ttl {} {!r}>'.format(self.name, self.rtype, self.ttl, self.rdata)
+
+
+class DNSMessage(object):
+    """DNS message, mDNS queries and responses
+
+    Attributes:
+        id - transaction id, 0 on multicast
+        flags - header flags, see FLAG_RESPONSE
+        questions, answers, authorities, additionals - lists of DNSQuestion/DNSRecord
+    """
+
+    __slots__ = ('id', 'flags', 'questions', 'answers', 'authorities', 'additionals')
+
+    def __init__(self, flags=0, questions=None, answers=None, authorities=None, additionals=None, id=0):
+        self.id = id
+        self.flags = flags
+        self.questions = questions or []
+        self.answers = answers or []
+        self.authorities = authorities or []
+        self.additionals = additionals or []
+
+    @property
+    def is_response(self):
+        return bool(self.flags & FLAG_RESPONSE)
+
+    @property
+    def truncated(self):
+        return bool(self.flags & FLAG_TRUNCATED)
+
+    def __repr__(self):
+        return '<DNSMessage {} q={} an={} ns={} ar={}>'.format(
+            'response' if self.is_response else 'query', len(self.questions), len(self.answers),
+            len(self.authorities), len(self.additionals))
+
+
+def txt_to_dict(strings):
+    """TXT strings to a dict as described by DNS-SD, 'key=value' or a boolean 'key'"""
+    data = {}
+    for item in strings:
+        key, equal, value = item.partition(b'=')
+        key = key.decode('ascii', 'replace').lower()
+        if key and key not in data:
+            data[key] = value if equal else True
+    return data
+
+
+def dict_to_txt(data):
+    """Dict to TXT strings, True values become boolean attributes"""
+    strings = []
+    for key, value in sorted(data.items()):
+        key = key.encode('ascii') if not isinstance(key, bytes) else key
+        if value is True:
+            strings.append(key)
+        else:
+            value = value if isinstance(value, bytes) else str(value).encode('utf-8')
+            strings.append(key + b'=' + value)
+    return tuple(strings) or (b'',)
+
+
+def escape_label(label):
+    """Escapes the dots and backslashes of a label, i.e. a DNS-SD instance, to put it in a name"""
+    return label.replace('\\', '\\\\').replace('.', '\\.')
+
+
+def split_name(name):
+    """Unescaped labels of a name, 'Printer v1\\.2._ipp._tcp.local.' gives
+    ['Printer v1.2', '_ipp', '_tcp', 'local']
+    """
+    if '\\' not in name:
+        name = name.rstrip('.')
+        return name.split('.') if name else []
+    labels = []
+    label = []
+    escaped = False
+    for char in name:
+        if escaped:
+            label.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '.':
+            labels.append(''.join(label))
+            label = []
+        else:
+            label.append(char)
+    if label:
+        labels.append(''.join(label))
+    return labels
+
+
+class _Writer(object):
+    """Message encoder with name compression"""
+
+    __slots__ = ('buffer', 'names')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # lower case name suffix -> offset
+        self.names = {}
+
+    def name(self, name):
+        labels = split_name(name)
+        buffer = self.buffer
+        for index in range(len(labels)):
+            suffix = '.'.join(escape_label(label) for label in labels[index:]).lower()
+            pointer = self.names.get(suffix)
+            if pointer is not None:
+                buffer += _SHORT.pack(0xc000 | pointer)
+                return
+            if len(buffer) < 0x3fff:
+                self.names[suffix] = len(buffer)
+            label = _label_bytes(labels[index])
+            if not label or len(label) > MAX_LABEL_LENGTH:
+                raise DNSError('Invalid label on {}'.format(name))
+            buffer.append(len(label))
+            buffer += label
+        buffer.append(0)
+
+    def question(self, question):
+        self.name(question.name)
+        self.buffer += _QUESTION.pack(question.rtype, question.rclass | (CLASS_UNIQUE if question.unicast else 0))
+
+    def record(self, record):
+        self.name(record.name)
+        rclass = record.rclass | (CLASS_UNIQUE if record.cache_flush else 0)
+        buffer = self.buffer
+        start = len(buffer)
+        buffer += _RECORD.pack(record.rtype, rclass, record.ttl, 0)
+        data_start = len(buffer)
+        rtype, rdata = record.rtype, record.rdata
+        if rtype == TYPE_A:
+            buffer += socket.inet_aton(rdata)
+        elif rtype == TYPE_AAAA:
+            buffer += socket.inet_pton(socket.AF_INET6, rdata)
+        elif rtype == TYPE_PTR:
+            self.name(rdata)
+        elif rtype == TYPE_SRV:
+            buffer += _SRV.pack(*rdata[:3])
+            self.name(rdata[3])
+        elif rtype == TYPE_TXT:
+            for item in rdata:
+                if len(item) > 255:
+                    raise DNSError('TXT string longer than 255 bytes')
+                buffer.append(len(item))
+                buffer += item
+        else:
+            buffer += rdata
+        struct.pack_into('!H', buffer, start + 8, len(buffer) - data_start)
+
+
+def encode(message):
+    """DNSMessage to bytes
+
+    Raises:
+        DNSError - invalid names or record data
+    """
+    writer = _Writer()
+    writer.buffer += _HEADER.pack(message.id, message.flags, len(message.questions), len(message.answers),
+                                  len(message.authorities), len(message.additionals))
+    try:
+        for question in message.questions:
+            writer.question(question)
+        for section in (message.answers, message.authorities, message.additionals):
+            for record in section:
+                writer.record(record)
+    except (socket.error, struct.error, TypeError, ValueError, AttributeError, UnicodeError) as error:
+        raise DNSError('Cannot encode {}: {}'.format(message, error))
+    return bytes(writer.buffer)
+
+
+def _read_name(data, offset):
+    """Returns (name, offset after the name)"""
+    labels = []
+    end = None
+    jumps = 0
+    length = 0
+    size = len(data)
+    while True:
+        if offset >= size:
+            raise DNSError('Name out of bounds')
+        count = data[offset]
+        if count == 0:
+            offset += 1
+            break
+        if count & 0xc0 == 0xc0:
+            if offset + 1 >= size:
+                raise DNSError('Pointer out of bounds')
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > MAX_POINTERS:
+                raise DNSError('Compression loop')
+            offset = ((count & 0x3f) << 8) | data[offset + 1]
+            continue
+        if count & 0xc0:
+            raise DNSError('Unsupported label type')
+        offset += 1
+        label = data[offset:offset + count]
+        if len(label) != count:
+            raise DNSError('Label out of bounds')
+        length += count + 1
+        if length > MAX_NAME_LENGTH:
+            raise DNSError('Name too long')
+        labels.append(escape_label(_label_text(bytes(label))))
+        offset += count
+    return '.'.join(labels) + '.', end if end is not None else offset
+
+
+def _read_record(data, offset):
+    name, offset = _read_name(data, offset)
+    try:
+        rtype, rclass, ttl, length = _RECORD.unpack_from(data, offset)
+    except struct.error:
+        raise DNSError('Record header out of bounds')
+    offset += _RECORD.size
+    end = offset + length
+    if end > len(data):
+        raise DNSError('Record data out of bounds')
+    if rtype == TYPE_A and length == 4:
+        rdata = socket.inet_ntoa(bytes(data[offset:end]))
+    elif rtype == TYPE_AAAA and length == 16:
+        rdata = socket.inet_ntop(socket.AF_INET6, bytes(data[offset:end]))
+    elif rtype == TYPE_PTR:
+        rdata = _read_name(data, offset)[0]
+    elif rtype == TYPE_SRV and length >= 7:
+        rdata = _SRV.unpack_from(data, offset) + (_read_name(data, offset + 6)[0],)
+    elif rtype == TYPE_TXT:
+        strings = []
+        position = offset
+        while position < end:
+            count = data[position]
+            strings.append(bytes(data[position + 1:position + 1 + count]))
+            position += 1 + count
+        if position != end:
+            raise DNSError('TXT string out of bounds')
+        rdata = tuple(strings)
+    else:
+        rdata = bytes(data[offset:end])
+    return DNSRecord(name, rtype, rdata, ttl, rclass & CLASS_MASK, bool(rclass & CLASS_UNIQUE)), end
+
+
+def decode(data):
+    """Bytes to DNSMessage
+
+    Raises:
+        DNSError - malformed message, nothing partially decoded is returned
+    """
+    data = bytearray(data)
+    try:
+        ident, flags, questions, answers, authorities, additionals = _HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise DNSError('Message shorter than the header')
+    message = DNSMessage(flags, id=ident)
+    offset = _HEADER.size
+    for _ in range(questions):
+        name, offset = _read_name(data, offset)
+        try:
+            rtype, rclass = _QUESTION.unpack_from(data, offset)
+        except struct.error:
+            raise DNSError('Question out of bounds')
+        offset += _QUESTION.size
+        message.questions.append(DNSQuestion(name, rtype, rclass & CLASS_MASK, bool(rclass & CLASS_UNIQUE)))
+    for count, section in ((answers, message.answers), (authorities, message.authorities),
+                           (additionals, message.additionals)):
+        for _ in range(count):
+            record, offset = _read_record(data, offset)
+            section.append(record)
+    return message
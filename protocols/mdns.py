@@ -0,0 +1,739 @@
+# -*- coding: utf-8 -*-
+"""Multicast DNS / DNS Service Discovery querier and responder
+    - https://tools.ietf.org/html/rfc6762
+    - https://tools.ietf.org/html/rfc6763
+
+Implements the traffic reducers of RFC 6762, so the queries on the link don't grow
+with the number of services:
+    - exponential back-off of continuous queries (5.2)
+    - known-answer suppression, split over truncated packets when needed (7.1, 7.2)
+    - duplicate question suppression (7.3)
+    - duplicate answer suppression and per record multicast rate limit (7.4, 6)
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import heapq
+import random
+import socket
+import logging
+import itertools
+import threading
+from collections import namedtuple, deque
+from . import dns
+from .registry import DeviceRegistry, DiscoveryEvent
+from .delivery import DeliveryQueue, DROP_OLDEST
+from .metrics import METRICS
+from .networking import DatagramSocket, SocketSelector, InterfaceTable, MulticastException, \
+    UnicastException, JoinGroupError, NetworkConfigurationError
+
+MULTICAST_GROUP = '224.0.0.251'
+MULTICAST_PORT = 5353
+MULTICAST_TTL = 255
+# Largest mDNS message we receive, and the payload we try to fit our messages in
+MAX_MESSAGE_SIZE = 9000
+MAX_PACKET_SIZE = 1460
+# Record TTLs recommended by RFC 6762 10, host name related ones and the others
+HOST_TTL = 120
+OTHER_TTL = 4500
+# Legacy unicast answers have their TTL capped, RFC 6762 6.7
+LEGACY_TTL = 10
+# Query schedule, RFC 6762 5.2
+FIRST_QUERY_DELAY = (0.02, 0.12)
+MIN_QUERY_INTERVAL = 1.0
+MAX_QUERY_INTERVAL = 3600.0
+# Shared record answers are delayed, RFC 6762 6
+RESPONSE_DELAY = (0.02, 0.12)
+# Wait for the rest of the known answers of a truncated query, RFC 6762 7.2
+TRUNCATED_DELAY = (0.4, 0.5)
+# A record isn't multicast again within this many seconds, RFC 6762 6
+MULTICAST_INTERVAL = 1.0
+# Unsolicited announcements of new services, RFC 6762 8.3
+ANNOUNCEMENTS = 2
+ANNOUNCE_INTERVAL = 1.0
+# Seconds between two attempts to join the group again after a failure
+REJOIN_RETRY = 10.0
+SERVICES = '_services._dns-sd._udp.local.'
+
+# service_info resolved from the cache, see MDNSDaemon.services
+ServiceInfo = namedtuple('service_info', ('name', 'type', 'host', 'port', 'addresses', 'txt'))
+
+
+class CachedRecord(object):
+    """A record on the RecordCache
+
+    Attributes:
+        record - dns.DNSRecord as received, record.ttl is the original TTL
+        received - time.time() of the last copy received
+        expires - time.time() based expiry
+    """
+
+    __slots__ = ('record', 'received', 'expires')
+
+    def __init__(self, record, received):
+        self.record = record
+        self.received = received
+        self.expires = received + record.ttl
+
+    def remaining(self, now):
+        return self.expires - now
+
+
+class RecordCache(object):
+    """TTL expiring cache of the records seen on the link
+
+    Records are keyed by dns.DNSRecord.key (the TTL is not part of it) and indexed by
+    name, expiries are kept on a heap like registry.DeviceRegistry.
+
+    Note:
+        Thread safe, the daemon updates it while consumers query it.
+    """
+
+    # Records of a cache-flush set received before this are flushed, RFC 6762 10.2
+    FLUSH_GRACE = 1.0
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.RLock()
+        # key -> CachedRecord
+        self._entries = {}
+        # lower case name -> {key: CachedRecord}
+        self._by_name = {}
+        # (expires, sequence, key)
+        self._expiries = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, record):
+        return record.key in self._entries
+
+    def add(self, record, now=None):
+        """Caches a received record
+
+        Returns:
+            DiscoveryEvent with action ADDED or REMOVED (goodbye, TTL 0), None on refreshes
+        """
+        now = self.clock() if now is None else now
+        key = record.key
+        with self._lock:
+            entry = self._entries.get(key)
+            if record.ttl == 0:
+                if entry is None:
+                    return None
+                self._remove(key)
+                return DiscoveryEvent(DeviceRegistry.REMOVED, entry.record)
+            if record.cache_flush:
+                for other in list(self._by_name.get(key[0], {}).values()):
+                    old = other.record
+                    if old.rtype == record.rtype and old.rclass == record.rclass and \
+                            old.key != key and now - other.received > self.FLUSH_GRACE:
+                        other.expires = min(other.expires, now + self.FLUSH_GRACE)
+                        heapq.heappush(self._expiries, (other.expires, next(self._sequence), old.key))
+            if entry is not None:
+                entry.record = record
+                entry.received = now
+                entry.expires = now + record.ttl
+                return None
+            entry = self._entries[key] = CachedRecord(record, now)
+            self._by_name.setdefault(key[0], {})[key] = entry
+            heapq.heappush(self._expiries, (entry.expires, next(self._sequence), key))
+            return DiscoveryEvent(DeviceRegistry.ADDED, record)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        bucket = self._by_name.get(key[0])
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self._by_name[key[0]]
+        return entry
+
+    def expire(self, now=None):
+        """Drops every record whose TTL elapsed
+
+        Returns:
+            List of DiscoveryEvent with action EXPIRED
+        """
+        now = self.clock() if now is None else now
+        events = []
+        with self._lock:
+            expiries = self._expiries
+            while expiries and expiries[0][0] <= now:
+                _, _, key = heapq.heappop(expiries)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry.expires > now:
+                    # Refreshed since scheduled
+                    heapq.heappush(expiries, (entry.expires, next(self._sequence), key))
+                    continue
+                self._remove(key)
+                events.append(DiscoveryEvent(DeviceRegistry.EXPIRED, entry.record))
+        return events
+
+    def next_expiry(self, now=None):
+        """Seconds until the next scheduled expiry check, None if the cache is empty"""
+        with self._lock:
+            if not self._expiries:
+                return None
+            now = self.clock() if now is None else now
+            return max(0.0, self._expiries[0][0] - now)
+
+    def get(self, name, rtype=dns.TYPE_ANY):
+        """Cached records of a name, of any type by default"""
+        with self._lock:
+            return [entry.record for entry in self._by_name.get(name.lower(), {}).values()
+                    if rtype in (dns.TYPE_ANY, entry.record.rtype)]
+
+    def known_answers(self, question, now=None):
+        """Cached answers to a question with more than half of their TTL left, RFC 6762 7.1
+
+        Returns:
+            List of dns.DNSRecord with the TTL set to the remaining seconds
+        """
+        now = self.clock() if now is None else now
+        answers = []
+        with self._lock:
+            for entry in self._by_name.get(question.name.lower(), {}).values():
+                record = entry.record
+                remaining = entry.remaining(now)
+                if question.answered_by(record) and remaining > record.ttl / 2.0:
+                    answers.append(dns.DNSRecord(record.name, record.rtype, record.rdata, int(remaining),
+                                                 record.rclass, record.cache_flush))
+        return answers
+
+
+class _Query(object):
+    """A continuous query and its back-off state"""
+
+    __slots__ = ('question', 'interval', 'due')
+
+    def __init__(self, question, due):
+        self.question = question
+        self.interval = MIN_QUERY_INTERVAL
+        self.due = due
+
+    def sent(self, now):
+        """Schedules the next query, doubling the interval up to MAX_QUERY_INTERVAL"""
+        self.due = now + self.interval
+        self.interval = min(self.interval * 2, MAX_QUERY_INTERVAL)
+
+
+class _PendingAnswer(object):
+    """Answers waiting for their delay, see MDNSDaemon.handle_query"""
+
+    __slots__ = ('due', 'answers', 'known')
+
+    def __init__(self, due):
+        self.due = due
+        # key -> dns.DNSRecord
+        self.answers = {}
+        # key -> TTL the querier knows the record with
+        self.known = {}
+
+
+class MDNSDaemon(threading.Thread):
+    """Multicast DNS querier and responder
+
+    Browse for services with browse(service_type), the records seen on the link are
+    cached and changes go to records_out_q as DiscoveryEvent(action, dns.DNSRecord).
+    Advertise services with register_service.
+
+    Flow:
+        Querier                       Multicast Group(224.0.0.251:5353)     Responder
+           |-- PTR? _ipp._tcp.local. + known answers --------->|                |
+           |                                                   |--------------->|
+           |<------------------- PTR, SRV, TXT, A (multicast) -|<---------------|
+
+    Note:
+        Unique records are not probed for conflicts (RFC 6762 8.1), use names
+        nobody else on the link uses.
+    """
+
+    def __init__(self, host_name=None, address=None, logger_name='mDNS Agent', interface=None,
+                 queue_size=0, overflow_policy=DROP_OLDEST, metrics=None):
+        """Creates an MDNSDaemon agent
+
+        Args:
+            :param host_name: name of the A record of the registered services,
+                default is the host name on .local.
+            :param address: address of the A record, default is the interface or the
+                default route address
+            :param logger_name: String logger name, default: 'mDNS Agent'.
+            :param interface: local IPv4 address of the interface to use, default is INADDR_ANY
+            :param queue_size: max pending items on records_out_q, default 0 is unbounded
+            :param overflow_policy: what a full records_out_q does, see delivery.DeliveryQueue
+            :param metrics: metrics.MetricsRegistry for the daemon metrics, default is the shared one
+
+        Raises:
+            JoinGroupError - Socket level errors for multicast will be raised on the instantiation
+        """
+        self.logging = logging.getLogger(logger_name)
+        self.host_name = host_name or socket.gethostname().split('.')[0] + '.local.'
+        self.interfaces = InterfaceTable.get_instance()
+        self.address = address or interface
+        self.cache = RecordCache()
+        self.records_out_q = DeliveryQueue(queue_size, overflow_policy)
+        self.uniform = random.uniform
+        self._lock = threading.RLock()
+        # question key -> _Query
+        self._queries = {}
+        # lower case name -> {record key: dns.DNSRecord}, our authoritative records
+        self._records = {}
+        # instance name -> records of the registered service
+        self._services = {}
+        # (due, sequence, records) unsolicited responses
+        self._announcements = []
+        self._sequence = itertools.count()
+        self._multicast = None
+        # (host, port) -> _PendingAnswer of truncated queries waiting for their known answers
+        self._truncated = {}
+        # record key -> time.time() it was last multicast
+        self._last_multicast = {}
+        # Payloads we sent, to ignore them when looped back
+        self._sent = deque(maxlen=64)
+        labels = {'daemon': logger_name}
+        metrics = metrics or METRICS
+        self._queries_sent = metrics.counter('snf_mdns_queries_sent_total', 'mDNS query packets sent', **labels)
+        self._responses_sent = metrics.counter('snf_mdns_responses_sent_total', 'mDNS response packets sent',
+                                               **labels)
+        self._invalid = metrics.counter('snf_mdns_invalid_total', 'Datagrams that are not valid DNS', **labels)
+        self._suppressed = metrics.counter('snf_mdns_suppressed_total',
+                                           'Queries and answers not sent thanks to the traffic reducers', **labels)
+        self.__is_running = True
+        # time.time() when the group membership is renewed by the daemon thread, see rejoin
+        self._rejoin_at = None
+        # Selector and wake-up pair of this daemon's sockets only
+        self._selector = SocketSelector.new_key(MDNSDaemon.__name__)
+        self.transport = DatagramSocket(socket_type=DatagramSocket.SERVER,
+                                        implemented_protocol=MDNSDaemon.__name__,
+                                        selector=self._selector,
+                                        logger_name=logger_name,
+                                        group=MULTICAST_GROUP,
+                                        port=MULTICAST_PORT,
+                                        ttl=MULTICAST_TTL,
+                                        recv_size=MAX_MESSAGE_SIZE,
+                                        batch_size=32,
+                                        handler=self.handle_datagrams,
+                                        interface=interface)
+        self.interfaces.subscribe(self.on_interfaces_changed)
+        threading.Thread.__init__(self, name=logger_name)
+        self.daemon = True
+
+    # Querier
+
+    def query(self, name, rtype=dns.TYPE_PTR):
+        """Starts a continuous query, sent with exponential back-off until stop_query"""
+        question = dns.DNSQuestion(name, rtype)
+        with self._lock:
+            if question.key not in self._queries:
+                self._queries[question.key] = _Query(question, time.time() + self.uniform(*FIRST_QUERY_DELAY))
+        SocketSelector.wakeup(self._selector)
+
+    def stop_query(self, name, rtype=dns.TYPE_PTR):
+        """Stops a continuous query, cached records are kept until they expire"""
+        with self._lock:
+            self._queries.pop(dns.DNSQuestion(name, rtype).key, None)
+
+    def browse(self, service_type):
+        """Looks for the instances of a service type, i.e. '_ipp._tcp.local.'"""
+        self.query(service_type, dns.TYPE_PTR)
+
+    def services(self, service_type):
+        """Resolves the cached instances of a service type
+
+        Returns:
+            List of ServiceInfo, host, port and addresses are None while their records
+            haven't been seen
+        """
+        services = []
+        for pointer in self.cache.get(service_type, dns.TYPE_PTR):
+            name = pointer.rdata
+            host = port = None
+            addresses = []
+            txt = {}
+            for record in self.cache.get(name):
+                if record.rtype == dns.TYPE_SRV:
+                    port, host = record.rdata[2], record.rdata[3]
+                elif record.rtype == dns.TYPE_TXT:
+                    txt = dns.txt_to_dict(record.rdata)
+            if host is not None:
+                addresses = [record.rdata for record in self.cache.get(host)
+                             if record.rtype in (dns.TYPE_A, dns.TYPE_AAAA)]
+            services.append(ServiceInfo(name, service_type, host, port, addresses, txt))
+        return services
+
+    # Responder
+
+    def register_service(self, instance, service_type, port, txt=None, host_name=None, address=None):
+        """Advertises a service, announced twice and answered until unregister_service
+
+        Args:
+            :param instance: instance label, i.e. 'Office Printer', dots are escaped
+            :param service_type: i.e. '_ipp._tcp.local.'
+            :param port: TCP/UDP port of the service
+            :param txt: dict of TXT attributes, see dns.dict_to_txt
+            :param host_name: host of the SRV record, default is the daemon host_name
+            :param address: A record address, default is the daemon address
+
+        Returns:
+            Full instance name, i.e. 'Office Printer._ipp._tcp.local.'
+
+        Raises:
+            dns.DNSError - a label is empty or longer than 63 bytes, i.e. the instance
+        """
+        name = '{}.{}'.format(dns.escape_label(instance), service_type)
+        host_name = host_name or self.host_name
+        address = address or self.address or self.interfaces.host_address()
+        records = [dns.DNSRecord(service_type, dns.TYPE_PTR, name, OTHER_TTL),
+                   dns.DNSRecord(SERVICES, dns.TYPE_PTR, service_type, OTHER_TTL),
+                   dns.DNSRecord(name, dns.TYPE_SRV, (0, 0, port, host_name), HOST_TTL, cache_flush=True),
+                   dns.DNSRecord(name, dns.TYPE_TXT, dns.dict_to_txt(txt or {}), OTHER_TTL, cache_flush=True),
+                   dns.DNSRecord(host_name, dns.TYPE_A, address, HOST_TTL, cache_flush=True)]
+        # Rejected here rather than on every announcement and answer
+        dns.encode(dns.DNSMessage(dns.FLAG_RESPONSE, answers=records))
+        with self._lock:
+            self.unregister_service(name, goodbye=False)
+            self._services[name.lower()] = records
+            for record in records:
+                self._records.setdefault(record.key[0], {})[record.key] = record
+            now = time.time()
+            for index in range(ANNOUNCEMENTS):
+                heapq.heappush(self._announcements, (now + index * ANNOUNCE_INTERVAL, next(self._sequence), records))
+        SocketSelector.wakeup(self._selector)
+        return name
+
+    def unregister_service(self, name, goodbye=True):
+        """Stops advertising a service, sending a goodbye (TTL 0) unless told otherwise"""
+        with self._lock:
+            records = self._services.pop(name.lower(), None)
+            if not records:
+                return
+            shared = set(record.key for other in self._services.values() for record in other)
+            removed = []
+            for record in records:
+                if record.key in shared:
+                    # i.e. the host A record or the service type PTR used by another service
+                    continue
+                bucket = self._records.get(record.key[0], {})
+                bucket.pop(record.key, None)
+                if not bucket:
+                    self._records.pop(record.key[0], None)
+                removed.append(dns.DNSRecord(record.name, record.rtype, record.rdata, 0, record.rclass,
+                                             record.cache_flush))
+        if goodbye and removed:
+            self._send(dns.DNSMessage(dns.FLAG_RESPONSE | dns.FLAG_AUTHORITATIVE, answers=removed))
+
+    def _answers(self, question):
+        """Our records answering a question"""
+        return [record for record in self._records.get(question.name.lower(), {}).values()
+                if question.answered_by(record)]
+
+    def _additionals(self, answers):
+        """SRV, TXT and address records that save the querier another query, RFC 6763 12"""
+        names = set()
+        for record in answers:
+            if record.rtype == dns.TYPE_PTR:
+                names.add(record.rdata.lower())
+            elif record.rtype == dns.TYPE_SRV:
+                names.add(record.rdata[3].lower())
+        additionals = {}
+        while names:
+            name = names.pop()
+            for record in self._records.get(name, {}).values():
+                if record.key not in additionals:
+                    additionals[record.key] = record
+                    if record.rtype == dns.TYPE_SRV:
+                        names.add(record.rdata[3].lower())
+        for record in answers:
+            additionals.pop(record.key, None)
+        return list(additionals.values())
+
+    # Network
+
+    def run(self):
+        """Overrides threading.Thread.run method, sends the queries and answers when due"""
+        self.logging.info('mDNS agent started as {}'.format(self.host_name))
+        while self.__is_running:
+            now = time.time()
+            timeout = None
+            for due in self._timers():
+                delay = max(0.0, due - now)
+                if timeout is None or delay < timeout:
+                    timeout = delay
+            SocketSelector.dispatch(self._selector, timeout)
+            now = time.time()
+            if self._rejoin_at is not None and now >= self._rejoin_at:
+                self.rejoin()
+            self.send_queries(now)
+            self.send_answers(now)
+            for event in self.cache.expire(now):
+                self.records_out_q.put(event)
+
+    def _timers(self):
+        with self._lock:
+            timers = [query.due for query in self._queries.values()]
+            if self._announcements:
+                timers.append(self._announcements[0][0])
+            if self._multicast is not None:
+                timers.append(self._multicast.due)
+            timers.extend(pending.due for pending in self._truncated.values())
+            if self._rejoin_at is not None:
+                timers.append(self._rejoin_at)
+        expiry = self.cache.next_expiry()
+        if expiry is not None:
+            timers.append(time.time() + expiry)
+        return timers
+
+    def send_queries(self, now):
+        """Sends the due questions in a single query with their known answers"""
+        with self._lock:
+            due = [query for query in self._queries.values() if query.due <= now]
+            for query in due:
+                query.sent(now)
+        if not due:
+            return
+        questions = [query.question for query in due]
+        known = []
+        for question in questions:
+            known.extend(self.cache.known_answers(question, now))
+        # Known answers that don't fit go on the following packets, all but the last truncated
+        packets = _split(questions, known, dns.FLAG_TRUNCATED)
+        for message in packets:
+            self._send(message)
+        self._queries_sent.value += len(packets)
+
+    def send_answers(self, now):
+        """Sends the announcements and delayed answers that are due"""
+        with self._lock:
+            for source in [source for source, pending in self._truncated.items() if pending.due <= now]:
+                pending = self._truncated.pop(source)
+                self._schedule(pending.answers.values(), pending.known, now)
+            records = {}
+            while self._announcements and self._announcements[0][0] <= now:
+                for record in heapq.heappop(self._announcements)[2]:
+                    records[record.key] = record
+            multicast = self._multicast
+            if multicast is not None and multicast.due <= now:
+                self._multicast = None
+                records.update(multicast.answers)
+            answers = []
+            for key, record in records.items():
+                last = self._last_multicast.get(key)
+                if last is not None and now - last < MULTICAST_INTERVAL and record.ttl:
+                    self._suppressed.value += 1
+                    continue
+                self._last_multicast[key] = now
+                answers.append(record)
+            additionals = self._additionals(answers)
+        if answers:
+            for message in _split([], answers, 0, additionals):
+                self._send(message)
+
+    def _schedule(self, answers, known, now):
+        """Adds answers to the aggregated multicast response, minus the ones the querier knows"""
+        answers = list(answers)
+        wanted = [record for record in answers if known.get(record.key, -1) < record.ttl / 2.0]
+        self._suppressed.value += len(answers) - len(wanted)
+        answers = wanted
+        if not answers:
+            return
+        # Unique records are answered right away, shared ones after a random delay
+        if all(record.cache_flush for record in answers):
+            due = now
+        else:
+            due = now + self.uniform(*RESPONSE_DELAY)
+        if self._multicast is None:
+            self._multicast = _PendingAnswer(due)
+        self._multicast.due = min(self._multicast.due, due)
+        for record in answers:
+            self._multicast.answers[record.key] = record
+
+    def handle_datagrams(self):
+        """SocketSelector handler, drains the socket"""
+        try:
+            packages = self.transport.recv_batch()
+        except UnicastException:
+            return
+        for package in packages:
+            data = package.data.tobytes()
+            if data in self._sent and self.interfaces.is_local(package.host):
+                # Our own multicast looped back
+                continue
+            try:
+                message = dns.decode(data)
+            except dns.DNSError as error:
+                self._invalid.value += 1
+                self.logging.debug('Invalid DNS message from {}:{}: {}'.format(package.host, package.port, error))
+                continue
+            if message.is_response:
+                self.handle_response(message, package.host, package.port)
+            else:
+                self.handle_query(message, package.host, package.port)
+
+    def handle_response(self, message, host, port):
+        """Caches the records and drops the answers somebody else already sent"""
+        if port != MULTICAST_PORT:
+            # Not an mDNS responder, RFC 6762 6
+            return
+        now = time.time()
+        with self._lock:
+            pending = self._multicast
+            for record in itertools.chain(message.answers, message.additionals):
+                if pending is not None:
+                    ours = pending.answers.get(record.key)
+                    if ours is not None and record.ttl >= ours.ttl / 2.0:
+                        # Duplicate answer suppression, RFC 6762 7.4
+                        del pending.answers[record.key]
+                        self._suppressed.value += 1
+                if record.key[0] in self._records:
+                    continue
+                event = self.cache.add(record, now)
+                if event is not None:
+                    self.records_out_q.put(event)
+            if pending is not None and not pending.answers:
+                self._multicast = None
+
+    def handle_query(self, message, host, port):
+        """Answers the questions about our records, see RFC 6762 6 and 7"""
+        now = time.time()
+        known = dict((record.key, record.ttl) for record in message.answers)
+        with self._lock:
+            for question in message.questions:
+                # Duplicate question suppression, RFC 6762 7.3
+                query = self._queries.get(question.key)
+                if query is not None and not question.unicast and query.due > now and \
+                        all(record.key in known for record in self.cache.known_answers(question, now)):
+                    query.sent(now)
+                    self._suppressed.value += 1
+            truncated = self._truncated.get((host, port))
+            if truncated is not None:
+                # Known answers continuation of a truncated query
+                truncated.known.update(known)
+            answers = []
+            for question in message.questions:
+                answers.extend(self._answers(question))
+            if not answers:
+                return
+            if port != MULTICAST_PORT:
+                # Legacy unicast querier, answered right away with the same id and questions
+                self._send_legacy(message, answers, (host, port))
+                return
+            if any(question.unicast for question in message.questions):
+                unicast = [record for record in answers if known.get(record.key, -1) < record.ttl / 2.0]
+                if unicast:
+                    self._send(dns.DNSMessage(dns.FLAG_RESPONSE | dns.FLAG_AUTHORITATIVE, answers=unicast,
+                                              additionals=self._additionals(unicast)), (host, port))
+                return
+            if message.truncated:
+                pending = self._truncated.setdefault((host, port), _PendingAnswer(now + self.uniform(*TRUNCATED_DELAY)))
+                pending.known.update(known)
+                for record in answers:
+                    pending.answers[record.key] = record
+                return
+            self._schedule(answers, known, now)
+
+    def _send_legacy(self, message, answers, address):
+        capped = [dns.DNSRecord(record.name, record.rtype, record.rdata, min(record.ttl, LEGACY_TTL),
+                                record.rclass) for record in answers]
+        self._send(dns.DNSMessage(dns.FLAG_RESPONSE | dns.FLAG_AUTHORITATIVE, questions=message.questions,
+                                  answers=capped, id=message.id), address)
+
+    def _send(self, message, address=None):
+        """Encodes and sends a message, multicast unless an address is given"""
+        try:
+            payload = dns.encode(message)
+        except dns.DNSError as error:
+            self.logging.error('Cannot encode {}: {}'.format(message, error))
+            return
+        if address is None:
+            address = (MULTICAST_GROUP, MULTICAST_PORT)
+            self._sent.append(payload)
+        if message.is_response:
+            self._responses_sent.value += 1
+        try:
+            self.transport.send_batch([(payload, address)])
+        except MulticastException:
+            pass
+
+    def on_interfaces_changed(self, interfaces):
+        """InterfaceTable subscriber, the group membership is renewed by the daemon thread"""
+        self.logging.info('Local addresses changed, re-joining {}'.format(MULTICAST_GROUP))
+        self._rejoin_at = time.time()
+        SocketSelector.wakeup(self._selector)
+
+    def rejoin(self):
+        """Renews the group membership, reopening the socket if a join failed before"""
+        self._rejoin_at = None
+        try:
+            self.transport.recover()
+        except (JoinGroupError, NetworkConfigurationError, MulticastException) as error:
+            self.logging.error('Cannot join {}, retrying in {}s: {}'.format(MULTICAST_GROUP, REJOIN_RETRY, error))
+            self._rejoin_at = time.time() + REJOIN_RETRY
+
+    def join(self, timeout=None):
+        """Sends goodbye for the registered services and stops the daemon"""
+        for name in list(self._services):
+            self.unregister_service(name)
+        self.__is_running = False
+        self.interfaces.unsubscribe(self.on_interfaces_changed)
+        SocketSelector.wakeup(self._selector)
+        if self.is_alive():
+            threading.Thread.join(self, timeout)
+        self.logging.info('mDNS Daemon stopped')
+        self.transport.destroy()
+        SocketSelector.release(self._selector)
+
+
+def _split(questions, records, flags, additionals=()):
+    """Packs questions and records in messages of up to MAX_PACKET_SIZE bytes
+
+    Records that don't fit go to the next message, every message but the last gets the
+    extra flags (FLAG_TRUNCATED for known answers). Additional records are only added
+    to the last message while they fit. Questions and records that can't be encoded, i.e.
+    a label over 63 bytes, are left out instead of failing the whole message.
+    """
+    base = flags & ~dns.FLAG_TRUNCATED
+    response = not questions
+    if response:
+        base |= dns.FLAG_RESPONSE | dns.FLAG_AUTHORITATIVE
+    messages = []
+    questions = [question for question in questions if _encodes(dns.DNSMessage(base, questions=[question]))]
+    current = dns.DNSMessage(base, questions=questions)
+    for record in records:
+        current.answers.append(record)
+        try:
+            size = len(dns.encode(current))
+        except dns.DNSError:
+            current.answers.pop()
+            continue
+        if len(current.answers) > 1 and size > MAX_PACKET_SIZE:
+            current.answers.pop()
+            current.flags = base | flags
+            messages.append(current)
+            current = dns.DNSMessage(base, answers=[record])
+    for record in additionals:
+        current.additionals.append(record)
+        try:
+            size = len(dns.encode(current))
+        except dns.DNSError:
+            current.additionals.pop()
+            continue
+        if size > MAX_PACKET_SIZE:
+            current.additionals.pop()
+            break
+    if current.questions or current.answers:
+        messages.append(current)
+    return messages
+
+
+def _encodes(message):
+    try:
+        dns.encode(message)
+    except dns.DNSError:
+        return False
+    return True
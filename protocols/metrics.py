@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Low overhead counters, gauges and histograms for the sockets and daemons
+
+Updating a metric is a couple of attribute increments, no locks and no formatting,
+gauges are callables only evaluated when somebody reads a snapshot. Read them with
+MetricsRegistry.snapshot or expose them with an exporter, i.e. PrometheusExporter.
+
+Note:
+    Counters aren't locked, concurrent writers of the same metric may lose increments.
+    Each metric is written by its owning daemon thread, readers only see a snapshot.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import bisect
+import logging
+import threading
+import timeit
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Monotonic enough for latencies, perf_counter on Python 3
+clock = timeit.default_timer
+
+# Seconds, from 10us to 5s (the UPnP 1.1 max MX)
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter(object):
+    """Monotonic value, i.e. packets received"""
+
+    __slots__ = ('value',)
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def read(self):
+        return self.value
+
+
+class Gauge(object):
+    """Value read from a callable when a snapshot is taken, i.e. a queue depth"""
+
+    __slots__ = ('function',)
+    kind = 'gauge'
+
+    def __init__(self, function):
+        self.function = function
+
+    def read(self):
+        try:
+            return self.function()
+        except Exception:
+            return None
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed upper bounds"""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+    kind = 'histogram'
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(bounds))
+        # One slot per bound plus +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def read(self):
+        """Cumulative buckets, bound -> observations <= bound, like Prometheus"""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+def _escape(value, quote=True):
+    """Escapes a label value (or a HELP text without quote) for the text exposition format"""
+    value = '{}'.format(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quote else value
+
+
+def _sample_name(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels))
+
+
+class MetricsRegistry(object):
+    """Named metrics identified by a name and a set of labels
+
+    Getting a metric that already exists returns it, so sockets with the same labels
+    (i.e. the same protocol and interface) share their counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (kind, help)
+        self._families = {}
+        # (name, sorted labels) -> metric
+        self._metrics = {}
+
+    def _get(self, name, help_text, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = factory()
+                    self._families.setdefault(name, (metric.kind, help_text))
+                    self._metrics[key] = metric
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        """Gets or creates a Counter"""
+        return self._get(name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text='', bounds=LATENCY_BUCKETS, **labels):
+        """Gets or creates a Histogram"""
+        return self._get(name, help_text, labels, lambda: Histogram(bounds))
+
+    def gauge(self, name, function, help_text='', exclusive=False, **labels):
+        """Registers a Gauge, replacing the callable of an existing one
+
+        Raises:
+            ValueError - exclusive is set and the gauge is registered already, i.e. by
+                another daemon with the same labels
+        """
+        if exclusive:
+            key = (name, tuple(sorted(labels.items())))
+            with self._lock:
+                if key in self._metrics:
+                    raise ValueError('{} is registered already'.format(_sample_name(name, key[1])))
+                gauge = self._metrics[key] = Gauge(function)
+                self._families.setdefault(name, (gauge.kind, help_text))
+            return gauge
+        gauge = self._get(name, help_text, labels, lambda: Gauge(function))
+        gauge.function = function
+        return gauge
+
+    def remove(self, name, **labels):
+        """Removes a metric, i.e. the gauges of a stopped daemon"""
+        with self._lock:
+            self._metrics.pop((name, tuple(sorted(labels.items()))), None)
+
+    def collect(self):
+        """List of (name, kind, help, [(labels, value)]) sorted by name"""
+        with self._lock:
+            metrics = list(self._metrics.items())
+            families = dict(self._families)
+        samples = {}
+        for (name, labels), metric in metrics:
+            samples.setdefault(name, []).append((labels, metric.read()))
+        return [(name, families[name][0], families[name][1], sorted(samples[name], key=lambda s: s[0]))
+                for name in sorted(samples)]
+
+    def snapshot(self):
+        """Dict of sample name (name{label="value"}) -> value, histograms are dicts"""
+        snapshot = {}
+        for name, _, _, samples in self.collect():
+            for labels, value in samples:
+                snapshot[_sample_name(name, labels)] = value
+        return snapshot
+
+
+# Shared by the sockets and daemons unless they're given another registry
+METRICS = MetricsRegistry()
+
+
+def render_prometheus(registry=METRICS):
+    """Prometheus text exposition format (version 0.0.4) of a registry"""
+    lines = []
+    for name, kind, help_text, samples in registry.collect():
+        if help_text:
+            lines.append('# HELP {} {}'.format(name, _escape(help_text, quote=False)))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            if kind == 'histogram':
+                for bound, count in value['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{} {}'.format(_sample_name(name + '_bucket', labels + (('le', le),)), count))
+                lines.append('{} {}'.format(_sample_name(name + '_sum', labels), repr(value['sum'])))
+                lines.append('{} {}'.format(_sample_name(name + '_count', labels), value['count']))
+            elif value is not None:
+                lines.append('{} {}'.format(_sample_name(name, labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusExporter(threading.Thread):
+    """Serves render_prometheus over HTTP, by default on localhost only
+
+    Any other exporter only needs MetricsRegistry.snapshot or MetricsRegistry.collect,
+    metrics are rendered on demand so an idle exporter costs nothing.
+    """
+
+    def __init__(self, registry=METRICS, host='127.0.0.1', port=9464, logger_name='Metrics'):
+        """PrometheusExporter constructor
+
+        Args:
+            :param registry: MetricsRegistry to export
+            :param host: address to listen on, keep it local unless the network is trusted
+            :param port: TCP port, 0 picks a free one (see the port attribute)
+            :param logger_name: Valid logger name.
+        """
+        self.registry = registry
+        self.logging = logging.getLogger(logger_name)
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = render_prometheus(exporter.registry).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                exporter.logging.debug(fmt % args)
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread.__init__(self, name=logger_name)
+        self.daemon = True
+
+    def run(self):
+        """Overrides threading.Thread.run method"""
+        self.logging.info('Exporting metrics on http://{}:{}/metrics'.format(*self.httpd.server_address))
+        self.httpd.serve_forever()
+
+    def join(self, timeout=None):
+        """Stops the HTTP server"""
+        if self.is_alive():
+            self.httpd.shutdown()
+            threading.Thread.join(self, timeout=timeout)
+        self.httpd.server_close()
@@ -7,16 +7,74 @@ __author__ = 'douglasvinter'
 __version__ = '0.1'
 
 
+import os
+import sys
+import math
+import errno
+import ctypes
 import socket
 import struct
+import time
 import select
+import itertools
+import threading
 import netifaces
-from logging import getLogger
+from logging import getLogger, DEBUG
 from collections import namedtuple
+from .metrics import METRICS
+try:
+    from selectors import DefaultSelector, SelectorKey, EVENT_READ
+except ImportError:
+    # Python 2, fallback to a minimal epoll/poll based selector
+    DefaultSelector = None
+    SelectorKey = namedtuple('SelectorKey', ('fileobj', 'fd', 'events', 'data'))
+    EVENT_READ = 1
 
 # udp_pkg used to return datagram status
 # Class-like declaration
 UdpPackage = namedtuple('udp_pkg', ('data', 'host', 'port'))
+# send_failure used to report messages DatagramSocket.send_batch could not deliver
+SendFailure = namedtuple('send_failure', ('index', 'address', 'error'))
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint32), ('sin_zero', ctypes.c_char * 8)]
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IoVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """Looks up the Linux sendmmsg(2) syscall wrapper, not exposed by the socket module"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+_sendmmsg = _load_sendmmsg()
+# Not exposed by the socket module on every Python version
+_IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49 if sys.platform.startswith('linux') else None)
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+# Non-blocking receive of a single call (missing on Windows, where the reader is non-blocking anyway)
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
 
 
 class ProtocolError(Exception):
@@ -52,25 +110,104 @@ class NetworkConfigurationError(ProtocolError):
     pass
 
 
+class _PollSelector(object):
+    """Minimal registration based selector for interpreters without ``selectors``
+
+    Mirrors the subset of the ``selectors.BaseSelector`` API used by SocketSelector,
+    backed by epoll on Linux, poll elsewhere and select as a last resort.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._flag = select.EPOLLIN
+        elif hasattr(select, 'poll'):
+            self._poller = select.poll()
+            self._flag = select.POLLIN
+        else:
+            self._poller = None
+            self._flag = 1
+
+    def register(self, fileobj, events, data=None):
+        key = SelectorKey(fileobj, fileobj.fileno(), events, data)
+        if key.fd in self._keys:
+            raise KeyError("{!r} is already registered".format(fileobj))
+        if self._poller is not None:
+            self._poller.register(key.fd, self._flag)
+        self._keys[key.fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        key = self._keys.pop(fileobj if isinstance(fileobj, int) else fileobj.fileno())
+        if self._poller is not None:
+            try:
+                self._poller.unregister(key.fd)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        return key
+
+    def select(self, timeout=None):
+        if timeout is not None:
+            # epoll and poll truncate to milliseconds, a timer due in less would be polled
+            # with 0 until it's due, round up like the selectors module does
+            timeout = math.ceil(max(timeout, 0) * 1e3) * 1e-3
+        if self._poller is None:
+            ready, _, _ = select.select(list(self._keys), [], [], timeout)
+        elif isinstance(self._poller, getattr(select, 'epoll', ())):
+            ready = [fd for fd, _ in self._poller.poll(-1 if timeout is None else timeout)]
+        else:
+            ready = [fd for fd, _ in self._poller.poll(None if timeout is None else timeout * 1000)]
+        return [(self._keys[fd], EVENT_READ) for fd in ready if fd in self._keys]
+
+    def get_map(self):
+        return self._keys
+
+    def close(self):
+        if self._poller is not None and hasattr(self._poller, 'close'):
+            self._poller.close()
+        self._keys.clear()
+
+
+if DefaultSelector is None:
+    DefaultSelector = _PollSelector
+
+
 class SocketSelector(object):
-    """"""
+    """Persistent I/O selector shared by every DatagramSocket
+
+    Sockets are registered once (on build) and unregistered on destroy, grouped by their
+    selector key (the implemented protocol name by default), so each loop waits only on its
+    own file descriptors and every ready descriptor maps straight back to its owning
+    DatagramSocket. Daemons get a key of their own from new_key, two instances of the same
+    protocol never handle each other's sockets or take each other's wake-ups.
 
-    # select.select timeout
+    Note:
+        Uses epoll on Linux (kqueue/poll elsewhere) through the standard library selectors.
+        Waiting without a timeout is cheap: an idle loop is not woken until a datagram
+        arrives or SocketSelector.wakeup is called for its protocol.
+    """
+
+    # Default timeout for the legacy polling helpers
     SOCKET_TIMEOUT = 0.1
+    # Selector key holding every registered socket, used by select_all
+    ALL_PROTOCOLS = None
     _instance = None
-    sockets = []
+    _lock = threading.Lock()
+    _keys = itertools.count(1)
 
     def __new__(cls, *args, **kwargs):
-        """"""
+        """Singleton, all the sockets must share the same registry"""
         if cls._instance is None:
             cls._instance = super(SocketSelector, cls).__new__(cls, *args, **kwargs)
+            # fd -> DatagramSocket, shared by all protocols
+            cls._instance.handlers = {}
+            # protocol name -> (selector, wake-up socket pair)
+            cls._instance._selectors = {}
+            # Keys closed by release, never created again
+            cls._instance._released = set()
         return cls._instance
 
-    @staticmethod
-    def add_handler(klaas):
-        if klaas is not None:
-            SocketSelector.sockets.append(klaas)
-
     @staticmethod
     def get_instance():
         """Gets class instance."""
@@ -78,45 +215,169 @@ class SocketSelector(object):
             SocketSelector._instance = SocketSelector()
         return SocketSelector._instance
 
+    def _get_selector(self, protocol):
+        """Gets (or lazily creates) the selector for a protocol name, None once released"""
+        entry = self._selectors.get(protocol)
+        if entry is None:
+            if protocol in self._released:
+                return None
+            selector = DefaultSelector()
+            reader, writer = socket.socketpair()
+            reader.setblocking(False)
+            writer.setblocking(False)
+            selector.register(reader, EVENT_READ, None)
+            entry = self._selectors[protocol] = (selector, (reader, writer))
+        return entry
+
     @staticmethod
-    def select_all():
-        """Simple I/O selector
+    def new_key(protocol):
+        """Unique selector key of a protocol instance, see DatagramSocket selector"""
+        return '{}-{}'.format(protocol, next(SocketSelector._keys))
 
-        Returns:
-            List of ready sockets to be read
+    @staticmethod
+    def release(key):
+        """Closes the selector and wake-up pair of a key, once its sockets are destroyed"""
+        instance = SocketSelector.get_instance()
+        with SocketSelector._lock:
+            entry = instance._selectors.pop(key, None)
+            # A late wakeup or dispatch must not build it again, nothing would close it
+            instance._released.add(key)
+        if entry is not None:
+            selector, (reader, writer) = entry
+            selector.close()
+            reader.close()
+            writer.close()
+
+    @staticmethod
+    def add_handler(klaas):
+        """Registers a DatagramSocket transport for its implemented protocol
+
+        Args:
+            :param klaas: DatagramSocket instance with a built transport
         """
+        if klaas is None or not isinstance(klaas.transport, socket.socket):
+            return
+        instance = SocketSelector.get_instance()
+        with SocketSelector._lock:
+            fd = klaas.transport.fileno()
+            if fd in instance.handlers:
+                return
+            for protocol in (klaas.selector, SocketSelector.ALL_PROTOCOLS):
+                entry = instance._get_selector(protocol)
+                if entry is not None:
+                    entry[0].register(klaas.transport, EVENT_READ, klaas)
+            instance.handlers[fd] = klaas
 
-        sockets = []
-        socks_ready = []
-        for cls in SocketSelector.get_instance().sockets:
-            sockets.append(cls.transport)
+    @staticmethod
+    def remove_handler(klaas):
+        """Unregisters a DatagramSocket transport, must be called before closing it
+
+        Args:
+            :param klaas: DatagramSocket instance previously registered
+        """
+        if klaas is None or not isinstance(klaas.transport, socket.socket):
+            return
+        instance = SocketSelector.get_instance()
+        with SocketSelector._lock:
+            try:
+                fd = klaas.transport.fileno()
+            except socket.error:
+                return
+            if instance.handlers.get(fd) is not klaas:
+                return
+            del instance.handlers[fd]
+            for protocol in (klaas.selector, SocketSelector.ALL_PROTOCOLS):
+                entry = instance._get_selector(protocol)
+                if entry is None:
+                    continue
+                try:
+                    entry[0].unregister(klaas.transport)
+                except (KeyError, ValueError):
+                    pass
+
+    @staticmethod
+    def wakeup(protocol):
+        """Interrupts a loop blocked on SocketSelector.dispatch for the protocol
+
+        Args:
+            :param protocol: Protocol name or selector key used on the DatagramSocket instances
+        """
+        entry = SocketSelector.get_instance()._selectors.get(protocol)
+        if entry is None:
+            # Nothing registered nor waiting on it, or released already
+            return
+        _, (_, writer) = entry
         try:
-            socks_ready, _, _ = select.select(sockets, [], [], SocketSelector.SOCKET_TIMEOUT)
-        except (socket.error, TypeError):
+            writer.send(b'\0')
+        except socket.error:
+            # Buffer full, the loop already has a pending wake-up
             pass
-        return socks_ready
 
     @staticmethod
-    def select_protocol(protocol):
-        """Simple I/O selector
+    def _select(protocol, timeout):
+        """Waits for ready keys on the protocol selector, draining wake-up events"""
+        ready = []
+        entry = SocketSelector.get_instance()._get_selector(protocol)
+        if entry is None:
+            # Released, its daemon is gone
+            return ready
+        selector, (reader, _) = entry
+        try:
+            events = selector.select(timeout)
+        except (IOError, OSError, socket.error, ValueError):
+            return ready
+        for key, _ in events:
+            if key.data is None:
+                try:
+                    reader.recv(4096)
+                except socket.error:
+                    pass
+            else:
+                ready.append(key.data)
+        return ready
+
+    @staticmethod
+    def dispatch(protocol, timeout=None):
+        """Waits for datagrams and hands them straight to the owning socket handler
 
         Args:
             :param protocol: Protocol name to hook up on sub classes
+            :param timeout: Seconds to wait, None blocks until a datagram or wakeup
+
+        Returns:
+            Number of sockets dispatched
+        """
+        dispatched = 0
+        for klaas in SocketSelector._select(protocol, timeout):
+            if klaas.handler is not None and klaas.transport is not None:
+                klaas.handler()
+                dispatched += 1
+        return dispatched
+
+    @staticmethod
+    def select_all(timeout=SOCKET_TIMEOUT):
+        """Simple I/O selector
+
+        Args:
+            :param timeout: Seconds to wait, None blocks until a socket is ready
 
         Returns:
             List of ready sockets to be read
         """
+        return [k.transport for k in SocketSelector._select(SocketSelector.ALL_PROTOCOLS, timeout)]
 
-        sockets = []
-        socks_ready = []
-        for cls in SocketSelector.get_instance().sockets:
-            if cls.implemented_protocol == protocol:
-                sockets.append(cls.transport)
-        try:
-            socks_ready, _, _ = select.select(sockets, [], [], SocketSelector.SOCKET_TIMEOUT)
-        except (socket.error, TypeError):
-            pass
-        return socks_ready
+    @staticmethod
+    def select_protocol(protocol, timeout=SOCKET_TIMEOUT):
+        """Simple I/O selector
+
+        Args:
+            :param protocol: Protocol name to hook up on sub classes
+            :param timeout: Seconds to wait, None blocks until a socket is ready
+
+        Returns:
+            List of ready sockets to be read
+        """
+        return [k.transport for k in SocketSelector._select(protocol, timeout)]
 
 
 class DatagramSocket(object):
@@ -136,8 +397,12 @@ class DatagramSocket(object):
     # Public constants
     CLIENT = 0x554e4943415354
     SERVER = 0x4d554c544943415354
+    # Blocking receive time-out in seconds
+    SOCKET_TIMEOUT = 1
 
-    def __init__(self, socket_type, implemented_protocol, logger_name, group, port, ttl=None, recv_size=1024):
+    def __init__(self, socket_type, implemented_protocol, logger_name, group, port, ttl=None, recv_size=1024,
+                 handler=None, batch_size=64, interface=None, reuse_port=False, metrics=None, recorder=None,
+                 selector=None):
         """DatagramSocket constructor
 
         Args:
@@ -149,23 +414,56 @@ class DatagramSocket(object):
             :param ttl: time to live, datagram package hops.
             :param recv_size: size in bytes to be received.
                 Max UDP package is 64Kb = 65536
+            :param handler: callable invoked by SocketSelector.dispatch when data is ready
+            :param batch_size: max datagrams drained by recv_batch in a single call
+            :param interface: local IPv4 address of the interface to use, default is INADDR_ANY.
+                A SERVER only receives the group traffic of this interface, a CLIENT sends the
+                multicast out of it and is bound to its address.
+            :param reuse_port: set SO_REUSEPORT, so several processes can bind the same port and
+                the kernel spreads the unicast datagrams between them (multicast is copied to all)
+            :param metrics: metrics.MetricsRegistry for the packet counters, default is the shared one
+            :param recorder: optional capture.PacketRecorder, gets every datagram received and sent
+            :param selector: SocketSelector key the socket is registered on, default is the
+                implemented_protocol, see SocketSelector.new_key
         Note:
             Please make sure to chose the correct socket_type:
                 - If you want a MUSTICAST litener ONLY, chose the socket type to be SERVER.
                 - If you want a socket to send MULTICAST and UNICAST but not listening, chose CLIENT.
         """
-        assert (255 >= ttl >= 1 or ttl is None), "TTL of {} is invalid".format(ttl)
+        assert (ttl is None or 255 >= ttl >= 1), "TTL of {} is invalid".format(ttl)
         assert (65536 >= recv_size >= 8), "Receive size of {} is invalid".format(recv_size)
+        assert (batch_size >= 1), "Batch size of {} is invalid".format(batch_size)
         self.__socket_type = socket_type
         self.implemented_protocol = implemented_protocol
+        self.selector = selector or implemented_protocol
         self.logging = getLogger(logger_name)
         self.group = group
         self.port = port
         self.sock_ttl = ttl or 1
         self.recv_size = recv_size
+        self.handler = handler
+        self.interface = interface
+        self.reuse_port = reuse_port
+        self.recorder = recorder
+        # (address, port) of the socket as written on the captures, see _record
+        self._local = None
+        # Sockets with the same labels (i.e. one per worker thread) share the counters
+        metrics = metrics or METRICS
+        labels = {'protocol': implemented_protocol, 'interface': interface or 'any',
+                  'socket': 'server' if socket_type == DatagramSocket.SERVER else 'client'}
+        self._packets_in = metrics.counter('snf_packets_received_total', 'Datagrams received', **labels)
+        self._bytes_in = metrics.counter('snf_bytes_received_total', 'Bytes received', **labels)
+        self._packets_out = metrics.counter('snf_packets_sent_total', 'Datagrams sent', **labels)
+        self._bytes_out = metrics.counter('snf_bytes_sent_total', 'Bytes sent', **labels)
+        self._recv_errors = metrics.counter('snf_receive_errors_total', 'Socket errors while receiving', **labels)
+        self._send_errors = metrics.counter('snf_send_errors_total', 'Datagrams that could not be sent', **labels)
+        # Pre-allocated receive buffer pool, one recv_size slot per datagram
+        pool = memoryview(bytearray(recv_size * batch_size))
+        self._recv_pool = [pool[i * recv_size:(i + 1) * recv_size] for i in range(batch_size)]
         self.transport = None
+        # Non-blocking duplicate of the transport used by recv_batch, see _batch_reader
+        self._reader = None
         self._build_socket()
-        SocketSelector.add_handler(self)
 
     def _build_socket(self):
         """Builds the socket accordly to its type
@@ -194,7 +492,7 @@ class DatagramSocket(object):
             raise MulticastException("A protocol is already defined, you need to destroy it first")
         self.transport = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                        socket.IPPROTO_UDP)
-        self.transport.settimeout(1)
+        self.transport.settimeout(DatagramSocket.SOCKET_TIMEOUT)
         # NOTE: Set the TTL according to the protocol you're implementing
         # Check RFC/Protocol documentation before setting a HUGE TTL,
         # Some routers/switch may decrease the hops.
@@ -204,18 +502,49 @@ class DatagramSocket(object):
             self.transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         except AttributeError:
             self.logging.warning('Re-use address is not supported')
+        if self.reuse_port:
+            if _SO_REUSEPORT is None:
+                self.transport.close()
+                self.transport = None
+                raise NetworkConfigurationError('SO_REUSEPORT is not supported on this platform')
+            self.transport.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        if self.interface is not None:
+            try:
+                self.transport.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                          socket.inet_aton(self.interface))
+                if self.__socket_type == DatagramSocket.CLIENT:
+                    # Unicast answers come back on the interface the M-SEARCH left from
+                    self.transport.bind((self.interface, 0))
+            except socket.error as error:
+                error_msg = 'Cannot use interface {}: {}'.format(self.interface, error)
+                self.logging.error(error_msg)
+                self.transport.close()
+                self.transport = None
+                raise NetworkConfigurationError(error_msg)
+        SocketSelector.add_handler(self)
+
+    def _membership(self):
+        """ip_mreq for the group on the socket interface"""
+        if self.interface is None:
+            return struct.pack('4sl', socket.inet_aton(self.group), socket.INADDR_ANY)
+        return struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton(self.interface))
 
     def join_group(self):
         """Joins the target multicast group
 
         Note:
-            We're using INADDR_ANY
+            We're using INADDR_ANY unless an interface was given, in that case only the
+            group traffic arriving on that interface is delivered to this socket
         """
         if not isinstance(self.transport, socket.socket):
             raise MulticastException("Build a protocol before call join group method")
         try:
-            host = struct.pack('4sl', socket.inet_aton(self.group), socket.INADDR_ANY)
-            self.transport.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.INADDR_ANY)
+            host = self._membership()
+            if self.interface is None:
+                self.transport.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.INADDR_ANY)
+            elif _IP_MULTICAST_ALL is not None:
+                # Linux delivers the group traffic joined by any socket unless disabled
+                self.transport.setsockopt(socket.SOL_IP, _IP_MULTICAST_ALL, 0)
             self.transport.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, host)
         except (socket.error, AttributeError, TypeError, NetworkConfigurationError) as error:
             error_msg = 'Could not join multicast group {}:{} \n{}' \
@@ -225,6 +554,37 @@ class DatagramSocket(object):
             self.destroy()
             raise JoinGroupError(error_msg)
 
+    def rejoin_group(self):
+        """Drops and joins the multicast group again, i.e. after the local addresses changed
+
+        Raises:
+            JoinGroupError - the socket is destroyed if the group can't be joined
+        """
+        if not isinstance(self.transport, socket.socket):
+            raise MulticastException("Build a protocol before call join group method")
+        try:
+            self.transport.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP, self._membership())
+        except socket.error:
+            # Membership was lost together with the interface
+            pass
+        self.join_group()
+
+    def recover(self):
+        """Joins the group again, rebuilding the socket if a failed join destroyed it
+
+        Raises:
+            JoinGroupError - still failing, the socket is left destroyed
+            NetworkConfigurationError - the interface can't be used
+        """
+        if isinstance(self.transport, socket.socket):
+            self.rejoin_group()
+            return
+        try:
+            self._build_socket()
+        except socket.error as error:
+            self.destroy()
+            raise JoinGroupError('Could not reopen {}:{}, reason:{}'.format(self.group, self.port, error))
+
     def send_multicast(self, msg):
         """Multicast a message over the group.
 
@@ -241,8 +601,12 @@ class DatagramSocket(object):
             self.logging.debug('Sending data for target {}:{}:\n{}'
                                .format(self.group, self.port, msg))
             try:
-                self.transport.sendto(msg, (self.group, self.port))
+                self._bytes_out.value += self.transport.sendto(to_bytes(msg), (self.group, self.port))
+                self._packets_out.value += 1
+                if self.recorder is not None:
+                    self._record(True, to_bytes(msg), self.group, self.port)
             except (socket.error, AttributeError) as mcast_error:
+                self._send_errors.value += 1
                 error_msg = 'Error while sending multicast, reason:{}' \
                     .format(mcast_error)
                 self.logging.error(error_msg)
@@ -250,6 +614,105 @@ class DatagramSocket(object):
                 self.destroy()
                 raise MulticastException(error_msg)
 
+    def send_batch(self, messages):
+        """Sends many datagrams with as few system calls as possible
+
+        Uses a single sendmmsg(2) call on Linux, falls back to one sendto per message
+        elsewhere. Unlike send_multicast/send_unicast a failing message does not
+        destroy the socket, it's reported back and the remaining ones are still sent.
+
+        Args:
+            :param messages: iterable of (payload, (host, port)) pairs
+
+        Returns:
+            List of SendFailure(index, address, error), empty if everything was sent
+
+        Raises:
+            MulticastException - Socket not connected
+        """
+        if not isinstance(self.transport, socket.socket):
+            raise MulticastException("Cant send, not connected")
+        messages = [(to_bytes(msg), address) for msg, address in messages]
+        if self.logging.isEnabledFor(DEBUG):
+            self.logging.debug('Sending batch of {} datagrams:\n{}'
+                               .format(len(messages), '\n'.join('{}:{}'.format(*a) for _, a in messages)))
+        if _sendmmsg is not None and len(messages) > 1:
+            failures = self._sendmmsg(messages)
+        else:
+            failures = []
+            for index, (msg, address) in enumerate(messages):
+                try:
+                    self.transport.sendto(msg, address)
+                except (socket.error, TypeError) as send_error:
+                    failures.append(SendFailure(index, address, str(send_error)))
+        self._packets_out.value += len(messages) - len(failures)
+        self._bytes_out.value += sum(len(msg) for msg, _ in messages) - \
+            sum(len(messages[failure.index][0]) for failure in failures)
+        self._send_errors.value += len(failures)
+        if self.recorder is not None:
+            failed = set(failure.index for failure in failures)
+            for index, (msg, address) in enumerate(messages):
+                if index not in failed:
+                    self._record(True, msg, address[0], address[1])
+        for failure in failures:
+            self.logging.error('Error while sending to {}:{}, reason:{}'
+                               .format(failure.address[0], failure.address[1], failure.error))
+        return failures
+
+    def _sendmmsg(self, messages):
+        """send_batch implementation on top of sendmmsg(2)"""
+        failures = []
+        count = len(messages)
+        headers = (_MMsgHdr * count)()
+        # Keep references to the ctypes buffers until the call returns
+        keep = []
+        for index, (msg, address) in enumerate(messages):
+            try:
+                name = _SockAddrIn(socket.AF_INET, socket.htons(address[1]),
+                                   struct.unpack('=I', socket.inet_aton(address[0]))[0])
+            except (socket.error, TypeError, IndexError, OverflowError) as addr_error:
+                # Zero length header without address, reported and skipped below
+                failures.append(SendFailure(index, address, str(addr_error)))
+                continue
+            buf = ctypes.create_string_buffer(msg, len(msg))
+            iov = _IoVec(ctypes.cast(buf, ctypes.c_void_p), len(msg))
+            keep.append((name, buf, iov))
+            header = headers[index].msg_hdr
+            header.msg_name = ctypes.cast(ctypes.pointer(name), ctypes.c_void_p)
+            header.msg_namelen = ctypes.sizeof(name)
+            header.msg_iov = ctypes.pointer(iov)
+            header.msg_iovlen = 1
+        invalid = set(failure.index for failure in failures)
+        start = 0
+        fd = self.transport.fileno()
+        base = ctypes.addressof(headers)
+        while start < count:
+            if start in invalid:
+                start += 1
+                continue
+            # Stop each call right before the next invalid header
+            end = start + 1
+            while end < count and end not in invalid:
+                end += 1
+            sent = _sendmmsg(fd, base + start * ctypes.sizeof(_MMsgHdr), end - start, 0)
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # Send buffer is full, same time-out used by the blocking sendto
+                    _, writable, _ = select.select([], [fd], [], DatagramSocket.SOCKET_TIMEOUT)
+                    if writable:
+                        continue
+                # The first message of the call failed, report it and carry on
+                failures.append(SendFailure(start, messages[start][1],
+                                            '[Errno {}] {}'.format(err, os.strerror(err))))
+                start += 1
+            else:
+                start += sent
+        failures.sort()
+        return failures
+
     def send_unicast(self, msg, *address):
         """Unicast sender
         Args:
@@ -261,9 +724,13 @@ class DatagramSocket(object):
         if not isinstance(self.transport, socket.socket) and len(msg) > 0:
             raise UnicastException("Cant send, not connected")
         try:
-            self.transport.sendto(msg, address)
+            self._bytes_out.value += self.transport.sendto(to_bytes(msg), address)
+            self._packets_out.value += 1
+            if self.recorder is not None:
+                self._record(True, to_bytes(msg), address[0], address[1])
             self.logging.debug('Send to {}:{} data: \n{}'.format(address[0], address[1], msg))
         except (socket.error, AttributeError) as mcast_error:
+            self._send_errors.value += 1
             error_msg = 'Error while sending unicast, reason:{}' \
                 .format(mcast_error)
             self.logging.error(error_msg)
@@ -299,9 +766,14 @@ class DatagramSocket(object):
 
         try:
             data, (host, port) = self.transport.recvfrom(self.recv_size)
+            self._packets_in.value += 1
+            self._bytes_in.value += len(data)
+            if self.recorder is not None:
+                self._record(False, data, host, port)
         except socket.timeout as mcast_time_out:
             data = '{}'.format(mcast_time_out)
         except (socket.error, AttributeError) as mcast_error:
+            self._recv_errors.value += 1
             # We won't close the socket file descriptor
             # as we're working with time-out UDP multicast sockets
             error_msg = 'Error receiving socket data: {}' \
@@ -310,23 +782,130 @@ class DatagramSocket(object):
             # Force file descriptor closure
             self.destroy()
             raise UnicastException(error_msg)
+        if self.logging.isEnabledFor(DEBUG):
+            self._log_package(data, host, port)
+        return UdpPackage(data, host, port)
+
+    def recv_batch(self, max_packets=None):
+        """Drains every datagram already queued on the socket, without blocking.
+
+        Datagrams are received straight into the pre-allocated buffer pool, so a storm
+        of responses is consumed in a single wake-up with no per-package allocation.
+
+        Args:
+            :param max_packets: Stop after this many datagrams, default is batch_size
+
+        Returns:
+            List of UdpPackage, data is a memoryview over the buffer pool and is only
+            valid until the next recv_batch call (copy it with tobytes() to keep it)
+
+        Raises:
+            UnicastException - Socket not connected or socket level errors, the socket is destroyed
+        """
+        if not isinstance(self.transport, socket.socket):
+            raise UnicastException("Cannot recv, not connected")
+        packages = []
+        debug = self.logging.isEnabledFor(DEBUG)
+        pool = self._recv_pool
+        limit = len(pool) if max_packets is None else min(max_packets, len(pool))
+        reader = self._reader
+        if reader is None:
+            reader = self._reader = self._batch_reader()
+        recvfrom_into = reader.recvfrom_into
+        received = 0
+        recorder = self.recorder
+        try:
+            for i in range(limit):
+                view = pool[i]
+                try:
+                    nbytes, (host, port) = recvfrom_into(view, 0, _MSG_DONTWAIT)
+                except socket.error as error:
+                    if error.args and error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        break
+                    self._recv_errors.value += 1
+                    error_msg = 'Error receiving socket data: {}'.format(error)
+                    self.logging.error(error_msg)
+                    # Force file descriptor closure
+                    self.destroy()
+                    raise UnicastException(error_msg)
+                data = view[:nbytes]
+                received += nbytes
+                packages.append(UdpPackage(data, host, port))
+                if recorder is not None:
+                    self._record(False, data, host, port)
+                if debug:
+                    self._log_package(data.tobytes(), host, port)
+        finally:
+            self._packets_in.value += len(packages)
+            self._bytes_in.value += received
+        return packages
+
+    def _batch_reader(self):
+        """Duplicate of the transport without a time-out, for recv_batch
+
+        Python polls a socket with a time-out before every receive, which would wait
+        SOCKET_TIMEOUT once the queue is drained. The duplicate shares the file with the
+        transport, which keeps its time-out for recv_dgram and the senders.
+        """
+        transport = self.transport
+        reader = socket.fromfd(transport.fileno(), transport.family, transport.type, transport.proto)
+        reader.setblocking(False)
+        return reader
+
+    def _record(self, sent, data, host, port):
+        """Hands a datagram to the recorder, with the local end of the socket"""
+        local = self._local
+        if local is None:
+            if self.__socket_type == DatagramSocket.SERVER:
+                local = self._local = (self.group, self.port)
+            else:
+                try:
+                    address, local_port = self.transport.getsockname()
+                except (socket.error, AttributeError):
+                    address, local_port = '0.0.0.0', 0
+                local = (self.interface or address, local_port)
+                if local_port:
+                    # Bound on the first send when there's no interface
+                    self._local = local
+        # capture.SENT and capture.CLIENT
+        flags = 0x01 if sent else 0
+        if self.__socket_type == DatagramSocket.CLIENT:
+            flags |= 0x02
+        self.recorder.record(flags, data, host, port, local)
+
+    def _log_package(self, data, host, port):
+        """Dumps a received package, callers must check the DEBUG level first"""
         self.logging.debug('Received MCAST:\n\n******* PACKAGE DATA *******\n\n{}\n******* END OF PACKAGE DATA *******\nFROM: {}:{}\n'
                            .format(data, host, port))
-        return UdpPackage(data, host, port)
 
     def destroy(self):
         """Performs graceful shut-down on socket.
 
-        shuts-down both read/write on the file descriptor.
+        shuts-down both read/write on the file descriptor and removes it from the selector.
         """
         self.logging.debug('Closing RDWR for socket')
+        SocketSelector.remove_handler(self)
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
         try:
             self.transport.shutdown(socket.SHUT_RDWR)
         except (socket.error, AttributeError):
             pass
+        try:
+            self.transport.close()
+        except (socket.error, AttributeError):
+            pass
         self.transport = None
 
 
+def to_bytes(msg):
+    """Encodes text payloads, Python 3 sockets only accept bytes"""
+    if not isinstance(msg, bytes):
+        msg = msg.encode('utf-8')
+    return msg
+
+
 def get_host_address(network_interface=None):
     """Gets your active IP Address"""
     try:
@@ -336,3 +915,182 @@ def get_host_address(network_interface=None):
     except (ValueError, KeyError):
         raise NetworkConfigurationError("There's a problem on your network configuration, operation cannot proceed")
     return address
+
+
+class InterfaceTable(object):
+    """Cached view of the local interfaces and their IPv4 addresses
+
+    Reading netifaces on every package is expensive, this table is populated once and
+    refreshed when the kernel reports an address or link change (netlink, Linux only)
+    or, where netlink isn't available, when the TTL expires.
+
+    Subscribers are called with the table every time the addresses change, so derived
+    state (pre-rendered answers, multicast memberships) can be rebuilt.
+
+    Attributes:
+        addresses - frozenset with every local IPv4 address
+        interfaces - dict of interface name -> list of IPv4 addresses
+        default_address - address of the default route interface, see get_host_address
+    """
+
+    # Refresh interval in seconds when netlink notifications are not available
+    TTL = 30.0
+    _instance = None
+    _lock = threading.Lock()
+
+    # Netlink route multicast groups and message types
+    _RTMGRP_LINK = 0x1
+    _RTMGRP_IPV4_IFADDR = 0x10
+    _RTM_EVENTS = (16, 17, 20, 21)  # RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR
+
+    def __init__(self, ttl=None, watch=True, logger_name='Interface Table'):
+        """InterfaceTable constructor, use InterfaceTable.get_instance for the shared table
+
+        Args:
+            :param ttl: refresh interval in seconds used without netlink, default TTL
+            :param watch: listen to netlink address changes on a background thread
+            :param logger_name: Valid logger name.
+        """
+        self.ttl = self.TTL if ttl is None else ttl
+        self.logging = getLogger(logger_name)
+        self.addresses = frozenset()
+        self.interfaces = {}
+        self.default_address = None
+        self._subscribers = []
+        self._expires = 0
+        self._watcher = None
+        self.refresh()
+        if watch:
+            self._watch()
+
+    @staticmethod
+    def get_instance():
+        """Gets the shared table, created on the first call"""
+        if InterfaceTable._instance is None:
+            with InterfaceTable._lock:
+                if InterfaceTable._instance is None:
+                    InterfaceTable._instance = InterfaceTable()
+        return InterfaceTable._instance
+
+    def subscribe(self, callback):
+        """Registers a callable(table) called whenever the addresses change"""
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Removes a callable registered with subscribe"""
+        try:
+            self._subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def is_local(self, address):
+        """O(1) check if the address belongs to this host, i.e. a package sent by us"""
+        self._check_ttl()
+        return address in self.addresses
+
+    def host_address(self):
+        """Cached get_host_address, raises NetworkConfigurationError without a default route"""
+        self._check_ttl()
+        if self.default_address is None:
+            raise NetworkConfigurationError("There's a problem on your network configuration, "
+                                            "operation cannot proceed")
+        return self.default_address
+
+    def resolve(self, interfaces):
+        """Local IPv4 addresses selected by an interface list
+
+        Args:
+            :param interfaces: 'all' for every non loopback address, or a list of
+                interface names (i.e. 'eth0') and/or local IPv4 addresses
+
+        Returns:
+            Sorted list of addresses, unknown names and addresses are ignored
+        """
+        self._check_ttl()
+        if interfaces == 'all':
+            return sorted(address for address in self.addresses if not address.startswith('127.'))
+        selected = set()
+        for item in interfaces:
+            if item in self.interfaces:
+                selected.update(self.interfaces[item])
+            elif item in self.addresses:
+                selected.add(item)
+        return sorted(selected)
+
+    def _check_ttl(self):
+        if self._watcher is None and time.time() >= self._expires:
+            self.refresh()
+
+    def refresh(self):
+        """Reads the interfaces again, notifying the subscribers if anything changed
+
+        Returns:
+            bool - True if the addresses changed
+        """
+        interfaces = {}
+        for name in netifaces.interfaces():
+            try:
+                entries = netifaces.ifaddresses(name).get(netifaces.AF_INET, [])
+            except ValueError:
+                # Interface removed while iterating
+                continue
+            addresses = [str(entry['addr']) for entry in entries if 'addr' in entry]
+            if addresses:
+                interfaces[str(name)] = addresses
+        try:
+            default_address = str(get_host_address())
+        except NetworkConfigurationError:
+            default_address = None
+        self._expires = time.time() + self.ttl
+        changed = interfaces != self.interfaces or default_address != self.default_address
+        if changed:
+            self.interfaces = interfaces
+            self.addresses = frozenset(address for addresses in interfaces.values() for address in addresses)
+            self.default_address = default_address
+            self.logging.debug('Local addresses changed: {}'.format(interfaces))
+            for callback in list(self._subscribers):
+                try:
+                    callback(self)
+                except Exception as error:
+                    self.logging.error('Interface change subscriber failed: {}'.format(error))
+        return changed
+
+    def _watch(self):
+        """Starts the netlink listener thread, falls back to TTL refreshes if unavailable"""
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, self._RTMGRP_LINK | self._RTMGRP_IPV4_IFADDR))
+        except (socket.error, AttributeError, ValueError):
+            self.logging.debug('Netlink not available, refreshing interfaces every {}s'.format(self.ttl))
+            return
+        self._watcher = threading.Thread(target=self._netlink_loop, args=(sock,), name='InterfaceTable')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _netlink_loop(self, sock):
+        """Refreshes the table on RTM_NEWADDR/RTM_DELADDR/RTM_NEWLINK/RTM_DELLINK"""
+        header = struct.Struct('=LHHLL')
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error as error:
+                if error.args and error.args[0] == errno.EINTR:
+                    continue
+                # Buffer overrun or closed socket, keep the table fresh with the TTL
+                self.logging.error('Netlink listener stopped: {}'.format(error))
+                self._watcher = None
+                return
+            offset = 0
+            relevant = False
+            while offset + header.size <= len(data):
+                length, msg_type, _, _, _ = header.unpack_from(data, offset)
+                if msg_type in self._RTM_EVENTS:
+                    relevant = True
+                    break
+                if length < header.size:
+                    break
+                # Messages are 4 bytes aligned
+                offset += (length + 3) & ~3
+            if relevant:
+                self.refresh()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""Registry of the devices and services found on the network
+
+Keeps one entry per USN, honoring the CACHE-CONTROL max-age of the announcements,
+so consumers get add/update/expire deltas instead of every single response.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import re
+import time
+import heapq
+import itertools
+import threading
+from collections import namedtuple
+
+# discovery_event used to report registry changes
+# action is one of DeviceRegistry.ADDED, UPDATED, EXPIRED or REMOVED
+DiscoveryEvent = namedtuple('discovery_event', ('action', 'entry'))
+
+_MAX_AGE = re.compile(r'max-age\s*=\s*"?(\d+)', re.IGNORECASE)
+
+
+def max_age(cache_control, default):
+    """Gets the max-age in seconds from a CACHE-CONTROL header value
+
+    Args:
+        :param cache_control: header value, i.e. 'max-age=1800'
+        :param default: returned when the header is missing or invalid
+    """
+    if cache_control:
+        match = _MAX_AGE.search(cache_control)
+        if match:
+            return int(match.group(1))
+    return default
+
+
+def split_usn(usn):
+    """Splits a USN into the device UUID and its type
+
+    i.e 'uuid:abc::urn:schemas-upnp-org:service:ConnectionManager:1' returns
+    ('uuid:abc', 'urn:schemas-upnp-org:service:ConnectionManager:1')
+    """
+    uuid, _, target = usn.partition('::')
+    return uuid, target or uuid
+
+
+class DeviceEntry(object):
+    """A device or service found on the network, see DeviceRegistry
+
+    Attributes:
+        usn - unique service name, the registry key
+        uuid - device UUID (uuid:...), shared by all the services of a device
+        st - search target / notification type
+        location - device description URL
+        max_age - seconds the announcement is valid for
+        expires - time.time() based expiry
+        headers - dict of the announcement, same format as upnp.parse
+        scheduled - time of the registry expiry check, up to expires
+    """
+
+    __slots__ = ('usn', 'uuid', 'st', 'location', 'max_age', 'expires', 'headers', 'scheduled')
+
+    def __init__(self, usn, uuid, st, location, max_age, expires, headers):
+        self.usn = usn
+        self.uuid = uuid
+        self.st = st
+        self.location = location
+        self.max_age = max_age
+        self.expires = expires
+        self.headers = headers
+        self.scheduled = expires
+
+    def __repr__(self):
+        return '<DeviceEntry {} at {}>'.format(self.usn, self.location)
+
+
+class DeviceRegistry(object):
+    """Expiring registry of discovered devices indexed by USN, UUID and type
+
+    Entries expire according to their CACHE-CONTROL max-age, expiries are kept on a
+    heap so DeviceRegistry.expire only touches the entries that are actually due.
+    Repeated announcements only extend the expiry and don't generate events.
+
+    Attributes:
+        generation - incremented on every added, updated or dropped entry
+
+    Note:
+        Thread safe, the daemon updates it while consumers query it.
+    """
+
+    ADDED = 'add'
+    UPDATED = 'update'
+    EXPIRED = 'expire'
+    REMOVED = 'remove'
+    # Used when the announcement has no valid CACHE-CONTROL
+    DEFAULT_MAX_AGE = 1800
+    # Heap size under which the stale items of removed entries are left for expire
+    COMPACT_SIZE = 1024
+    # Headers that make an announcement an update when they change, together with the
+    # target (ST of the answers, NT of the NOTIFY)
+    SIGNIFICANT_HEADERS = ('location', 'server', 'bootid.upnp.org', 'configid.upnp.org')
+
+    def __init__(self, default_max_age=DEFAULT_MAX_AGE, clock=time.time):
+        """DeviceRegistry constructor
+
+        Args:
+            :param default_max_age: max-age used when CACHE-CONTROL is missing
+            :param clock: callable returning the current time in seconds
+        """
+        self.default_max_age = default_max_age
+        self.clock = clock
+        self._lock = threading.RLock()
+        self.generation = 0
+        # usn -> DeviceEntry
+        self._entries = {}
+        # uuid -> {usn: DeviceEntry}
+        self._by_uuid = {}
+        # st -> {usn: DeviceEntry}
+        self._by_type = {}
+        # (due time, sequence, DeviceEntry)
+        self._expiries = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, usn):
+        return usn in self._entries
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries.values()))
+
+    def get(self, usn):
+        """Gets an entry by USN, None if unknown"""
+        return self._entries.get(usn)
+
+    def by_uuid(self, uuid):
+        """Gets every entry (root device, embedded devices and services) of a device UUID"""
+        with self._lock:
+            return list(self._by_uuid.get(uuid, {}).values())
+
+    def by_type(self, st):
+        """Gets every entry of a device or service type, i.e. urn:schemas-upnp-org:device:MediaServer:1"""
+        with self._lock:
+            return list(self._by_type.get(st, {}).values())
+
+    def update(self, message, now=None):
+        """Adds or refreshes an entry from an announcement
+
+        Args:
+            :param message: upnp.SSDPMessage or dict returned by upnp.parse, needs a USN
+            :param now: current time, default is the registry clock
+
+        Returns:
+            DiscoveryEvent for new or changed entries, None for a plain refresh
+        """
+        usn = message.get('usn')
+        if not usn:
+            return None
+        now = self.clock() if now is None else now
+        age = max_age(message.get('cache-control'), self.default_max_age)
+        uuid, target = split_usn(usn)
+        st = message.get('st') or message.get('nt') or target
+        with self._lock:
+            entry = self._entries.get(usn)
+            if entry is not None:
+                entry.max_age = age
+                entry.expires = now + age
+                if entry.expires < entry.scheduled:
+                    # Shorter max-age, the check already scheduled would be too late
+                    self._schedule(entry)
+                if st == entry.st and \
+                        all(message.get(name) == entry.headers.get(name) for name in self.SIGNIFICANT_HEADERS):
+                    return None
+                self._unindex(entry)
+                action = DeviceRegistry.UPDATED
+            else:
+                action = DeviceRegistry.ADDED
+            headers = message.to_dict() if hasattr(message, 'to_dict') else dict(message)
+            if entry is None:
+                entry = DeviceEntry(usn, uuid, st, headers.get('location'), age, now + age, headers)
+                self._entries[usn] = entry
+                self._schedule(entry)
+            else:
+                entry.uuid, entry.st, entry.location, entry.headers = uuid, st, headers.get('location'), headers
+            self._by_uuid.setdefault(uuid, {})[usn] = entry
+            self._by_type.setdefault(st, {})[usn] = entry
+            self.generation += 1
+            return DiscoveryEvent(action, entry)
+
+    def restore(self, headers, expires, now=None):
+        """Adds an entry saved before a restart, see snapshot.load
+
+        Args:
+            :param headers: dict of the saved announcement
+            :param expires: time.time() based expiry saved with it, kept as is
+
+        Returns:
+            DiscoveryEvent ADDED, None if the USN is known already or the entry expired
+        """
+        now = self.clock() if now is None else now
+        usn = headers.get('usn')
+        with self._lock:
+            if not usn or usn in self._entries or expires <= now:
+                return None
+            event = self.update(headers, now)
+            # The heap item pushed by update is later than this one, skipped as stale
+            event.entry.expires = expires
+            self._schedule(event.entry)
+            return event
+
+    def remove(self, usn):
+        """Removes an entry, i.e. on ssdp:byebye
+
+        Returns:
+            DiscoveryEvent or None if the USN is unknown
+        """
+        with self._lock:
+            entry = self._entries.pop(usn, None)
+            if entry is None:
+                return None
+            self._unindex(entry)
+            self.generation += 1
+            if len(self._expiries) > self.COMPACT_SIZE and len(self._expiries) > 2 * len(self._entries):
+                # Mostly heap items of removed entries, i.e. a registry whose expire is never
+                # called (the merged view of workers.SSDPWorkerPool)
+                self._compact()
+            return DiscoveryEvent(DeviceRegistry.REMOVED, entry)
+
+    def expire(self, now=None):
+        """Drops every entry whose max-age elapsed
+
+        Returns:
+            List of DiscoveryEvent with action EXPIRED
+        """
+        now = self.clock() if now is None else now
+        events = []
+        with self._lock:
+            expiries = self._expiries
+            while expiries and expiries[0][0] <= now:
+                due, _, entry = heapq.heappop(expiries)
+                if self._entries.get(entry.usn) is not entry or due != entry.scheduled:
+                    # Removed, replaced or rescheduled earlier, stale heap item
+                    continue
+                if entry.expires > now:
+                    # Refreshed since scheduled, a single live heap item per entry
+                    self._schedule(entry)
+                    continue
+                del self._entries[entry.usn]
+                self._unindex(entry)
+                self.generation += 1
+                events.append(DiscoveryEvent(DeviceRegistry.EXPIRED, entry))
+        return events
+
+    def expiring(self, before):
+        """Entries expiring by a time, earliest first
+
+        Only the heap items due by then are visited, not the whole registry.
+        """
+        found = {}
+        with self._lock:
+            heap = self._expiries
+            pending = [0] if heap else []
+            while pending:
+                index = pending.pop()
+                due, _, entry = heap[index]
+                if due > before:
+                    continue
+                if self._entries.get(entry.usn) is entry and entry.expires <= before:
+                    found[entry.usn] = entry
+                pending.extend(child for child in (2 * index + 1, 2 * index + 2) if child < len(heap))
+        return sorted(found.values(), key=lambda entry: entry.expires)
+
+    def next_expiry(self, now=None):
+        """Seconds until the next scheduled expiry check, None if the registry is empty"""
+        with self._lock:
+            if not self._expiries:
+                return None
+            now = self.clock() if now is None else now
+            return max(0.0, self._expiries[0][0] - now)
+
+    def _compact(self):
+        """Rebuilds the expiry heap with a single item per entry"""
+        self._expiries = [(entry.scheduled, next(self._sequence), entry) for entry in self._entries.values()]
+        heapq.heapify(self._expiries)
+
+    def _schedule(self, entry):
+        """Pushes the expiry check of an entry, earlier heap items of it become stale"""
+        entry.scheduled = entry.expires
+        heapq.heappush(self._expiries, (entry.expires, next(self._sequence), entry))
+
+    def _unindex(self, entry):
+        """Removes the entry from the UUID and type indexes"""
+        for index, key in ((self._by_uuid, entry.uuid), (self._by_type, entry.st)):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(entry.usn, None)
+                if not bucket:
+                    del index[key]
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""Timing helpers shared by the discovery daemons
+
+Rate limiting and delayed sending, so our own traffic follows the pacing
+intended by the protocols instead of going out in bursts. ResponseScheduler
+delays the answers to M-SEARCH and SearchScheduler our own M-SEARCH.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import heapq
+import random
+import itertools
+import threading
+from collections import OrderedDict
+from .advertising import search_matches
+
+
+class TokenBucket(object):
+    """Classic token bucket, rate tokens per second up to burst tokens"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = now
+
+    def consume(self, now, tokens=1.0):
+        """Takes tokens from the bucket
+
+        Returns:
+            bool - False if there weren't enough tokens, nothing is taken
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, now, tokens=1.0):
+        """Seconds until the bucket has enough tokens"""
+        available = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        if available >= tokens:
+            return 0.0
+        return (tokens - available) / self.rate
+
+
+def max_wait(value, limit):
+    """Parses an MX header value into seconds, clamped to [0, limit], 0 if missing or invalid"""
+    try:
+        return min(max(float(value), 0.0), limit)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ResponseScheduler(object):
+    """Delays M-SEARCH answers by a random time within the requester's MX
+
+    UPnP asks devices to spread their answers uniformly over [0, MX] so control points
+    aren't flooded in the same millisecond. Pending answers are kept on a heap, a repeated
+    request from the same sender and ST is coalesced while its answer is pending, and each
+    source address has a token bucket limiting how many requests per second it gets
+    answers for.
+
+    Attributes:
+        scheduled - requests scheduled to be answered
+        coalesced - duplicate requests dropped while an answer was pending
+        suppressed - requests dropped by the per sender rate limit
+        sent - answers handed back by due
+    """
+
+    # UPnP 1.1, MX values above 5 should be treated as 5
+    MAX_MX = 5.0
+
+    def __init__(self, rate=10.0, burst=20, max_senders=4096, max_mx=MAX_MX,
+                 clock=time.time, uniform=random.uniform, latency=None):
+        """ResponseScheduler constructor
+
+        Args:
+            :param rate: requests per second answered for a single source address
+            :param burst: requests answered in a burst before the rate applies
+            :param max_senders: source addresses tracked, least recently seen are evicted
+            :param max_mx: upper bound of the random delay in seconds
+            :param clock: callable returning the current time in seconds
+            :param uniform: callable(a, b) returning a random delay
+            :param latency: optional metrics.Histogram observing the seconds between
+                scheduling a request and handing its answers back
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_senders = max_senders
+        self.max_mx = max_mx
+        self.clock = clock
+        self.uniform = uniform
+        self.latency = latency
+        self.scheduled = self.coalesced = self.suppressed = self.sent = 0
+        # address -> TokenBucket, least recently seen first
+        self._buckets = OrderedDict()
+        # (due time, sequence, (sender, st), replies, scheduled time)
+        self._heap = []
+        self._pending = set()
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, sender, search_target, replies, mx, now=None):
+        """Schedules the answers of an M-SEARCH
+
+        Args:
+            :param sender: (host, port) of the requester
+            :param search_target: ST of the request, used to coalesce duplicates
+            :param replies: list of (answer, address) pairs, see DatagramSocket.send_batch
+            :param mx: MX header value of the request, delay upper bound in seconds
+
+        Returns:
+            bool - False if the request was coalesced or rate limited
+        """
+        now = self.clock() if now is None else now
+        key = (sender, search_target)
+        if key in self._pending:
+            self.coalesced += 1
+            return False
+        bucket = self._buckets.pop(sender[0], None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, now)
+            if len(self._buckets) >= self.max_senders:
+                self._buckets.popitem(last=False)
+        self._buckets[sender[0]] = bucket
+        if not bucket.consume(now):
+            self.suppressed += 1
+            return False
+        delay = self.uniform(0, max_wait(mx, self.max_mx))
+        heapq.heappush(self._heap, (now + delay, next(self._sequence), key, replies, now))
+        self._pending.add(key)
+        self.scheduled += 1
+        return True
+
+    def due(self, now=None):
+        """Pops every answer whose delay elapsed
+
+        Returns:
+            List of (answer, address) pairs ready to be sent
+        """
+        now = self.clock() if now is None else now
+        ready = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, key, replies, scheduled = heapq.heappop(heap)
+            self._pending.discard(key)
+            ready.extend(replies)
+            if self.latency is not None:
+                self.latency.observe(now - scheduled)
+        self.sent += len(ready)
+        return ready
+
+    def next_due(self, now=None):
+        """Seconds until the next answer is due, None if nothing is pending"""
+        if not self._heap:
+            return None
+        now = self.clock() if now is None else now
+        return max(0.0, self._heap[0][0] - now)
+
+    def stats(self):
+        """Snapshot of the scheduler counters"""
+        return {'pending': len(self._heap), 'scheduled': self.scheduled, 'coalesced': self.coalesced,
+                'suppressed': self.suppressed, 'sent': self.sent}
+
+
+class _SearchTarget(object):
+    """Schedule of a single M-SEARCH target, see SearchScheduler"""
+
+    __slots__ = ('target', 'interval', 'next', 'retries', 'changed')
+
+    def __init__(self, target, interval, next, retries):
+        self.target = target
+        self.interval = interval
+        self.next = next
+        self.retries = retries
+        self.changed = False
+
+
+class SearchScheduler(object):
+    """Decides when each M-SEARCH target is searched
+
+    A target is searched retries times retry_spacing apart when it's added, a single
+    request is easily lost, then every interval seconds doubling up to max_interval while
+    its results stay the same. New or updated devices of the target bring the interval
+    back to its minimum, and losing one (byebye or expiry) also searches it again soon.
+    Every delay is jittered so control points started together drift apart, and a token
+    bucket shared by every target paces the datagrams sent.
+
+    Attributes:
+        sent - searches handed back by due
+        throttled - times due stopped because the token bucket was empty
+    """
+
+    RETRIES = 3
+    RETRY_SPACING = 1.0
+    BACKOFF = 2.0
+    MAX_INTERVAL = 900.0
+    # Delays are spread over +/- JITTER of their value
+    JITTER = 0.2
+    # Datagrams per second sent by every target together
+    RATE = 10.0
+    BURST = 10
+
+    def __init__(self, interval, max_interval=None, retries=RETRIES, retry_spacing=RETRY_SPACING,
+                 rate=RATE, burst=BURST, clock=time.time, uniform=random.uniform):
+        """SearchScheduler constructor
+
+        Args:
+            :param interval: seconds between searches once the retries are sent, None or 0
+                for no periodic search
+            :param max_interval: interval upper bound while the results are stable, by
+                default MAX_INTERVAL or interval if it's larger
+            :param retries: searches sent when a target is added, 0 for none
+            :param retry_spacing: seconds between these searches
+            :param rate: datagrams per second sent by every target together
+            :param burst: datagrams sent in a burst before the rate applies
+            :param clock: callable returning the current time in seconds
+            :param uniform: callable(a, b) returning a random number, the jitter
+        """
+        self.interval = interval if interval and interval > 0 else None
+        self.max_interval = max_interval or max(self.MAX_INTERVAL, self.interval or 0)
+        self.retries = retries
+        self.retry_spacing = retry_spacing
+        self.clock = clock
+        self.uniform = uniform
+        self.bucket = TokenBucket(rate, burst, clock())
+        self.sent = self.throttled = 0
+        self._lock = threading.Lock()
+        self._targets = OrderedDict()
+
+    def __len__(self):
+        return len(self._targets)
+
+    def __contains__(self, target):
+        return target in self._targets
+
+    def _jitter(self, delay):
+        return delay * self.uniform(1.0 - self.JITTER, 1.0 + self.JITTER)
+
+    def add(self, target, now=None, delay=0.0, retries=None):
+        """Schedules a search target, its first search is due after delay and the retries follow
+
+        Args:
+            :param delay: seconds before the first search, 0 for right away
+            :param retries: searches sent when it's added, default is the scheduler retries
+        """
+        now = self.clock() if now is None else now
+        retries = self.retries if retries is None else retries
+        with self._lock:
+            if retries > 0:
+                self._targets[target] = _SearchTarget(target, self.interval, now + delay, retries)
+            elif self.interval is not None:
+                self._targets[target] = _SearchTarget(target, self.interval, now + self._jitter(self.interval), 0)
+            else:
+                self._targets[target] = _SearchTarget(target, None, None, 0)
+
+    def targets(self):
+        """Scheduled search targets"""
+        with self._lock:
+            return list(self._targets)
+
+    def remove(self, target):
+        """Stops searching a target"""
+        with self._lock:
+            self._targets.pop(target, None)
+
+    def refresh(self, now=None):
+        """Makes every target due now, i.e. when the passive view went stale"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            for state in self._targets.values():
+                state.next = now
+
+    def observe(self, target, lost, now=None):
+        """Feeds a device arrival or departure back into the schedule of the targets covering it
+
+        Updated devices aren't fed, a single flapping device would keep its targets at the
+        shortest interval.
+
+        Args:
+            :param target: ST/NT of the device that was added, removed or expired
+            :param lost: True for a byebye or an expiry, the target is searched again soon
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            for state in self._targets.values():
+                if not search_matches(state.target, target):
+                    continue
+                state.changed = True
+                if lost:
+                    if self.interval is not None:
+                        state.interval = self.interval
+                    soon = now + self._jitter(self.retry_spacing)
+                    state.next = soon if state.next is None else min(state.next, soon)
+
+    def _sent(self, state, now):
+        retry = state.retries > 0
+        if retry:
+            state.retries -= 1
+        if state.retries > 0:
+            state.next = now + self._jitter(self.retry_spacing)
+        elif self.interval is not None:
+            if retry or state.changed:
+                state.interval = self.interval
+            else:
+                state.interval = min(state.interval * self.BACKOFF, self.max_interval)
+            state.changed = False
+            state.next = now + self._jitter(state.interval)
+        else:
+            state.next = None
+
+    def due(self, now=None, cost=1.0):
+        """Targets to search now, as many as the token bucket allows
+
+        Args:
+            :param cost: tokens taken by a single target, i.e. the number of interfaces
+
+        Returns:
+            List of search targets, earliest first
+        """
+        now = self.clock() if now is None else now
+        # A single target costing more than the burst would never be sent
+        cost = min(cost, self.bucket.burst)
+        ready = []
+        with self._lock:
+            states = sorted((state for state in self._targets.values() if state.next is not None and state.next <= now),
+                            key=lambda state: state.next)
+            for state in states:
+                if not self.bucket.consume(now, cost):
+                    self.throttled += 1
+                    break
+                ready.append(state.target)
+                self._sent(state, now)
+        self.sent += len(ready)
+        return ready
+
+    def next_due(self, now=None, cost=1.0):
+        """Seconds until the next search, None if nothing is scheduled"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            times = [state.next for state in self._targets.values() if state.next is not None]
+        if not times:
+            return None
+        delay = max(0.0, min(times) - now)
+        return delay if delay > 0 else self.bucket.delay(now, min(cost, self.bucket.burst))
+
+    def stats(self):
+        """Snapshot of the scheduler counters"""
+        with self._lock:
+            intervals = [state.interval for state in self._targets.values() if state.interval is not None]
+        return {'targets': len(self._targets), 'sent': self.sent, 'throttled': self.throttled,
+                'max_interval': max(intervals) if intervals else 0}
+
+
+class RefreshScheduler(object):
+    """Picks the known devices to re-confirm with an unicast M-SEARCH before they expire
+
+    An entry is asked for once its expiry is closer than lead seconds (at most
+    LEAD_RATIO of its max-age), again every retry seconds up to attempts times while no
+    answer or announcement pushed its expiry back. A token bucket limits the searches
+    per second and the registry is looked at every CHECK_INTERVAL seconds at most.
+
+    Attributes:
+        sent - entries handed back by due
+        throttled - checks cut short by the token bucket
+    """
+
+    LEAD = 180.0
+    LEAD_RATIO = 0.25
+    RETRY = 10.0
+    ATTEMPTS = 2
+    RATE = 50.0
+    BURST = 50
+    CHECK_INTERVAL = 5.0
+
+    def __init__(self, registry, lead=LEAD, attempts=ATTEMPTS, retry=RETRY, rate=RATE, burst=BURST,
+                 clock=time.time):
+        """RefreshScheduler constructor
+
+        Args:
+            :param registry: registry.DeviceRegistry of the devices to refresh
+            :param lead: seconds before the expiry an entry is asked for
+            :param attempts: searches sent for an entry that doesn't answer
+            :param retry: seconds between these searches
+            :param rate: searches per second
+            :param burst: searches sent in a burst before the rate applies
+            :param clock: callable returning the current time in seconds
+        """
+        self.registry = registry
+        self.lead = lead
+        self.attempts = attempts
+        self.retry = retry
+        self.clock = clock
+        self.bucket = TokenBucket(rate, burst, clock())
+        self.sent = self.throttled = 0
+        # usn -> (expiry when asked, attempts, next attempt time)
+        self._asked = {}
+        self._next_check = 0.0
+
+    def due(self, now=None):
+        """Registry entries to search now, earliest expiry first
+
+        Returns:
+            List of registry.DeviceEntry
+        """
+        now = self.clock() if now is None else now
+        if now < self._next_check:
+            return []
+        self._next_check = now + self.CHECK_INTERVAL
+        asked = {}
+        ready = []
+        throttled = False
+        for entry in self.registry.expiring(now + self.lead):
+            if entry.expires - now > min(self.lead, entry.max_age * self.LEAD_RATIO):
+                continue
+            state = self._asked.get(entry.usn)
+            attempts = 0
+            if state is not None and state[0] == entry.expires:
+                # Nothing heard since it was asked
+                attempts = state[1]
+                if attempts >= self.attempts or now < state[2]:
+                    asked[entry.usn] = state
+                    continue
+            if throttled or not self.bucket.consume(now):
+                if not throttled:
+                    throttled = True
+                    self.throttled += 1
+                    self._next_check = now + self.bucket.delay(now)
+                if state is not None:
+                    asked[entry.usn] = state
+                continue
+            asked[entry.usn] = (entry.expires, attempts + 1, now + self.retry)
+            ready.append(entry)
+        # Entries refreshed, removed or expired are forgotten
+        self._asked = asked
+        self.sent += len(ready)
+        return ready
+
+    def next_due(self, now=None):
+        """Seconds until the next check, None if the registry is empty"""
+        if not len(self.registry):
+            return None
+        now = self.clock() if now is None else now
+        return max(0.0, self._next_check - now)
+
+    def stats(self):
+        """Snapshot of the scheduler counters"""
+        return {'asked': len(self._asked), 'sent': self.sent, 'throttled': self.throttled}
@@ -0,0 +1,958 @@
+# -*- coding: utf-8 -*-
+"""Service Location Protocol version 2, user and service agent
+    - https://tools.ietf.org/html/rfc2608
+
+Binary codec for SrvRqst, SrvRply, SrvReg, SrvAck, DAAdvert and SAAdvert, and an
+agent that finds services (UA) and answers for the registered ones (SA). Without a
+Directory Agent requests are multicast to 239.255.255.253:427 until they converge,
+once a DA is known for the scopes they are sent to it by unicast instead.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import re
+import time
+import heapq
+import random
+import struct
+import fnmatch
+import logging
+import itertools
+import threading
+from collections import namedtuple
+from .registry import DeviceRegistry, DiscoveryEvent
+from .delivery import DeliveryQueue, DROP_OLDEST
+from .metrics import METRICS
+from .networking import DatagramSocket, SocketSelector, InterfaceTable, ProtocolError, \
+    MulticastException, UnicastException, JoinGroupError, NetworkConfigurationError
+
+MULTICAST_GROUP = '239.255.255.253'
+MULTICAST_PORT = 427
+VERSION = 2
+# Function ids
+SRV_RQST = 1
+SRV_RPLY = 2
+SRV_REG = 3
+SRV_ACK = 5
+DA_ADVERT = 8
+SA_ADVERT = 11
+# Header flags
+FLAG_OVERFLOW = 0x8000
+FLAG_FRESH = 0x4000
+FLAG_MCAST = 0x2000
+# Error codes
+OK = 0
+PARSE_ERROR = 2
+SCOPE_NOT_SUPPORTED = 4
+INTERNAL_ERROR = 10
+DEFAULT_SCOPE = 'DEFAULT'
+DIRECTORY_AGENT = 'service:directory-agent'
+SERVICE_AGENT = 'service:service-agent'
+# Datagrams are kept under the path MTU, larger replies set FLAG_OVERFLOW
+MAX_DATAGRAM = 1400
+MAX_LIFETIME = 0xffff
+# Nested predicate filters evaluated, deeper ones come from a broken or hostile peer
+MAX_PREDICATE_DEPTH = 32
+
+_HEADER = struct.Struct('!BB3sH3sHH')
+_SHORT = struct.Struct('!H')
+_LONG = struct.Struct('!L')
+
+# url_entry lifetime is in seconds, what's left of it when read from the cache
+URLEntry = namedtuple('url_entry', ('url', 'lifetime'))
+ServiceRequest = namedtuple('service_request', ('previous_responders', 'service_type', 'scopes', 'predicate'))
+ServiceReply = namedtuple('service_reply', ('error', 'entries'))
+ServiceRegistration = namedtuple('service_registration', ('entry', 'service_type', 'scopes', 'attributes'))
+ServiceAck = namedtuple('service_ack', ('error',))
+DAAdvert = namedtuple('da_advert', ('error', 'boot_timestamp', 'url', 'scopes', 'attributes'))
+SAAdvert = namedtuple('sa_advert', ('url', 'scopes', 'attributes'))
+
+_FUNCTIONS = {ServiceRequest: SRV_RQST, ServiceReply: SRV_RPLY, ServiceRegistration: SRV_REG,
+              ServiceAck: SRV_ACK, DAAdvert: DA_ADVERT, SAAdvert: SA_ADVERT}
+
+
+class SLPError(ProtocolError):
+    """Malformed SLP message or predicate"""
+    pass
+
+
+class SLPMessage(object):
+    """SLPv2 message, a header and one of the body namedtuples (i.e. ServiceRequest)
+
+    Attributes:
+        body - ServiceRequest, ServiceReply, ServiceRegistration, ServiceAck, DAAdvert or SAAdvert
+        xid - transaction id, replies carry the request one
+        flags - header flags, see FLAG_MCAST
+        lang - language tag
+    """
+
+    __slots__ = ('body', 'xid', 'flags', 'lang')
+
+    def __init__(self, body, xid=0, flags=0, lang='en'):
+        self.body = body
+        self.xid = xid
+        self.flags = flags
+        self.lang = lang
+
+    @property
+    def function(self):
+        return _FUNCTIONS[type(self.body)]
+
+    def __repr__(self):
+        return '<SLPMessage xid {} {!r}>'.format(self.xid, self.body)
+
+
+def service_type_of(url):
+    """Service type of a 'service:' URL, i.e. service:printer:lpr://host -> service:printer:lpr"""
+    return url.split('://', 1)[0].lower()
+
+
+def _string(value):
+    data = value.encode('utf-8')
+    if len(data) > 0xffff:
+        raise SLPError('String longer than 65535 bytes')
+    return _SHORT.pack(len(data)) + data
+
+
+def _list(values):
+    return _string(','.join(values))
+
+
+def _url_entry(entry):
+    return b'\0' + _SHORT.pack(min(max(int(entry.lifetime), 0), MAX_LIFETIME)) + _string(entry.url) + b'\0'
+
+
+def encode(message):
+    """SLPMessage to bytes
+
+    Raises:
+        SLPError - unknown body or values out of range
+    """
+    body = message.body
+    try:
+        if isinstance(body, ServiceRequest):
+            payload = (_list(body.previous_responders) + _string(body.service_type) + _list(body.scopes) +
+                       _string(body.predicate) + _string(''))
+        elif isinstance(body, ServiceReply):
+            payload = _SHORT.pack(body.error) + _SHORT.pack(len(body.entries)) + \
+                b''.join(_url_entry(entry) for entry in body.entries)
+        elif isinstance(body, ServiceRegistration):
+            payload = (_url_entry(body.entry) + _string(body.service_type) + _list(body.scopes) +
+                       _string(body.attributes) + b'\0')
+        elif isinstance(body, ServiceAck):
+            payload = _SHORT.pack(body.error)
+        elif isinstance(body, DAAdvert):
+            payload = (_SHORT.pack(body.error) + _LONG.pack(body.boot_timestamp) + _string(body.url) +
+                       _list(body.scopes) + _string(body.attributes) + _string('') + b'\0')
+        elif isinstance(body, SAAdvert):
+            payload = _string(body.url) + _list(body.scopes) + _string(body.attributes) + b'\0'
+        else:
+            raise SLPError('Cannot encode {!r}'.format(body))
+        lang = message.lang.encode('ascii')
+        length = _HEADER.size + len(lang) + len(payload)
+        header = _HEADER.pack(VERSION, message.function, struct.pack('!L', length)[1:], message.flags,
+                              b'\0\0\0', message.xid, len(lang))
+    except (struct.error, TypeError, ValueError, AttributeError, UnicodeError) as error:
+        raise SLPError('Cannot encode {}: {}'.format(message, error))
+    return header + lang + payload
+
+
+class _Reader(object):
+    """Bounds checked reads over a message"""
+
+    __slots__ = ('data', 'offset', 'end')
+
+    def __init__(self, data, offset, end):
+        self.data = data
+        self.offset = offset
+        self.end = end
+
+    def take(self, size):
+        start = self.offset
+        if start + size > self.end:
+            raise SLPError('Message truncated')
+        self.offset += size
+        return self.data[start:self.offset]
+
+    def byte(self):
+        return bytearray(self.take(1))[0]
+
+    def short(self):
+        return _SHORT.unpack(self.take(2))[0]
+
+    def long(self):
+        return _LONG.unpack(self.take(4))[0]
+
+    def string(self):
+        try:
+            return self.take(self.short()).decode('utf-8')
+        except UnicodeError:
+            raise SLPError('Invalid UTF-8 string')
+
+    def list(self):
+        return tuple(item.strip() for item in self.string().split(',') if item.strip())
+
+    def auths(self):
+        """Skips the authentication blocks, they're not verified"""
+        for _ in range(self.byte()):
+            self.take(2)
+            length = self.short()
+            if length < 4:
+                raise SLPError('Invalid authentication block')
+            self.take(length - 4)
+
+    def url_entry(self):
+        self.take(1)
+        lifetime = self.short()
+        url = self.string()
+        self.auths()
+        return URLEntry(url, lifetime)
+
+
+def decode(data):
+    """Bytes to SLPMessage
+
+    Raises:
+        SLPError - malformed message, other versions or unsupported functions
+    """
+    data = data.tobytes() if isinstance(data, memoryview) else bytes(data)
+    if len(data) < _HEADER.size:
+        raise SLPError('Message shorter than the header')
+    version, function, length, flags, _, xid, lang_length = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise SLPError('Unsupported SLP version {}'.format(version))
+    length = _LONG.unpack(b'\0' + length)[0]
+    if length > len(data):
+        raise SLPError('Message truncated')
+    reader = _Reader(data, _HEADER.size, length)
+    try:
+        lang = reader.take(lang_length).decode('ascii')
+    except UnicodeError:
+        raise SLPError('Invalid language tag')
+    if function == SRV_RQST:
+        body = ServiceRequest(reader.list(), reader.string(), reader.list(), reader.string())
+    elif function == SRV_RPLY:
+        error = reader.short()
+        # Errors may come without the entry count
+        count = reader.short() if reader.offset < reader.end else 0
+        body = ServiceReply(error, [reader.url_entry() for _ in range(count)])
+    elif function == SRV_REG:
+        entry = reader.url_entry()
+        body = ServiceRegistration(entry, reader.string(), reader.list(), reader.string())
+    elif function == SRV_ACK:
+        body = ServiceAck(reader.short())
+    elif function == DA_ADVERT:
+        body = DAAdvert(reader.short(), reader.long(), reader.string(), reader.list(), reader.string())
+    elif function == SA_ADVERT:
+        body = SAAdvert(reader.string(), reader.list(), reader.string())
+    else:
+        raise SLPError('Unsupported function {}'.format(function))
+    return SLPMessage(body, xid, flags, lang)
+
+
+_ESCAPE = re.compile(r'\\([0-9a-fA-F]{2})')
+_COMPARISON = re.compile(r'\s*([^=<>~()]+?)\s*(~=|>=|<=|=)(.*)$', re.S)
+
+
+def _unescape(value):
+    return _ESCAPE.sub(lambda match: chr(int(match.group(1), 16)), value).strip()
+
+
+def parse_attributes(text):
+    """Attribute list to a dict, '(a=1,2),(b=x),flag' -> {'a': ['1', '2'], 'b': ['x'], 'flag': True}"""
+    attributes = {}
+    depth = 0
+    item = []
+    for char in text + ',':
+        if char == ',' and depth == 0:
+            item = ''.join(item).strip()
+            if item.startswith('(') and item.endswith(')'):
+                name, _, values = item[1:-1].partition('=')
+                attributes[_unescape(name).lower()] = [_unescape(value) for value in values.split(',')]
+            elif item:
+                attributes[_unescape(item).lower()] = True
+            item = []
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        item.append(char)
+    return attributes
+
+
+def _compare(item, attributes):
+    match = _COMPARISON.match(item)
+    if match is None:
+        raise SLPError('Invalid predicate comparison {!r}'.format(item))
+    name, operator, wanted = match.group(1).lower(), match.group(2), _unescape(match.group(3))
+    values = attributes.get(name)
+    if values is None:
+        return False
+    if operator == '=' and wanted == '*':
+        return True
+    if values is True:
+        return False
+    wanted = wanted.lower()
+    for value in values:
+        value = value.lower()
+        if operator == '=' and fnmatch.fnmatchcase(value, wanted):
+            return True
+        if operator == '~=' and ' '.join(value.split()) == ' '.join(wanted.split()):
+            return True
+        if operator in ('>=', '<='):
+            try:
+                left, right = int(value), int(wanted)
+            except ValueError:
+                left, right = value, wanted
+            if (left >= right) if operator == '>=' else (left <= right):
+                return True
+    return False
+
+
+def _filter(text, position, attributes, depth=0):
+    """Evaluates the LDAPv3 filter at position, returns (result, position after it)"""
+    if text[position:position + 1] != '(':
+        raise SLPError('Predicate filter must start with (')
+    if depth >= MAX_PREDICATE_DEPTH:
+        raise SLPError('Predicate nested deeper than {} filters'.format(MAX_PREDICATE_DEPTH))
+    position += 1
+    operator = text[position:position + 1]
+    if operator in ('&', '|'):
+        results = []
+        position += 1
+        while text[position:position + 1] == '(':
+            result, position = _filter(text, position, attributes, depth + 1)
+            results.append(result)
+        if not results:
+            raise SLPError('Empty predicate filter list')
+        result = all(results) if operator == '&' else any(results)
+    elif operator == '!':
+        result, position = _filter(text, position + 1, attributes, depth + 1)
+        result = not result
+    else:
+        end = text.find(')', position)
+        if end < 0:
+            raise SLPError('Unbalanced predicate')
+        result = _compare(text[position:end], attributes)
+        position = end
+    if text[position:position + 1] != ')':
+        raise SLPError('Unbalanced predicate')
+    return result, position + 1
+
+
+def matches(predicate, attributes):
+    """True if the attributes dict (see parse_attributes) satisfies an LDAPv3 predicate
+
+    Raises:
+        SLPError - invalid predicate or nested deeper than MAX_PREDICATE_DEPTH
+    """
+    predicate = predicate.strip()
+    if not predicate:
+        return True
+    result, end = _filter(predicate, 0, attributes)
+    if end != len(predicate):
+        raise SLPError('Trailing data after the predicate')
+    return result
+
+
+def _scopes(scopes):
+    return tuple(sorted(scope.lower() for scope in scopes))
+
+
+class CachedService(object):
+    """A service URL on the ServiceCache
+
+    Attributes:
+        url - service URL
+        service_type - service type it was found with
+        scopes - lower case scopes it was found on
+        expires - time.time() based expiry, from the URL lifetime
+    """
+
+    __slots__ = ('url', 'service_type', 'scopes', 'expires')
+
+    def __init__(self, url, service_type, scopes, expires):
+        self.url = url
+        self.service_type = service_type
+        self.scopes = scopes
+        self.expires = expires
+
+    def __repr__(self):
+        return '<CachedService {} expires {:.0f}>'.format(self.url, self.expires)
+
+
+class ServiceCache(object):
+    """Service URLs found by the lookups, expired with their lifetimes
+
+    Each lookup (service type, scopes and predicate) keeps the URLs it found while all
+    of them are alive, so repeating it doesn't send anything on the network.
+
+    Note:
+        Thread safe, the agent fills it while callers of SLPDaemon.find read it.
+    """
+
+    # Seconds an empty lookup result is trusted
+    NEGATIVE_LIFETIME = 30.0
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.RLock()
+        # url -> CachedService
+        self._services = {}
+        # lookup key -> (urls, fresh until)
+        self._lookups = {}
+        # (expires, sequence, url)
+        self._expiries = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._services)
+
+    def add(self, entry, service_type, scopes, now=None):
+        """Caches a URL entry
+
+        Returns:
+            DiscoveryEvent(ADDED, CachedService) for a new URL, None on refreshes
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            service = self._services.get(entry.url)
+            expires = now + entry.lifetime
+            if service is not None:
+                service.expires = expires
+                return None
+            service = self._services[entry.url] = CachedService(entry.url, service_type, scopes, expires)
+            heapq.heappush(self._expiries, (expires, next(self._sequence), entry.url))
+            return DiscoveryEvent(DeviceRegistry.ADDED, service)
+
+    def store(self, key, urls, now=None):
+        """Records the result of a finished lookup"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            expiries = [self._services[url].expires for url in urls if url in self._services]
+            self._lookups[key] = (tuple(urls), min(expiries) if expiries else now + self.NEGATIVE_LIFETIME)
+
+    def lookup(self, key, now=None):
+        """URLEntry list of a lookup, None if it never ran or one of its URLs expired"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            result = self._lookups.get(key)
+            if result is None or result[1] <= now:
+                return None
+            return [URLEntry(url, int(self._services[url].expires - now)) for url in result[0]
+                    if url in self._services]
+
+    def expire(self, now=None):
+        """Drops the URLs whose lifetime elapsed
+
+        Returns:
+            List of DiscoveryEvent with action EXPIRED
+        """
+        now = self.clock() if now is None else now
+        events = []
+        with self._lock:
+            while self._expiries and self._expiries[0][0] <= now:
+                _, _, url = heapq.heappop(self._expiries)
+                service = self._services.get(url)
+                if service is None:
+                    continue
+                if service.expires > now:
+                    heapq.heappush(self._expiries, (service.expires, next(self._sequence), url))
+                    continue
+                del self._services[url]
+                events.append(DiscoveryEvent(DeviceRegistry.EXPIRED, service))
+            for key in [key for key, result in self._lookups.items() if result[1] <= now]:
+                del self._lookups[key]
+        return events
+
+    def next_expiry(self, now=None):
+        """Seconds until the next URL expires, None if the cache is empty"""
+        with self._lock:
+            if not self._expiries:
+                return None
+            now = self.clock() if now is None else now
+            return max(0.0, self._expiries[0][0] - now)
+
+    def services(self):
+        """Every cached CachedService"""
+        with self._lock:
+            return list(self._services.values())
+
+
+class DirectoryAgent(object):
+    """A Directory Agent learnt from its DAAdvert"""
+
+    __slots__ = ('address', 'url', 'scopes', 'boot_timestamp', 'seen')
+
+    def __init__(self, address, url, scopes, boot_timestamp, seen):
+        self.address = address
+        self.url = url
+        self.scopes = scopes
+        self.boot_timestamp = boot_timestamp
+        self.seen = seen
+
+    def serves(self, scopes):
+        return all(scope in self.scopes for scope in scopes)
+
+    def __repr__(self):
+        return '<DirectoryAgent {} scopes {}>'.format(self.url, ','.join(self.scopes))
+
+
+class _Registration(object):
+    """A service advertised by the SA"""
+
+    __slots__ = ('url', 'service_type', 'scopes', 'attributes', 'parsed', 'lifetime', 'registered')
+
+    def __init__(self, url, service_type, scopes, attributes, lifetime, registered):
+        self.url = url
+        self.service_type = service_type
+        self.scopes = scopes
+        self.attributes = attributes
+        self.parsed = parse_attributes(attributes)
+        self.lifetime = lifetime
+        self.registered = registered
+
+    def entry(self, now):
+        return URLEntry(self.url, max(0, int(self.registered + self.lifetime - now)))
+
+
+class _Lookup(object):
+    """A SrvRqst in flight, multicast convergence or unicast to a DA"""
+
+    __slots__ = ('key', 'request', 'xid', 'entries', 'responders', 'directory', 'attempts', 'interval',
+                 'due', 'deadline', 'new', 'done')
+
+    def __init__(self, key, request, xid, due, deadline):
+        self.key = key
+        self.request = request
+        self.xid = xid
+        # url -> URLEntry
+        self.entries = {}
+        self.responders = set()
+        self.directory = None
+        self.attempts = 0
+        self.interval = 0
+        self.due = due
+        self.deadline = deadline
+        self.new = False
+        self.done = threading.Event()
+
+
+class SLPDaemon(threading.Thread):
+    """SLPv2 User Agent and Service Agent
+
+    Find services with find(service_type), it blocks until the lookup converges and
+    returns URLEntry items, advertise them with register_service. New and expired URLs
+    also go to services_out_q as DiscoveryEvent(action, CachedService).
+
+    Flow:
+        UA                  Multicast Group(239.255.255.253:427)                  SA
+         |-- SrvRqst (PRList: empty) ---------->|--------------------------------->|
+         |<------------------------------------------------ SrvRply (unicast) -----|
+         |-- SrvRqst (PRList: SA) ------------->|   SA is on PRList, stays quiet   |
+         |   no new replies, lookup converged
+
+        With a DA (learnt from a DAAdvert) for the scopes:
+         |-- SrvRqst (unicast) --> DA --> SrvRply, SAs register with SrvReg --> DA
+
+    Note:
+        Binding port 427 needs root on most systems. Overflowed replies are not
+        retried over TCP and authentication blocks are ignored.
+    """
+
+    # Multicast convergence, CONFIG_MC_MAX of RFC 2608 13
+    MULTICAST_WAIT = 0.5
+    MULTICAST_MAX = 15.0
+    # Unicast retries to a DA before falling back to multicast, CONFIG_RETRY
+    DIRECTORY_WAIT = 2.0
+    DIRECTORY_ATTEMPTS = 3
+    # Active DA discovery delay after start, CONFIG_START_WAIT
+    START_WAIT = 3.0
+    # Seconds between two attempts to join the group again after a failure
+    REJOIN_RETRY = 10.0
+
+    def __init__(self, scopes=(DEFAULT_SCOPE,), logger_name='SLP Agent', interface=None, address=None,
+                 queue_size=0, overflow_policy=DROP_OLDEST, metrics=None):
+        """Creates an SLPDaemon agent
+
+        Args:
+            :param scopes: scopes used by find and register_service by default
+            :param logger_name: String logger name, default: 'SLP Agent'.
+            :param interface: local IPv4 address of the interface to use, default is INADDR_ANY
+            :param address: address put on the SAAdvert URL, default is the default route address
+            :param queue_size: max pending items on services_out_q, default 0 is unbounded
+            :param overflow_policy: what a full services_out_q does, see delivery.DeliveryQueue
+            :param metrics: metrics.MetricsRegistry for the daemon metrics, default is the shared one
+
+        Raises:
+            JoinGroupError - Socket level errors for multicast will be raised on the instantiation
+        """
+        self.logging = logging.getLogger(logger_name)
+        self.scopes = tuple(scopes)
+        self.interfaces = InterfaceTable.get_instance()
+        self.address = address or interface
+        self.cache = ServiceCache()
+        self.services_out_q = DeliveryQueue(queue_size, overflow_policy)
+        # address -> DirectoryAgent
+        self.directory_agents = {}
+        self.uniform = random.uniform
+        self._lock = threading.RLock()
+        self._xid = itertools.count(random.randint(1, 0x7fff))
+        # lookup key -> _Lookup, xid -> _Lookup
+        self._lookups = {}
+        self._by_xid = {}
+        # url -> _Registration
+        self._services = {}
+        labels = {'daemon': logger_name}
+        metrics = metrics or METRICS
+        self._multicast_sent = metrics.counter('snf_slp_requests_sent_total', 'SrvRqst sent', mode='multicast',
+                                               **labels)
+        self._directory_sent = metrics.counter('snf_slp_requests_sent_total', 'SrvRqst sent', mode='directory',
+                                               **labels)
+        self._cache_hits = metrics.counter('snf_slp_cache_hits_total', 'Lookups answered from the cache', **labels)
+        self._invalid = metrics.counter('snf_slp_invalid_total', 'Datagrams that are not valid SLPv2', **labels)
+        self.__is_running = True
+        # time.time() when the group membership is renewed by the daemon thread, see rejoin
+        self._rejoin_at = None
+        # Selector and wake-up pair of this daemon's sockets only
+        self._selector = SocketSelector.new_key(SLPDaemon.__name__)
+        self.client = DatagramSocket(socket_type=DatagramSocket.CLIENT,
+                                     implemented_protocol=SLPDaemon.__name__,
+                                     selector=self._selector,
+                                     logger_name=logger_name,
+                                     group=MULTICAST_GROUP,
+                                     port=MULTICAST_PORT,
+                                     ttl=1,
+                                     recv_size=8192,
+                                     interface=interface)
+        self.server = DatagramSocket(socket_type=DatagramSocket.SERVER,
+                                     implemented_protocol=SLPDaemon.__name__,
+                                     selector=self._selector,
+                                     logger_name=logger_name,
+                                     group=MULTICAST_GROUP,
+                                     port=MULTICAST_PORT,
+                                     ttl=1,
+                                     recv_size=8192,
+                                     interface=interface)
+        self.client.handler = lambda: self.handle_datagrams(self.client)
+        self.server.handler = lambda: self.handle_datagrams(self.server)
+        self.interfaces.subscribe(self.on_interfaces_changed)
+        threading.Thread.__init__(self, name=logger_name)
+        self.daemon = True
+
+    # User Agent
+
+    def find(self, service_type, scopes=None, predicate='', timeout=None, fresh=False):
+        """Finds the services of a type, from the cache while the previous result is alive
+
+        Must not be called from the daemon thread, it waits for the lookup to finish.
+
+        Args:
+            :param service_type: i.e. 'service:printer' (matches service:printer:lpr too)
+            :param scopes: scopes to look on, default is the daemon scopes
+            :param predicate: LDAPv3 filter on the attributes, i.e. '(location=3rd floor)'
+            :param timeout: max seconds to wait, the URLs found so far are returned
+            :param fresh: ignore the cache and send a new request
+
+        Returns:
+            List of URLEntry
+        """
+        scopes = tuple(scopes or self.scopes)
+        key = (service_type.lower(), _scopes(scopes), predicate)
+        if not fresh:
+            cached = self.cache.lookup(key)
+            if cached is not None:
+                self._cache_hits.value += 1
+                return cached
+        with self._lock:
+            lookup = self._lookups.get(key)
+            if lookup is None:
+                lookup = self._start_lookup(key, ServiceRequest((), service_type, scopes, predicate))
+        SocketSelector.wakeup(self._selector)
+        lookup.done.wait(timeout)
+        if lookup.done.is_set():
+            cached = self.cache.lookup(key)
+            if cached is not None:
+                return cached
+        return list(lookup.entries.values())
+
+    def _start_lookup(self, key, request, delay=0.0):
+        now = time.time()
+        lookup = _Lookup(key, request, next(self._xid) & 0xffff, now + delay, now + delay + self.MULTICAST_MAX)
+        if request.service_type != DIRECTORY_AGENT:
+            agent = self._directory_for(key[1])
+            if agent is not None:
+                lookup.directory = agent.address
+        self._lookups[key] = lookup
+        self._by_xid[lookup.xid] = lookup
+        return lookup
+
+    def _directory_for(self, scopes):
+        for agent in self.directory_agents.values():
+            if agent.serves(scopes):
+                return agent
+        return None
+
+    def _advance(self, lookup, now):
+        """Sends the next request of a lookup or finishes it"""
+        request = lookup.request
+        if lookup.directory is not None:
+            if lookup.attempts >= self.DIRECTORY_ATTEMPTS:
+                self.logging.warning('Directory Agent {} is not answering'.format(lookup.directory))
+                self.directory_agents.pop(lookup.directory, None)
+                lookup.directory = None
+                lookup.attempts = 0
+                lookup.deadline = now + self.MULTICAST_MAX
+            else:
+                self._send(self.client, SLPMessage(request, lookup.xid), (lookup.directory, MULTICAST_PORT))
+                self._directory_sent.value += 1
+                lookup.due = now + self.DIRECTORY_WAIT * 2 ** lookup.attempts
+                lookup.attempts += 1
+                return
+        # Converged once a retransmission brought nothing new
+        if (lookup.attempts > 1 and not lookup.new) or now >= lookup.deadline:
+            self._finish(lookup, now)
+            return
+        request = request._replace(previous_responders=tuple(sorted(lookup.responders)))
+        message = SLPMessage(request, lookup.xid, FLAG_MCAST)
+        if len(encode(message)) > MAX_DATAGRAM:
+            # The previous responder list doesn't fit anymore
+            self._finish(lookup, now)
+            return
+        self._send(self.client, message, (MULTICAST_GROUP, MULTICAST_PORT))
+        self._multicast_sent.value += 1
+        lookup.interval = lookup.interval * 2 if lookup.interval else self.MULTICAST_WAIT
+        lookup.due = min(now + lookup.interval, lookup.deadline)
+        lookup.attempts += 1
+        lookup.new = False
+
+    def _finish(self, lookup, now):
+        self._lookups.pop(lookup.key, None)
+        self._by_xid.pop(lookup.xid, None)
+        if lookup.request.service_type != DIRECTORY_AGENT:
+            self.cache.store(lookup.key, list(lookup.entries), now)
+        lookup.done.set()
+
+    def handle_reply(self, message, host):
+        """SrvRply of a lookup, from a SA or a DA"""
+        reply = message.body
+        now = time.time()
+        with self._lock:
+            lookup = self._by_xid.get(message.xid)
+            if lookup is None:
+                return
+            if reply.error != OK:
+                self.logging.debug('SrvRply error {} from {}'.format(reply.error, host))
+                if lookup.directory == host:
+                    # i.e. SCOPE_NOT_SUPPORTED, ask the SAs instead
+                    lookup.directory = None
+                    lookup.attempts = 0
+                    lookup.due = now
+                return
+            lookup.responders.add(host)
+            for entry in reply.entries:
+                if entry.url not in lookup.entries:
+                    lookup.new = True
+                lookup.entries[entry.url] = entry
+                event = self.cache.add(entry, lookup.key[0], lookup.key[1], now)
+                if event is not None:
+                    self.services_out_q.put(event)
+            if lookup.directory == host:
+                self._finish(lookup, now)
+
+    def handle_directory_advert(self, message, host):
+        """DAAdvert, unsolicited or answering the active DA discovery"""
+        advert = message.body
+        with self._lock:
+            lookup = self._by_xid.get(message.xid) if message.xid else None
+            if lookup is not None and host not in lookup.responders:
+                lookup.responders.add(host)
+                lookup.new = True
+            if advert.error != OK:
+                return
+            known = self.directory_agents.get(host)
+            if advert.boot_timestamp == 0:
+                if known is not None:
+                    self.logging.info('Directory Agent {} is going down'.format(advert.url))
+                    del self.directory_agents[host]
+                return
+            scopes = _scopes(advert.scopes)
+            self.directory_agents[host] = DirectoryAgent(host, advert.url, scopes, advert.boot_timestamp, time.time())
+            if known is None or known.boot_timestamp != advert.boot_timestamp:
+                self.logging.info('Directory Agent {} found, scopes {}'.format(advert.url, ','.join(scopes)))
+                self._register_all(self.directory_agents[host], time.time())
+
+    # Service Agent
+
+    def register_service(self, url, service_type=None, attributes='', lifetime=10800, scopes=None):
+        """Advertises a service URL until unregister_service or its lifetime elapses
+
+        Args:
+            :param url: i.e. 'service:printer:lpr://192.0.2.10/queue'
+            :param service_type: default is taken from a 'service:' URL
+            :param attributes: attribute list, i.e. '(location=3rd floor),(color=true)'
+            :param lifetime: seconds, up to 65535
+            :param scopes: default is the daemon scopes
+        """
+        now = time.time()
+        registration = _Registration(url, (service_type or service_type_of(url)).lower(),
+                                     _scopes(scopes or self.scopes), attributes, min(lifetime, MAX_LIFETIME), now)
+        parse_attributes(attributes)
+        with self._lock:
+            self._services[url] = registration
+            for agent in self.directory_agents.values():
+                self._register(agent, registration, now)
+
+    def unregister_service(self, url):
+        """Stops answering for a service URL, DAs keep it until its lifetime elapses"""
+        with self._lock:
+            self._services.pop(url, None)
+
+    def _register_all(self, agent, now):
+        for registration in self._services.values():
+            self._register(agent, registration, now)
+
+    def _register(self, agent, registration, now):
+        if not any(scope in agent.scopes for scope in registration.scopes):
+            return
+        body = ServiceRegistration(registration.entry(now), registration.service_type,
+                                   registration.scopes, registration.attributes)
+        self._send(self.client, SLPMessage(body, next(self._xid) & 0xffff, FLAG_FRESH),
+                   (agent.address, MULTICAST_PORT))
+
+    def handle_request(self, message, host, port):
+        """SrvRqst for our services, or for service-agent adverts"""
+        request = message.body
+        multicast = bool(message.flags & FLAG_MCAST)
+        if any(self.interfaces.is_local(responder) for responder in request.previous_responders) or \
+                request.service_type.lower() == DIRECTORY_AGENT:
+            return
+        now = time.time()
+        scopes = _scopes(request.scopes)
+        with self._lock:
+            services = list(self._services.values())
+        ours = set(scope for service in services for scope in service.scopes) | set(_scopes(self.scopes))
+        if not any(scope in ours for scope in scopes):
+            if not multicast:
+                self._send(self.server, SLPMessage(ServiceReply(SCOPE_NOT_SUPPORTED, []), message.xid), (host, port))
+            return
+        if request.service_type.lower() == SERVICE_AGENT:
+            try:
+                address = self.address or self.interfaces.host_address()
+            except NetworkConfigurationError as error:
+                # No default route, the requester can't be told where we are
+                self.logging.warning('Cannot answer {}:{}: {}'.format(host, port, error))
+                return
+            body = SAAdvert('{}://{}'.format(SERVICE_AGENT, address), self.scopes, '')
+            self._send(self.server, SLPMessage(body, message.xid), (host, port))
+            return
+        wanted = request.service_type.lower()
+        try:
+            entries = [service.entry(now) for service in services
+                       if (service.service_type == wanted or service.service_type.startswith(wanted + ':')) and
+                       any(scope in service.scopes for scope in scopes) and
+                       matches(request.predicate, service.parsed)]
+        except SLPError as error:
+            self.logging.debug('Invalid predicate from {}: {}'.format(host, error))
+            if not multicast:
+                self._send(self.server, SLPMessage(ServiceReply(PARSE_ERROR, []), message.xid), (host, port))
+            return
+        if not entries and multicast:
+            return
+        reply = SLPMessage(ServiceReply(OK, entries), message.xid)
+        while entries and len(encode(reply)) > MAX_DATAGRAM:
+            entries.pop()
+            reply.flags = FLAG_OVERFLOW
+        self._send(self.server, reply, (host, port))
+
+    # Network
+
+    def run(self):
+        """Overrides threading.Thread.run method, drives the lookups and expiries"""
+        self.logging.info('SLP agent started, scopes {}'.format(','.join(self.scopes)))
+        with self._lock:
+            # Active DA discovery
+            key = (DIRECTORY_AGENT, _scopes(self.scopes), '')
+            self._start_lookup(key, ServiceRequest((), DIRECTORY_AGENT, self.scopes, ''),
+                               self.uniform(0, self.START_WAIT))
+        while self.__is_running:
+            now = time.time()
+            with self._lock:
+                timers = [lookup.due for lookup in self._lookups.values()]
+            expiry = self.cache.next_expiry(now)
+            if expiry is not None:
+                timers.append(now + expiry)
+            if self._rejoin_at is not None:
+                timers.append(self._rejoin_at)
+            timeout = max(0.0, min(timers) - now) if timers else None
+            SocketSelector.dispatch(self._selector, timeout)
+            now = time.time()
+            if self._rejoin_at is not None and now >= self._rejoin_at:
+                self.rejoin()
+            with self._lock:
+                for lookup in [lookup for lookup in self._lookups.values() if lookup.due <= now]:
+                    self._advance(lookup, now)
+            for event in self.cache.expire(now):
+                self.services_out_q.put(event)
+
+    def handle_datagrams(self, sock):
+        """SocketSelector handler of both sockets"""
+        try:
+            packages = sock.recv_batch()
+        except UnicastException:
+            return
+        for package in packages:
+            try:
+                message = decode(package.data)
+            except SLPError as error:
+                self._invalid.value += 1
+                self.logging.debug('Invalid SLP message from {}:{}: {}'.format(package.host, package.port, error))
+                continue
+            body = message.body
+            if isinstance(body, ServiceRequest):
+                self.handle_request(message, package.host, package.port)
+            elif isinstance(body, ServiceReply):
+                self.handle_reply(message, package.host)
+            elif isinstance(body, DAAdvert):
+                self.handle_directory_advert(message, package.host)
+            elif isinstance(body, ServiceAck) and body.error != OK:
+                self.logging.warning('Registration refused by {}: error {}'.format(package.host, body.error))
+
+    def _send(self, sock, message, address):
+        try:
+            payload = encode(message)
+        except SLPError as error:
+            self.logging.error('Cannot encode {}: {}'.format(message, error))
+            return
+        try:
+            sock.send_batch([(payload, address)])
+        except MulticastException:
+            pass
+
+    def on_interfaces_changed(self, interfaces):
+        """InterfaceTable subscriber, the group membership is renewed by the daemon thread"""
+        self._rejoin_at = time.time()
+        SocketSelector.wakeup(self._selector)
+
+    def rejoin(self):
+        """Renews the group membership, reopening the listener if a join failed before"""
+        self._rejoin_at = None
+        try:
+            self.server.recover()
+        except (JoinGroupError, NetworkConfigurationError, MulticastException) as error:
+            self.logging.error('Cannot join {}, retrying in {}s: {}'.format(MULTICAST_GROUP, self.REJOIN_RETRY, error))
+            self._rejoin_at = time.time() + self.REJOIN_RETRY
+
+    def join(self, timeout=None):
+        """Stops the daemon, lookups in flight return what they found"""
+        self.__is_running = False
+        self.interfaces.unsubscribe(self.on_interfaces_changed)
+        SocketSelector.wakeup(self._selector)
+        if self.is_alive():
+            threading.Thread.join(self, timeout)
+        with self._lock:
+            for lookup in list(self._lookups.values()):
+                lookup.done.set()
+        self.logging.info('SLP Daemon stopped')
+        self.client.destroy()
+        self.server.destroy()
+        SocketSelector.release(self._selector)
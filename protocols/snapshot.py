@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""On-disk snapshot of the discovered devices, for a warm start
+
+The registry is saved as a compact binary file and loaded again at startup, so
+consumers see the network right away instead of waiting for full searches.
+
+Format (network byte order):
+    header  - magic 'SNFS', version, header name count, entry count, save time,
+              CRC32 of everything after the header
+    names   - the header names once, length prefixed UTF-8
+    entries - expiry (time.time() based), max-age and the headers of the entry as
+              (name index, length prefixed UTF-8 value) pairs
+
+Files are replaced atomically and read through mmap. Another version or a bad CRC
+is refused as a whole, there's no partial load.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import os
+import mmap
+import zlib
+import struct
+from .networking import ProtocolError, to_bytes
+
+MAGIC = b'SNFS'
+VERSION = 1
+
+_HEADER = struct.Struct('!4sHHIdI')
+_NAME = struct.Struct('!H')
+_ENTRY = struct.Struct('!dIH')
+_PAIR = struct.Struct('!HH')
+_MAX_VALUE = 0xffff
+
+_replace = getattr(os, 'replace', os.rename)
+try:
+    # Python 2 zlib only takes the old buffer interface, mmap has no memoryview there
+    _buffer = buffer
+except NameError:
+    _buffer = None
+
+
+class SnapshotError(ProtocolError):
+    """Snapshot file that can't be used, i.e. another version or corrupted"""
+    pass
+
+
+def _text(data):
+    # Header values are native strings, bytes on Python 2
+    return data if bytes is str else data.decode('utf-8', 'replace')
+
+
+def _checksum(data, offset):
+    """CRC32 of data (bytes or an mmap) from offset on, without copying it"""
+    if _buffer is not None:
+        return zlib.crc32(_buffer(data, offset)) & 0xffffffff
+    with memoryview(data) as view:
+        with view[offset:] as body:
+            return zlib.crc32(body) & 0xffffffff
+
+
+def encode(entries, saved_at):
+    """Snapshot bytes of registry entries
+
+    Args:
+        :param entries: iterable of registry.DeviceEntry
+        :param saved_at: time.time() of the snapshot
+    """
+    names = {}
+    body = bytearray()
+    count = 0
+    for entry in entries:
+        pairs = []
+        for name, value in entry.headers.items():
+            if value is None:
+                continue
+            value = to_bytes(value)
+            if len(value) > _MAX_VALUE:
+                continue
+            index = names.get(name)
+            if index is None:
+                index = names[name] = len(names)
+            pairs.append((index, value))
+        body += _ENTRY.pack(entry.expires, entry.max_age, len(pairs))
+        for index, value in pairs:
+            body += _PAIR.pack(index, len(value))
+            body += value
+        count += 1
+    table = bytearray()
+    for name in sorted(names, key=names.get):
+        name = to_bytes(name)
+        table += _NAME.pack(len(name))
+        table += name
+    payload = bytes(table + body)
+    return _HEADER.pack(MAGIC, VERSION, len(names), count, saved_at, zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def decode(data):
+    """Entries of snapshot bytes (or an mmap)
+
+    Returns:
+        (saved_at, list of (expires, max_age, headers dict))
+
+    Raises:
+        SnapshotError - not a snapshot, another version or corrupted
+    """
+    try:
+        magic, version, name_count, count, saved_at, crc = _HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise SnapshotError('Snapshot shorter than its header')
+    if magic != MAGIC:
+        raise SnapshotError('Not a snapshot file')
+    if version != VERSION:
+        raise SnapshotError('Unsupported snapshot version {}'.format(version))
+    if _checksum(data, _HEADER.size) != crc:
+        raise SnapshotError('Snapshot checksum mismatch')
+    offset = _HEADER.size
+    names = []
+    entries = []
+    try:
+        for _ in range(name_count):
+            length, = _NAME.unpack_from(data, offset)
+            offset += _NAME.size
+            names.append(_text(data[offset:offset + length]))
+            offset += length
+        for _ in range(count):
+            expires, age, pairs = _ENTRY.unpack_from(data, offset)
+            offset += _ENTRY.size
+            headers = {}
+            for _ in range(pairs):
+                index, length = _PAIR.unpack_from(data, offset)
+                offset += _PAIR.size
+                headers[names[index]] = _text(data[offset:offset + length])
+                offset += length
+            entries.append((expires, age, headers))
+    except (struct.error, IndexError):
+        raise SnapshotError('Truncated snapshot')
+    return saved_at, entries
+
+
+def save(path, entries, saved_at):
+    """Writes a snapshot, the previous file is replaced only once the new one is complete"""
+    data = encode(entries, saved_at)
+    temporary = '{}.tmp'.format(path)
+    with open(temporary, 'wb') as handle:
+        handle.write(data)
+        handle.flush()
+        os.fsync(handle.fileno())
+    _replace(temporary, path)
+    return len(data)
+
+
+def load(path, now):
+    """Reads a snapshot, dropping the entries whose max-age elapsed by now
+
+    Returns:
+        List of (expires, max_age, headers dict), empty if there's no snapshot file
+
+    Raises:
+        SnapshotError - see decode
+    """
+    try:
+        handle = open(path, 'rb')
+    except (IOError, OSError):
+        return []
+    with handle:
+        try:
+            view = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # Empty file
+            return []
+        try:
+            _, entries = decode(view)
+        finally:
+            view.close()
+    return [entry for entry in entries if entry[0] > now]
@@ -11,16 +11,31 @@ __version__ = '0.1'
 import os
 import re
 import platform
-from networking import get_host_address, UdpPackage
+from .networking import InterfaceTable, to_bytes, UdpPackage
 
 MULTICAST_GROUP = '239.255.255.250'
 MULTICAST_PORT = 1900
 MULTICAST_TTL = 4
 M_SEARCH = ['M-SEARCH * HTTP/1.1', 'HOST: 239.255.255.250:1900',
             'MAN: "ssdp:discover"', 'ST: {st}', 'MX: {mx}', 'USER-AGENT: {ua}', '', '']
-ANSWER_TARGET = ['HTTP/1.1 200 OK', 'CACHE-CONTROL: max-age=1800', 'EXT:',
-                 'LOCATION: http://{my_addr}', 'SERVER: {sys_name}',
+# UPnP 1.1 unicast M-SEARCH, sent to a known device, which answers right away (no MX)
+UNICAST_M_SEARCH = ['M-SEARCH * HTTP/1.1', 'HOST: {host}:{port}', 'MAN: "ssdp:discover"', 'ST: {st}',
+                    'USER-AGENT: {ua}', '', '']
+# parse_message limits, anything bigger is rejected before being parsed
+MAX_MESSAGE_SIZE = 8192
+MAX_HEADERS = 64
+_START_LINES = (b'M-SEARCH * HTTP/1.', b'NOTIFY * HTTP/1.', b'HTTP/1.')
+ANSWER_TARGET = ['HTTP/1.1 200 OK', 'CACHE-CONTROL: max-age={max_age}', 'EXT:',
+                 'LOCATION: {location}', 'SERVER: {sys_name}',
                  'ST: {search_target}', 'USN: {server_usn}', '', '']
+ALIVE = 'ssdp:alive'
+BYEBYE = 'ssdp:byebye'
+UPDATE = 'ssdp:update'
+NOTIFY_ALIVE = ['NOTIFY * HTTP/1.1', 'HOST: 239.255.255.250:1900', 'CACHE-CONTROL: max-age={max_age}',
+                'LOCATION: {location}', 'NT: {target}', 'NTS: ssdp:alive', 'SERVER: {sys_name}', 'USN: {usn}', '', '']
+NOTIFY_BYEBYE = ['NOTIFY * HTTP/1.1', 'HOST: 239.255.255.250:1900', 'NT: {target}', 'NTS: ssdp:byebye',
+                 'USN: {usn}', '', '']
+SYSTEM_NAME = platform.system() + ' ' + platform.release() + ' / ' + os.name.upper()
 
 
 def m_search(search_target, max_wait, user_agent):
@@ -37,6 +52,16 @@ def m_search(search_target, max_wait, user_agent):
     return msearch
 
 
+def m_search_unicast(search_target, host, port, user_agent):
+    """Unicast M-SEARCH for a device at host:port, see m_search
+
+    :return str: UPnP M-SEARCH message or empty string
+    """
+    if not is_valid_search_target(search_target):
+        return ""
+    return "\r\n".join(UNICAST_M_SEARCH).format(host=host, port=port, st=search_target, ua=user_agent)
+
+
 def answer(answer_type, search_target, server_identifier):
     """Builds the answer payload if a valid search for this target was readed
     on the multicast group
@@ -50,17 +75,123 @@ def answer(answer_type, search_target, server_identifier):
     :return str: UPnP HTTP 200 answer if correct parameters were provided
     """
     payload = ''
-    active_adress = get_host_address()
-    system_name = platform.system() + ' ' + platform.release() + ' / ' + os.name.upper()
-    if answer_type.lower() == 'service':
-        payload = "\r\n".join(ANSWER_TARGET).format(my_addr=active_adress, sys_name=system_name,
-                                                    search_target=search_target, server_usn=server_identifier)
-    elif answer_type.lower() == 'device':
-        payload = "\r\n".join(ANSWER_TARGET).format(my_addr=active_adress, sys_name=system_name,
-                                                    search_target=search_target, server_usn=server_identifier)
+    if answer_type.lower() in ('service', 'device'):
+        payload = _decode(_ANSWERS.render(search_target, server_identifier))
     return payload
 
 
+class AnswerBuilder(object):
+    """Pre-rendered HTTP 200 answers for M-SEARCH requests, and NOTIFY announcements
+
+    The answer for a given ST/USN pair only depends on the advertised address, so it's
+    rendered to bytes once and reused for every request until invalidated.
+
+    Note:
+        The cache is dropped automatically when networking.InterfaceTable reports an
+        address change, call invalidate when the advertised services change.
+    """
+
+    def __init__(self, interface_table=None, system_name=None):
+        """AnswerBuilder constructor
+
+        Args:
+            :param interface_table: networking.InterfaceTable, default is the shared one
+            :param system_name: SERVER header value, default is the running OS
+        """
+        self.interfaces = interface_table
+        self.system_name = system_name or SYSTEM_NAME
+        self._address = None
+        # (search_target, server_identifier, address) -> rendered answer
+        self._cache = {}
+
+    def invalidate(self, *_):
+        """Drops every pre-rendered answer, next render reads the host address again"""
+        self._cache = {}
+        self._address = None
+
+    def close(self):
+        """Stops listening to interface changes"""
+        if self.interfaces is not None:
+            self.interfaces.unsubscribe(self.invalidate)
+
+    def _bind(self):
+        """Reads the host address, and follows its changes, on first use after an invalidation"""
+        if self._address is None:
+            if self.interfaces is None:
+                # Bound lazily, importing this module must not touch the network
+                self.interfaces = InterfaceTable.get_instance()
+            self.interfaces.subscribe(self.invalidate)
+            self._address = self.interfaces.host_address()
+
+    def render(self, search_target, server_identifier, address=None, location=None, max_age=1800):
+        """Gets the answer for a search target
+
+        Args:
+            :param search_target: The search target (ST) flag you received from the socket
+            :param server_identifier: USN of the service or uuid:VALID_UUID of the device
+            :param address: LOCATION address, i.e. the interface the request arrived on,
+                default is the default route address
+            :param location: LOCATION URL, '{address}' is replaced by the address,
+                default is http://{address}
+            :param max_age: CACHE-CONTROL max-age in seconds
+
+        Raises:
+            NetworkConfigurationError - No address given and no default route to advertise
+
+        :return bytes: UPnP HTTP 200 answer
+        """
+        key = (search_target, server_identifier, address, location, max_age)
+        payload = self._cache.get(key)
+        if payload is None:
+            if address is None:
+                # Only the default address needs a default route
+                self._bind()
+                address = self._address
+            location = (location or 'http://{address}').format(address=address)
+            payload = self._cache[key] = to_bytes(
+                "\r\n".join(ANSWER_TARGET).format(location=location, sys_name=self.system_name, max_age=max_age,
+                                                   search_target=search_target, server_usn=server_identifier))
+        return payload
+
+    def render_notify(self, nts, target, usn, address=None, location=None, max_age=1800):
+        """Gets the NOTIFY announcement of an advertisement
+
+        Args:
+            :param nts: ALIVE or BYEBYE
+            :param target: notification type (NT), i.e. upnp:rootdevice
+            :param usn: unique service name of the advertisement
+            :param address: LOCATION address, default is the default route address
+            :param location: LOCATION URL, see render
+            :param max_age: CACHE-CONTROL max-age in seconds
+
+        Raises:
+            NetworkConfigurationError - No address given and no default route to advertise
+
+        :return bytes: NOTIFY message
+        """
+        if nts == BYEBYE:
+            key = (BYEBYE, target, usn)
+        else:
+            key = (ALIVE, target, usn, address, location, max_age)
+        payload = self._cache.get(key)
+        if payload is None:
+            if nts == BYEBYE:
+                payload = to_bytes("\r\n".join(NOTIFY_BYEBYE).format(target=target, usn=usn))
+            else:
+                if address is None:
+                    self._bind()
+                    address = self._address
+                location = (location or 'http://{address}').format(address=address)
+                payload = to_bytes("\r\n".join(NOTIFY_ALIVE).format(
+                    max_age=max_age, location=location, target=target, sys_name=self.system_name, usn=usn))
+            self._cache[key] = payload
+        return payload
+
+
+# Shared by upnp.answer
+_ANSWERS = AnswerBuilder()
+
+
 def is_valid_max_wait(mx):
     """ Maximum Wait time
 
@@ -112,6 +243,119 @@ def is_valid_search_target(search_target):
         return False
 
 
+class SSDPMessage(object):
+    """SSDP/HTTPU message with lazily decoded headers
+
+    Built by parse_message, only the start line is validated and the header values
+    are kept as raw bytes, a header value is decoded only when it's accessed.
+
+    Attributes:
+        method - M-SEARCH, NOTIFY or HTTP (for 200 OK responses)
+        host - sender host
+        port - sender port
+    """
+
+    __slots__ = ('method', 'host', 'port', '_headers')
+
+    def __init__(self, method, headers, host, port):
+        self.method = method
+        self.host = host
+        self.port = port
+        # Lower case header name -> raw value bytes
+        self._headers = headers
+
+    def __contains__(self, name):
+        return name in self._headers
+
+    def __getitem__(self, name):
+        return _decode(self._headers[name])
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __repr__(self):
+        return '<SSDPMessage {} from {}:{}>'.format(self.method, self.host, self.port)
+
+    def get(self, name, default=None):
+        """Gets a header value by its lower case name"""
+        if name in self._headers:
+            return self[name]
+        return default
+
+    def keys(self):
+        """Lower case names of the headers present on the message"""
+        return list(self._headers)
+
+    def to_dict(self):
+        """Decodes every header into the same dict format returned by parse"""
+        data = dict((name, self[name]) for name in self._headers)
+        # Gets the device/service UUID
+        if 'usn' in data and ':' in data['usn']:
+            key, value = data['usn'].split(':')[0:2]
+            data.update({key: value})
+        data.update({'sender': [self.host, self.port]})
+        return data
+
+
+def _decode(value):
+    """Header bytes to native string"""
+    if str is bytes:
+        return value
+    return value.decode('utf-8', 'replace')
+
+
+def parse_message(response):
+    """Single pass SSDP/HTTPU parser
+
+    Validates the start line (M-SEARCH, NOTIFY or HTTP 200 response) and splits the
+    header block once, values are not decoded, see SSDPMessage.
+
+    Args:
+        :param response: networking.UdpPackage received payload
+
+    Returns:
+        SSDPMessage or None for anything that's not a well formed SSDP message
+    """
+    if not isinstance(response, UdpPackage) or not response.host:
+        return None
+    raw = response.data
+    if isinstance(raw, memoryview):
+        # Zero-copy packages are only valid until the next receive
+        raw = raw.tobytes()
+    elif not isinstance(raw, bytes):
+        raw = raw.encode('utf-8')
+    if len(raw) > MAX_MESSAGE_SIZE:
+        return None
+    end = raw.find(b'\r\n')
+    if end < 0:
+        return None
+    start_line = raw[:end]
+    if start_line.startswith(_START_LINES[0]):
+        method = 'M-SEARCH'
+    elif start_line.startswith(_START_LINES[1]):
+        method = 'NOTIFY'
+    elif start_line.startswith(_START_LINES[2]) and start_line[9:12] == b'200':
+        method = 'HTTP'
+    else:
+        return None
+    head_end = raw.find(b'\r\n\r\n', end)
+    if head_end < 0:
+        # Headers must be terminated by CRLF
+        if not raw.endswith(b'\r\n'):
+            return None
+        head_end = len(raw) - 2
+    lines = raw[end + 2:head_end].split(b'\r\n') if head_end > end else ()
+    if len(lines) > MAX_HEADERS:
+        return None
+    headers = {}
+    for line in lines:
+        name, colon, value = line.partition(b':')
+        if not colon or not name:
+            return None
+        headers[_decode(name.strip().lower())] = value.strip()
+    return SSDPMessage(method, headers, response.host, response.port)
+
+
 def parse(response):
     """Simple HTTP-U parser
 
@@ -122,9 +366,16 @@ def parse(response):
     if not isinstance(response, UdpPackage):
         return {}
     if response.data and response.host and response.port:
+        payload = response.data
+        if isinstance(payload, memoryview):
+            # Zero-copy packages from DatagramSocket.recv_batch
+            payload = payload.tobytes()
+        if not isinstance(payload, str):
+            # Python 3 sockets deliver bytes
+            payload = payload.decode('utf-8', 'replace')
         # Parse HTTP Headers by Key/Value
-        data = dict(re.findall(r"(?P<name>.*?): (?P<value>.*?)\r\n", response.data))
-        data = dict((k.lower(), v) for k, v in data.iteritems())
+        data = dict(re.findall(r"(?P<name>.*?): (?P<value>.*?)\r\n", payload))
+        data = dict((k.lower(), v) for k, v in data.items())
         # Gets the device/service UUID
         if 'usn' in data.keys() and ':' in data['usn']:
             key, value = data['usn'].split(':')[0:2]
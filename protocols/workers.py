@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Multi-process SSDP responder
+
+A single SSDPDaemon thread is bound to one core by the GIL, SSDPWorkerPool runs
+one SSDPDaemon per process, all of them listening on port 1900 with SO_REUSEPORT.
+
+Note:
+    The kernel spreads unicast datagrams between SO_REUSEPORT sockets but copies
+    multicast to all of them, so each worker only parses and answers the multicast
+    senders of its shard, see discovery.shard_of.
+"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import logging
+import threading
+import multiprocessing
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+from .discovery import SSDPDaemon
+from .registry import DeviceRegistry, DiscoveryEvent
+from .delivery import DeliveryQueue, DROP_OLDEST
+from .networking import InterfaceTable, SocketSelector
+
+# Worker -> supervisor messages, (kind, worker index, payload)
+_EVENT = 'event'
+_STATS = 'stats'
+
+
+def _worker_main(index, count, options, searches, results, stop, stats_interval):
+    """Worker process entry point, runs a sharded SSDPDaemon until stop is set
+
+    Registry events are forwarded as (action, usn, headers) and the daemon stats every
+    stats_interval seconds, plain tuples and dicts so they pickle on any Python.
+    """
+    # Inherited through fork, the netlink thread and the epoll sets belong to the parent
+    InterfaceTable._instance = None
+    SocketSelector._instance = None
+    if index:
+        # A single worker announces the advertisements
+        options = dict(options, notify=False)
+    if options.get('snapshot'):
+        # Each shard has its own registry and so its own snapshot
+        options = dict(options, snapshot='{}.{}'.format(options['snapshot'], index))
+    daemon = SSDPDaemon(reuse_port=True, shard=(index, count), raw_responses=False, **options)
+    for search_target, max_wait in searches:
+        if index:
+            # Worker 0 searches, the others still keep the announcements of their shard
+            daemon.watch(search_target)
+        else:
+            daemon.add_m_search(search_target, max_wait)
+    daemon.start()
+    try:
+        next_stats = time.time()
+        while not stop.is_set():
+            now = time.time()
+            if now >= next_stats:
+                results.put((_STATS, index, daemon.stats()))
+                next_stats = now + stats_interval
+            try:
+                event = daemon.discovery_out_q.get(timeout=min(0.5, max(0.0, next_stats - now)))
+            except Queue.Empty:
+                continue
+            results.put((_EVENT, index, (event.action, event.entry.usn, event.entry.headers)))
+    finally:
+        daemon.join()
+
+
+def merge_stats(snapshots):
+    """Sums the numeric values of stats dicts, nested dicts are merged recursively"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if isinstance(value, dict):
+                merged[name] = merge_stats([merged.get(name, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[name] = merged.get(name, 0) + value
+    return merged
+
+
+class SSDPWorkerPool(threading.Thread):
+    """Supervisor of N SSDPDaemon worker processes sharing the SSDP port
+
+    The supervisor thread restarts dead workers (with an increasing delay if they keep
+    crashing) and merges what the workers report into a single view:
+        registry - DeviceRegistry with the devices found by every worker
+        discovery_out_q - de-duplicated add/update/expire/remove DiscoveryEvents
+        stats() - per worker and total daemon counters
+
+    Note:
+        M-SEARCH strings are sent by worker 0 only, its client socket gets the responses.
+        Every worker keeps the NOTIFY announcements the search targets ask for.
+        The devices of a worker are removed from the merged view when it dies, the
+        restarted worker finds them again.
+    """
+
+    # Seconds before restarting a worker, doubled for every crash in a row
+    RESTART_DELAY = 1.0
+    MAX_RESTART_DELAY = 60.0
+    # A worker alive for this long is no longer crash looping
+    STABLE_TIME = 30.0
+    STATS_INTERVAL = 5.0
+
+    def __init__(self, workers=None, logger_name='SSDP Pool', stats_interval=STATS_INTERVAL,
+                 queue_size=0, overflow_policy=DROP_OLDEST, **options):
+        """SSDPWorkerPool constructor
+
+        Args:
+            :param workers: number of worker processes, default is the number of CPUs
+            :param logger_name: String logger name, default: 'SSDP Pool'.
+            :param stats_interval: seconds between the stats reports of each worker
+            :param queue_size: max pending items on discovery_out_q, default 0 is unbounded
+            :param overflow_policy: what a full discovery_out_q does, see delivery.DeliveryQueue
+            :param options: SSDPDaemon arguments used by every worker, i.e. server_usn, interfaces
+        """
+        self.workers = workers or multiprocessing.cpu_count()
+        assert (self.workers >= 1), "Invalid number of workers {}".format(workers)
+        self.logging = logging.getLogger(logger_name)
+        self.stats_interval = stats_interval
+        options.setdefault('logger_name', 'SSDP Worker')
+        self.options = options
+        self._searches = []
+        # Merged view, entries leave on the events of their worker. expire is never called,
+        # workers don't forward plain refreshes, the heap is compacted by remove instead
+        self.registry = DeviceRegistry()
+        self.discovery_out_q = DeliveryQueue(queue_size, overflow_policy)
+        self.restarts = 0
+        self._results = multiprocessing.Queue()
+        self._stop_event = multiprocessing.Event()
+        self._processes = [None] * self.workers
+        self._started_at = [0.0] * self.workers
+        self._crashes = [0] * self.workers
+        self._restart_at = [None] * self.workers
+        self._stats = {}
+        # usn -> index of the worker that reported it
+        self._owners = {}
+        self.__is_running = True
+        threading.Thread.__init__(self, name=logger_name)
+        self.daemon = True
+
+    def add_m_search(self, search_target, max_wait=5):
+        """Adds an M-SEARCH sent periodically by worker 0 and watched by the others, must be
+        called before start"""
+        self._searches.append((search_target, max_wait))
+
+    def start(self):
+        """Starts the workers and the supervisor thread"""
+        for index in range(self.workers):
+            self._spawn(index)
+        threading.Thread.start(self)
+
+    def _spawn(self, index):
+        process = multiprocessing.Process(target=_worker_main, name='SSDP worker {}'.format(index),
+                                          args=(index, self.workers, self.options, self._searches,
+                                                self._results, self._stop_event, self.stats_interval))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.time()
+        self._restart_at[index] = None
+        self.logging.info('Worker {} started, pid {}'.format(index, process.pid))
+
+    def run(self):
+        """Overrides threading.Thread.run, merges the worker reports and restarts dead workers"""
+        while self.__is_running:
+            try:
+                kind, index, payload = self._results.get(timeout=0.5)
+            except Queue.Empty:
+                pass
+            else:
+                if kind == _EVENT:
+                    self._merge_event(index, *payload)
+                elif kind == _STATS:
+                    self._stats[index] = payload
+            if self.__is_running:
+                self._supervise()
+
+    def _merge_event(self, index, action, usn, headers):
+        """Applies a worker registry event to the merged registry"""
+        if action in (DeviceRegistry.ADDED, DeviceRegistry.UPDATED):
+            self._owners[usn] = index
+            event = self.registry.update(headers)
+        else:
+            self._owners.pop(usn, None)
+            event = self.registry.remove(usn)
+            if event is not None:
+                event = DiscoveryEvent(action, event.entry)
+        if event is not None:
+            self.discovery_out_q.put(event)
+
+    def _supervise(self):
+        """Schedules the restart of dead workers and restarts the ones whose delay elapsed"""
+        now = time.time()
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            if self._restart_at[index] is None:
+                if now - self._started_at[index] >= self.STABLE_TIME:
+                    self._crashes[index] = 0
+                delay = min(self.RESTART_DELAY * 2 ** self._crashes[index], self.MAX_RESTART_DELAY)
+                self._crashes[index] += 1
+                self._restart_at[index] = now + delay
+                self.logging.warning('Worker {} exited with {}, restarting in {}s'
+                                     .format(index, process.exitcode, delay))
+                self._stats.pop(index, None)
+                for usn in [usn for usn, owner in self._owners.items() if owner == index]:
+                    self._merge_event(index, DeviceRegistry.REMOVED, usn, None)
+            elif now >= self._restart_at[index]:
+                self.restarts += 1
+                self._spawn(index)
+
+    def stats(self):
+        """Snapshot of the pool, the last stats reported by each worker and their sum"""
+        workers = {}
+        for index, process in enumerate(self._processes):
+            workers[index] = dict(self._stats.get(index, {}), pid=process.pid if process else None,
+                                  alive=bool(process and process.is_alive()))
+        return {'workers': workers, 'total': merge_stats(self._stats.values()),
+                'devices': len(self.registry), 'restarts': self.restarts}
+
+    def join(self, timeout=None):
+        """Stops the workers and the supervisor thread"""
+        self.__is_running = False
+        self._stop_event.set()
+        if self.is_alive():
+            threading.Thread.join(self, timeout=timeout)
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout=timeout or 5)
+                if process.is_alive():
+                    process.terminate()
+        # Undelivered reports must not block the interpreter exit
+        self._results.cancel_join_thread()
+        self.logging.info('SSDP worker pool stopped')
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""asyncio SSDP responder answers"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import unittest
+from protocols import upnp
+from protocols.networking import UdpPackage, NetworkConfigurationError
+try:
+    from protocols import aio
+except SyntaxError:
+    # Python 2, see the aio module note
+    aio = None
+
+
+class _NoRoute(object):
+
+    def subscribe(self, callback):
+        pass
+
+    def unsubscribe(self, callback):
+        pass
+
+    def host_address(self):
+        raise NetworkConfigurationError('No default route')
+
+
+class _Server(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send_unicast(self, msg, *address):
+        self.sent.append((msg, address))
+
+
+@unittest.skipIf(aio is None, 'asyncio needs Python 3.6+')
+class ResponderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.responder = aio.AsyncSSDPResponder(server_uuid='uuid:00000000-0000-4000-8000-000000000001')
+        self.responder.server = _Server()
+
+    def search(self, search_target):
+        payload = upnp.m_search(search_target, 1, 'test/1.0').encode()
+        self.responder._on_datagram(UdpPackage(payload, '10.0.0.5', 50000))
+
+    def test_answers_rootdevice(self):
+        self.responder.answers = upnp.AnswerBuilder(_NoRoute())
+        self.responder.answers._address = '10.0.0.2'
+        self.search('upnp:rootdevice')
+        answer, address = self.responder.server.sent[0]
+        self.assertEqual(address, ('10.0.0.5', 50000))
+        self.assertIn(b'LOCATION: http://10.0.0.2', answer)
+
+    def test_no_default_route(self):
+        self.responder.answers = upnp.AnswerBuilder(_NoRoute())
+        self.search('upnp:rootdevice')
+        self.assertEqual(self.responder.server.sent, [])
+
+    def test_other_targets_are_ignored(self):
+        self.search('urn:schemas-upnp-org:device:Printer:1')
+        self.assertEqual(self.responder.server.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""capture files written by PacketRecorder and read back by read_capture"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from protocols import capture
+from protocols.capture import CapturedPacket, SENT, CLIENT
+
+PACKETS = [CapturedPacket(1000.25, 0, '10.0.0.5', 50000, '10.0.0.2', 1900, b'M-SEARCH * HTTP/1.1\r\n\r\n'),
+           CapturedPacket(1000.5, SENT, '10.0.0.5', 50000, '10.0.0.2', 1900, b'HTTP/1.1 200 OK\r\n\r\n'),
+           CapturedPacket(1001.0, CLIENT, '10.0.0.7', 1900, '10.0.0.2', 40000, b'')]
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'ssdp.cap')
+
+    def write(self, fmt, packets, header=None):
+        with open(self.path, 'wb') as handle:
+            handle.write(header or capture.file_header(fmt))
+            for packet in packets:
+                handle.write(capture.encode_record(packet, fmt))
+
+    def test_compact_round_trip(self):
+        self.write(capture.COMPACT, PACKETS)
+        self.assertEqual(list(capture.read_capture(self.path)), PACKETS)
+
+    def test_pcap_round_trip(self):
+        self.write(capture.PCAP, PACKETS)
+        packets = list(capture.read_capture(self.path))
+        self.assertEqual([packet._replace(timestamp=round(packet.timestamp, 6)) for packet in packets], PACKETS)
+
+    def test_pcap_ethernet_frames(self):
+        frame = capture._ip_udp(PACKETS[0])
+        vlan = b'\x00' * 12 + b'\x81\x00\x00\x01' + b'\x08\x00' + frame
+        arp = b'\x00' * 12 + b'\x08\x06' + b'\x00' * 28
+        header = struct.pack('<IHHiIII', capture.PCAP_MAGIC, 2, 4, 0, 0, 65535, capture.LINKTYPE_ETHERNET)
+        with open(self.path, 'wb') as handle:
+            handle.write(header)
+            for data in (vlan, arp):
+                handle.write(struct.pack('<IIII', 1000, 250000, len(data), len(data)) + data)
+        self.assertEqual(list(capture.read_capture(self.path)), PACKETS[:1])
+
+    def test_refused(self):
+        with open(self.path, 'wb') as handle:
+            handle.write(b'not a capture file at all')
+        self.assertRaises(capture.CaptureError, list, capture.read_capture(self.path))
+        self.write(capture.COMPACT, [], header=struct.pack('!4sH', capture.COMPACT_MAGIC, 99))
+        self.assertRaises(capture.CaptureError, list, capture.read_capture(self.path))
+        for fmt in (capture.COMPACT, capture.PCAP):
+            self.write(fmt, PACKETS[:1])
+            with open(self.path, 'rb+') as handle:
+                handle.truncate(os.path.getsize(self.path) - 1)
+            self.assertRaises(capture.CaptureError, list, capture.read_capture(self.path))
+
+    def test_recorder(self):
+        recorder = capture.PacketRecorder(self.path, capture.PCAP, capacity=2, flush_interval=60, snaplen=8)
+        recorder.start()
+        for packet in PACKETS:
+            recorder.record(packet.flags, memoryview(packet.data), packet.host, packet.port,
+                            (packet.local_host, packet.local_port))
+        recorder.join()
+        self.assertEqual(recorder.stats(), {'recorded': 3, 'written': 2, 'dropped': 1, 'pending': 0})
+        self.assertEqual([packet.data for packet in capture.read_capture(self.path)], [b'HTTP/1.1', b''])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""description parser on valid and malformed documents, fetcher against a local server"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import io
+import threading
+import unittest
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+from protocols import description
+from protocols.metrics import MetricsRegistry
+
+DESCRIPTION = b'''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>1</minor></specVersion>
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:MediaServer:1</deviceType>
+    <friendlyName>Media</friendlyName>
+    <UDN>uuid:1234</UDN>
+    <serviceList>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:ContentDirectory:1</serviceType>
+        <serviceId>urn:upnp-org:serviceId:ContentDirectory</serviceId>
+        <SCPDURL>/cd.xml</SCPDURL>
+        <controlURL>/cd/control</controlURL>
+        <eventSubURL>/cd/event</eventSubURL>
+      </service>
+    </serviceList>
+  </device>
+</root>'''
+BOGUS = DESCRIPTION.replace(b'version="1.0"', b'version="1.0" encoding="bogus"')
+LOCATION = 'http://10.0.0.2:8080/desc.xml'
+
+
+class ParseTest(unittest.TestCase):
+
+    def parse(self, data, max_size=description.MAX_SIZE):
+        return description.parse_description(io.BytesIO(data), LOCATION, max_size)
+
+    def test_parse(self):
+        parsed = self.parse(DESCRIPTION)
+        self.assertEqual(parsed.spec_version, '1.1')
+        self.assertEqual(parsed.device.udn, 'uuid:1234')
+        service = parsed.device.services[0]
+        self.assertEqual(service.scpd_url, 'http://10.0.0.2:8080/cd.xml')
+        self.assertEqual(service.control_url, 'http://10.0.0.2:8080/cd/control')
+
+    def test_malformed(self):
+        for data in (b'', b'<root>', b'<root></root>', DESCRIPTION[:200],
+                     BOGUS,
+                     b'<?xml version="1.0" encoding="utf-8"?><root>\xff\xfe</root>'):
+            self.assertRaises(description.DescriptionError, self.parse, data)
+
+    def test_size_limit(self):
+        self.assertRaises(description.DescriptionError, self.parse, DESCRIPTION, 100)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # path -> (status, body, headers)
+    routes = {}
+
+    def do_GET(self):
+        status, body, headers = self.routes[self.path]
+        if status == 200 and self.headers.get('If-None-Match') == headers.get('ETag'):
+            status, body = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(HTTPServer):
+
+    def handle_error(self, request, client_address):
+        # The fetcher closes the connection on error responses without reading them
+        pass
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        _Handler.routes = {'/desc.xml': (200, DESCRIPTION, {'ETag': '"v1"'}),
+                           '/bogus.xml': (200, BOGUS, {}),
+                           '/missing.xml': (404, b'x' * 4096, {})}
+        self.fetcher = description.DescriptionFetcher(workers=1, fresh_for=0, metrics=MetricsRegistry())
+
+    def tearDown(self):
+        self.fetcher.join()
+        self.fetcher.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_and_revalidate(self):
+        first = self.fetcher.fetch(self.base + '/desc.xml')
+        self.assertEqual(first.status, description.FETCHED)
+        second = self.fetcher.fetch(self.base + '/desc.xml')
+        self.assertEqual(second.status, description.NOT_MODIFIED)
+        self.assertEqual(second.description, first.description)
+
+    def test_errors_are_results(self):
+        self.assertEqual(self.fetcher.fetch(self.base + '/bogus.xml').status, description.FAILED)
+        self.assertEqual(self.fetcher.fetch(self.base + '/missing.xml').status, description.FAILED)
+        self.assertEqual(self.fetcher.fetch(self.base + '/desc.xml').status, description.FETCHED)
+
+    def test_worker_survives_bad_descriptions(self):
+        self.fetcher.start()
+        for _ in range(3):
+            self.fetcher.submit(self.base + '/bogus.xml')
+            self.assertEqual(self.fetcher.results_out_q.get(timeout=5).status, description.FAILED)
+        self.fetcher.submit(self.base + '/desc.xml')
+        self.assertEqual(self.fetcher.results_out_q.get(timeout=5).status, description.FETCHED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""SSDPDaemon NOTIFY filtering and passive refresh pacing"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import unittest
+from protocols.discovery import SSDPDaemon
+from protocols.metrics import MetricsRegistry
+from protocols.scheduling import TokenBucket
+
+
+class DaemonTest(unittest.TestCase):
+
+    def daemon(self, **options):
+        daemon = SSDPDaemon(interfaces=['127.0.0.1'], m_search_timeout=0, metrics=MetricsRegistry(), **options)
+        self.addCleanup(daemon.join)
+        return daemon
+
+    def test_watched_targets_are_wanted(self):
+        daemon = self.daemon()
+        daemon.start()
+        self.assertFalse(daemon.is_wanted('urn:schemas-upnp-org:device:MediaServer:1'))
+        daemon.watch('urn:schemas-upnp-org:device:MediaServer:1')
+        self.assertTrue(daemon.is_wanted('urn:schemas-upnp-org:device:MediaServer:2'))
+        self.assertFalse(daemon.is_wanted('urn:schemas-upnp-org:device:MediaRenderer:1'))
+        # Watching doesn't search
+        self.assertEqual(daemon.searches.targets(), [])
+
+    def test_stale_refresh_waits_for_tokens(self):
+        daemon = self.daemon(passive=True, stale_after=0.2)
+        daemon.add_m_search('ssdp:all')
+        bucket = daemon.searches.bucket = TokenBucket(0.5, 1, time.time())
+        bucket.tokens = 0.0
+        loops = []
+        main_loop = daemon.main_loop
+
+        def counting():
+            loops.append(None)
+            return main_loop()
+        daemon.main_loop = counting
+        daemon.start()
+        time.sleep(0.5)
+        daemon.join()
+        # A refresh every stale_after, not a busy loop while the bucket is empty
+        self.assertLess(len(loops), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""dns codec round-trips and malformed input, mdns packet splitting"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import struct
+import unittest
+from protocols import dns, mdns
+from protocols.metrics import MetricsRegistry
+
+
+def _wire_name(*labels):
+    return b''.join(struct.pack('!B', len(label)) + label for label in labels) + b'\x00'
+
+
+def _query(name_bytes, rtype=dns.TYPE_PTR):
+    return struct.pack('!HHHHHH', 0, 0, 1, 0, 0, 0) + name_bytes + struct.pack('!HH', rtype, dns.CLASS_IN)
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        name = 'Office Printer._ipp._tcp.local.'
+        message = dns.DNSMessage(dns.FLAG_RESPONSE | dns.FLAG_AUTHORITATIVE, answers=[
+            dns.DNSRecord('_ipp._tcp.local.', dns.TYPE_PTR, name),
+            dns.DNSRecord(name, dns.TYPE_SRV, (0, 0, 631, 'host.local.'), cache_flush=True),
+            dns.DNSRecord(name, dns.TYPE_TXT, (b'rp=ipp/print', b'color')),
+            dns.DNSRecord('host.local.', dns.TYPE_A, '192.168.1.10'),
+            dns.DNSRecord('host.local.', dns.TYPE_AAAA, 'fe80::1')])
+        decoded = dns.decode(dns.encode(message))
+        self.assertTrue(decoded.is_response)
+        self.assertEqual(decoded.answers, message.answers)
+        self.assertTrue(decoded.answers[1].cache_flush)
+
+    def test_compression(self):
+        records = [dns.DNSRecord('_ipp._tcp.local.', dns.TYPE_PTR, '{}._ipp._tcp.local.'.format(index))
+                   for index in range(10)]
+        payload = dns.encode(dns.DNSMessage(dns.FLAG_RESPONSE, answers=records))
+        # Owner and target names would take 10 * (18 + 20) bytes without pointers
+        self.assertLess(len(payload), 10 * (18 + 20) // 2)
+        self.assertEqual(dns.decode(payload).answers, records)
+
+    def test_escaped_instance(self):
+        name = '{}._http._tcp.local.'.format(dns.escape_label('Printer v1.2 \\ main'))
+        self.assertEqual(dns.split_name(name), ['Printer v1.2 \\ main', '_http', '_tcp', 'local'])
+        question = dns.decode(dns.encode(dns.DNSMessage(questions=[dns.DNSQuestion(name, dns.TYPE_SRV)])))
+        self.assertEqual(question.questions[0].name, name)
+
+    def test_non_utf8_label_keeps_its_bytes(self):
+        payload = _query(_wire_name(b'\xff' * 63, b'_ipp', b'_tcp', b'local'))
+        message = dns.decode(payload)
+        self.assertEqual(dns.encode(message), payload)
+
+    def test_long_label(self):
+        message = dns.DNSMessage(questions=[dns.DNSQuestion('{}.local.'.format('a' * 64), dns.TYPE_A)])
+        self.assertRaises(dns.DNSError, dns.encode, message)
+
+    def test_malformed(self):
+        valid = _query(_wire_name(b'host', b'local'), dns.TYPE_A)
+        for payload in (b'', valid[:5], valid[:-1], valid[:14],
+                        # Label running past the end
+                        _query(b'\x3fabc'),
+                        # Pointer to itself
+                        _query(b'\xc0\x0c'),
+                        # Extended label type
+                        _query(b'\x40abc\x00')):
+            self.assertRaises(dns.DNSError, dns.decode, payload)
+
+    def test_txt(self):
+        self.assertEqual(dns.txt_to_dict(dns.dict_to_txt({'rp': 'ipp/print', 'Color': True})),
+                         {'rp': b'ipp/print', 'color': True})
+
+
+class SplitTest(unittest.TestCase):
+
+    def test_unencodable_records_are_left_out(self):
+        good = dns.DNSRecord('host.local.', dns.TYPE_A, '192.168.1.10')
+        bad = dns.DNSRecord('{}.local.'.format('a' * 64), dns.TYPE_A, '192.168.1.11')
+        messages = mdns._split([], [bad, good], 0, [bad])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].answers, [good])
+        self.assertEqual(messages[0].additionals, [])
+
+    def test_truncated_known_answers(self):
+        question = dns.DNSQuestion('_http._tcp.local.', dns.TYPE_PTR)
+        known = [dns.DNSRecord('_http._tcp.local.', dns.TYPE_PTR, '{}{}._http._tcp.local.'.format('x' * 60, index))
+                 for index in range(100)]
+        messages = mdns._split([question], known, dns.FLAG_TRUNCATED)
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(message.truncated for message in messages[:-1]))
+        self.assertFalse(messages[-1].truncated)
+        self.assertEqual(sum(len(message.answers) for message in messages), len(known))
+        for message in messages:
+            self.assertLessEqual(len(dns.encode(message)), mdns.MAX_PACKET_SIZE)
+
+    def test_echoed_known_answer_matches(self):
+        # A peer name that isn't UTF-8 is cached and echoed with the same bytes
+        record = dns.decode(dns.encode(dns.DNSMessage(dns.FLAG_RESPONSE, answers=[
+            dns.DNSRecord('_http._tcp.local.', dns.TYPE_PTR, 'x._http._tcp.local.')]))).answers[0]
+        payload = _query(_wire_name(b'\xfe' * 63, b'_http', b'_tcp', b'local'))
+        question = dns.decode(payload).questions[0]
+        messages = mdns._split([question], [record], dns.FLAG_TRUNCATED)
+        self.assertEqual(dns.decode(dns.encode(messages[0])).questions, [question])
+
+
+class RegisterServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.daemon = mdns.MDNSDaemon(host_name='test.local.', address='127.0.0.1', metrics=MetricsRegistry())
+
+    def tearDown(self):
+        self.daemon.join()
+
+    def test_long_instance_is_rejected(self):
+        self.assertRaises(dns.DNSError, self.daemon.register_service, 'x' * 64, '_http._tcp.local.', 80)
+        self.assertEqual(self.daemon._services, {})
+
+    def test_instance_with_dots(self):
+        name = self.daemon.register_service('Printer v1.2', '_http._tcp.local.', 80)
+        self.assertEqual(name, 'Printer v1\\.2._http._tcp.local.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""metrics registry and Prometheus exposition"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import unittest
+from protocols import metrics
+
+
+class ExpositionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_counter_and_histogram(self):
+        self.registry.counter('snf_test_total', 'Test counter', daemon='a').value += 3
+        histogram = self.registry.histogram('snf_test_seconds', 'Test histogram', bounds=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        lines = metrics.render_prometheus(self.registry).splitlines()
+        self.assertIn('# TYPE snf_test_total counter', lines)
+        self.assertIn('snf_test_total{daemon="a"} 3', lines)
+        self.assertIn('snf_test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('snf_test_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('snf_test_seconds_count 2', lines)
+
+    def test_label_values_are_escaped(self):
+        self.registry.counter('snf_test_total', 'Line one\nline two \\', daemon='My "SSDP"\nAgent \\ 1').value += 1
+        text = metrics.render_prometheus(self.registry)
+        self.assertIn('# HELP snf_test_total Line one\\nline two \\\\\n', text)
+        self.assertIn('snf_test_total{daemon="My \\"SSDP\\"\\nAgent \\\\ 1"} 1\n', text)
+        # One line per sample, nothing split by the newline of the label
+        self.assertEqual(len(text.splitlines()), 3)
+
+    def test_exclusive_gauge(self):
+        self.registry.gauge('snf_test_depth', lambda: 1, daemon='a', exclusive=True)
+        self.assertRaises(ValueError, self.registry.gauge, 'snf_test_depth', lambda: 2, daemon='a', exclusive=True)
+        self.registry.gauge('snf_test_depth', lambda: 3, daemon='b', exclusive=True)
+        self.assertIn('snf_test_depth{daemon="a"} 1', metrics.render_prometheus(self.registry).splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
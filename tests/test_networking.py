@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""SocketSelector keys and DatagramSocket batch receive"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import time
+import socket
+import unittest
+from protocols.metrics import MetricsRegistry
+from protocols.networking import SocketSelector, DatagramSocket, UnicastException
+
+
+class SelectorTest(unittest.TestCase):
+
+    def client(self, key):
+        sock = DatagramSocket(DatagramSocket.CLIENT, 'Test', 'Test', '239.255.255.250', 1900,
+                              selector=key, metrics=MetricsRegistry())
+        self.addCleanup(sock.destroy)
+        sock.transport.bind(('127.0.0.1', 0))
+        return sock
+
+    def send(self, sock, payload):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.sendto(payload, sock.transport.getsockname())
+        sender.close()
+
+    def test_keys_are_isolated(self):
+        first, second = SocketSelector.new_key('Test'), SocketSelector.new_key('Test')
+        self.assertNotEqual(first, second)
+        calls = []
+        sock = self.client(first)
+        sock.handler = lambda: calls.append(sock.recv_batch())
+        self.send(sock, b'hello')
+        self.assertEqual(SocketSelector.dispatch(second, 0.1), 0)
+        self.assertEqual(SocketSelector.dispatch(first, 1.0), 1)
+        self.assertEqual([package.data.tobytes() for package in calls[0]], [b'hello'])
+        for key in (first, second):
+            SocketSelector.release(key)
+
+    def test_released_key_is_not_rebuilt(self):
+        key = SocketSelector.new_key('Test')
+        sock = self.client(key)
+        sock.destroy()
+        SocketSelector.release(key)
+        SocketSelector.wakeup(key)
+        started = time.time()
+        self.assertEqual(SocketSelector.dispatch(key, 1.0), 0)
+        self.assertLess(time.time() - started, 0.5)
+        self.assertNotIn(key, SocketSelector.get_instance()._selectors)
+
+
+class RecvBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = DatagramSocket(DatagramSocket.CLIENT, 'Test', 'Test', '239.255.255.250', 1900,
+                                   metrics=MetricsRegistry())
+        self.sock.transport.bind(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.sock.destroy()
+
+    def test_drains_without_blocking(self):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for index in range(5):
+            sender.sendto('datagram {}'.format(index).encode(), self.sock.transport.getsockname())
+        sender.close()
+        time.sleep(0.1)
+        packages = self.sock.recv_batch()
+        self.assertEqual([package.data.tobytes() for package in packages],
+                         ['datagram {}'.format(index).encode() for index in range(5)])
+        started = time.time()
+        self.assertEqual(self.sock.recv_batch(), [])
+        self.assertLess(time.time() - started, 0.5)
+        # The transport keeps its time-out for recv_dgram and the senders
+        self.assertEqual(self.sock.transport.gettimeout(), DatagramSocket.SOCKET_TIMEOUT)
+
+    def test_not_connected(self):
+        self.sock.destroy()
+        self.assertRaises(UnicastException, self.sock.recv_batch)
+
+
+if __name__ == '__main__':
+    unittest.main()
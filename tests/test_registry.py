@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""DeviceRegistry expiry, updates and removal"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import unittest
+from protocols.registry import DeviceRegistry, max_age, split_usn
+
+USN = 'uuid:1234::urn:schemas-upnp-org:device:MediaServer:1'
+
+
+def announcement(usn=USN, age=100, **headers):
+    message = {'usn': usn, 'cache-control': 'max-age={}'.format(age), 'location': 'http://10.0.0.2/desc.xml'}
+    message.update(headers)
+    return message
+
+
+class HelpersTest(unittest.TestCase):
+
+    def test_max_age(self):
+        self.assertEqual(max_age('max-age=1800', 5), 1800)
+        self.assertEqual(max_age('no-cache, MAX-AGE = "60"', 5), 60)
+        for value in (None, '', 'max-age=', 'max-age=-1'):
+            self.assertEqual(max_age(value, 5), 5)
+
+    def test_split_usn(self):
+        self.assertEqual(split_usn(USN), ('uuid:1234', 'urn:schemas-upnp-org:device:MediaServer:1'))
+        self.assertEqual(split_usn('uuid:1234'), ('uuid:1234', 'uuid:1234'))
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry(clock=lambda: 0.0)
+
+    def test_add_refresh_and_update(self):
+        event = self.registry.update(announcement(), now=0)
+        self.assertEqual(event.action, DeviceRegistry.ADDED)
+        self.assertEqual(event.entry.uuid, 'uuid:1234')
+        self.assertEqual(self.registry.by_type('urn:schemas-upnp-org:device:MediaServer:1'), [event.entry])
+        # Same announcement, only the expiry moves
+        self.assertIsNone(self.registry.update(announcement(), now=50))
+        self.assertEqual(event.entry.expires, 150)
+        event = self.registry.update(announcement(location='http://10.0.0.3/desc.xml'), now=60)
+        self.assertEqual(event.action, DeviceRegistry.UPDATED)
+        self.assertEqual(self.registry.get(USN).location, 'http://10.0.0.3/desc.xml')
+        self.assertEqual(self.registry.generation, 2)
+
+    def test_nt_and_st_alternate(self):
+        # A NOTIFY and an M-SEARCH answer of the same device aren't a change
+        self.registry.update(announcement(nt='urn:schemas-upnp-org:device:MediaServer:1'), now=0)
+        self.assertIsNone(self.registry.update(announcement(st='urn:schemas-upnp-org:device:MediaServer:1'), now=1))
+        self.assertIsNone(self.registry.update(announcement(nt='urn:schemas-upnp-org:device:MediaServer:1'), now=2))
+
+    def test_expire(self):
+        self.registry.update(announcement(age=100), now=0)
+        self.registry.update(announcement('uuid:5678', age=10), now=0)
+        self.assertEqual(self.registry.next_expiry(now=0), 10)
+        self.assertEqual(self.registry.expire(now=9), [])
+        events = self.registry.expire(now=10)
+        self.assertEqual([(event.action, event.entry.usn) for event in events],
+                         [(DeviceRegistry.EXPIRED, 'uuid:5678')])
+        # Refreshed before its expiry, rescheduled instead of dropped
+        self.registry.update(announcement(age=100), now=90)
+        self.assertEqual(self.registry.expire(now=100), [])
+        self.assertEqual(len(self.registry.expire(now=190)), 1)
+        self.assertEqual(len(self.registry), 0)
+        self.assertIsNone(self.registry.next_expiry(now=190))
+
+    def test_shorter_max_age(self):
+        self.registry.update(announcement(age=1800), now=0)
+        self.registry.update(announcement(age=10), now=1)
+        self.assertEqual(len(self.registry.expire(now=11)), 1)
+
+    def test_expiring(self):
+        for index, age in enumerate((30, 10, 20, 500)):
+            self.registry.update(announcement('uuid:{}'.format(index), age=age), now=0)
+        self.assertEqual([entry.usn for entry in self.registry.expiring(25)], ['uuid:1', 'uuid:2'])
+
+    def test_remove(self):
+        self.registry.update(announcement(), now=0)
+        self.assertEqual(self.registry.remove(USN).action, DeviceRegistry.REMOVED)
+        self.assertIsNone(self.registry.remove(USN))
+        self.assertEqual(self.registry.by_uuid('uuid:1234'), [])
+        self.assertEqual(self.registry.expire(now=1000), [])
+
+    def test_removed_entries_are_compacted(self):
+        for index in range(3 * DeviceRegistry.COMPACT_SIZE):
+            self.registry.update(announcement('uuid:{}'.format(index)), now=0)
+            self.registry.remove('uuid:{}'.format(index))
+        self.assertLessEqual(len(self.registry._expiries), DeviceRegistry.COMPACT_SIZE + 1)
+
+    def test_restore(self):
+        event = self.registry.restore(announcement(age=1800), expires=30, now=0)
+        self.assertEqual(event.action, DeviceRegistry.ADDED)
+        self.assertIsNone(self.registry.restore(announcement(), expires=60, now=0))
+        self.assertIsNone(self.registry.restore(announcement('uuid:5678'), expires=0, now=0))
+        self.assertEqual(self.registry.next_expiry(now=0), 30)
+        self.assertEqual(len(self.registry.expire(now=30)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Token bucket and scheduler timing, driven by explicit clock values"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import unittest
+from protocols.registry import DeviceRegistry
+from protocols.scheduling import TokenBucket, ResponseScheduler, SearchScheduler, RefreshScheduler, max_wait
+
+SENDER = ('10.0.0.5', 50000)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, 3, 0.0)
+        self.assertEqual([bucket.consume(0.0) for _ in range(4)], [True, True, True, False])
+        self.assertEqual(bucket.delay(0.0), 0.5)
+        self.assertFalse(bucket.consume(0.25))
+        self.assertTrue(bucket.consume(0.5))
+        # Never more than burst after a long pause
+        self.assertEqual(bucket.delay(100.0, 3), 0.0)
+        self.assertEqual(bucket.delay(100.0, 4), 0.5)
+
+    def test_max_wait(self):
+        self.assertEqual(max_wait('3', 5), 3.0)
+        self.assertEqual(max_wait(120, 5), 5.0)
+        for value in (None, '', 'abc', '-1'):
+            self.assertEqual(max_wait(value, 5), 0.0)
+
+
+class ResponseSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Always the longest delay
+        self.scheduler = ResponseScheduler(rate=1, burst=2, max_senders=2, uniform=lambda low, high: high)
+
+    def test_answers_are_delayed_by_mx(self):
+        self.assertTrue(self.scheduler.schedule(SENDER, 'ssdp:all', ['answer'], '3', now=0))
+        self.assertEqual(self.scheduler.next_due(now=1), 2)
+        self.assertEqual(self.scheduler.due(now=2.9), [])
+        self.assertEqual(self.scheduler.due(now=3), ['answer'])
+        self.assertIsNone(self.scheduler.next_due(now=3))
+        # MX above the limit is clamped
+        self.scheduler.schedule(SENDER, 'ssdp:all', ['answer'], '120', now=3)
+        self.assertEqual(self.scheduler.next_due(now=3), ResponseScheduler.MAX_MX)
+
+    def test_duplicates_are_coalesced(self):
+        self.assertTrue(self.scheduler.schedule(SENDER, 'ssdp:all', ['answer'], 1, now=0))
+        self.assertFalse(self.scheduler.schedule(SENDER, 'ssdp:all', ['answer'], 1, now=0))
+        self.assertTrue(self.scheduler.schedule(SENDER, 'upnp:rootdevice', ['root'], 1, now=0))
+        self.assertEqual(self.scheduler.due(now=1), ['answer', 'root'])
+        self.assertEqual(self.scheduler.stats()['coalesced'], 1)
+
+    def test_senders_are_rate_limited(self):
+        results = [self.scheduler.schedule(SENDER, 'st-{}'.format(index), [index], 0, now=0) for index in range(3)]
+        self.assertEqual(results, [True, True, False])
+        # Other senders have their own bucket
+        self.assertTrue(self.scheduler.schedule(('10.0.0.6', 50000), 'st-0', [3], 0, now=0))
+        self.assertEqual(self.scheduler.due(now=0), [0, 1, 3])
+        self.assertEqual(self.scheduler.stats()['suppressed'], 1)
+
+    def test_tracked_senders_are_bounded(self):
+        for index in range(5):
+            self.scheduler.schedule(('10.0.0.{}'.format(index), 50000), 'ssdp:all', [index], 0, now=0)
+        self.assertEqual(len(self.scheduler._buckets), 2)
+
+
+class SearchSchedulerTest(unittest.TestCase):
+
+    TARGET = 'urn:schemas-upnp-org:device:MediaServer:1'
+
+    def scheduler(self, interval=10, **options):
+        # No jitter
+        return SearchScheduler(interval, clock=lambda: 0.0, uniform=lambda low, high: 1.0, **options)
+
+    def test_retries_then_back_off(self):
+        scheduler = self.scheduler()
+        scheduler.add(self.TARGET, now=0)
+        sent = [now for now in (0, 0.5, 1, 2, 11, 12, 31, 32, 72) if scheduler.due(now=now)]
+        self.assertEqual(sent, [0, 1, 2, 12, 32, 72])
+        self.assertEqual(scheduler.next_due(now=72), 80)
+
+    def test_back_off_is_bounded(self):
+        scheduler = self.scheduler(max_interval=25, retries=1)
+        scheduler.add(self.TARGET, now=0)
+        now = 0
+        for _ in range(5):
+            now += scheduler.next_due(now=now)
+            self.assertEqual(scheduler.due(now=now), [self.TARGET])
+        self.assertEqual(scheduler.next_due(now=now), 25)
+
+    def test_arrivals_reset_the_interval(self):
+        scheduler = self.scheduler(retries=1)
+        scheduler.add(self.TARGET, now=0)
+        for now in (0, 10, 30):
+            scheduler.due(now=now)
+        self.assertEqual(scheduler.next_due(now=30), 40)
+        # Arrivals of a matching type are searched at the minimum interval once due
+        scheduler.observe('urn:schemas-upnp-org:device:MediaServer:2', lost=False, now=31)
+        self.assertEqual(scheduler.next_due(now=31), 39)
+        scheduler.due(now=70)
+        self.assertEqual(scheduler.next_due(now=70), 10)
+
+    def test_departures_search_again_soon(self):
+        scheduler = self.scheduler(retries=1)
+        scheduler.add(self.TARGET, now=0)
+        self.assertEqual(scheduler.due(now=0), [self.TARGET])
+        scheduler.observe('urn:schemas-upnp-org:device:Printer:1', lost=True, now=5)
+        self.assertEqual(scheduler.next_due(now=5), 5)
+        scheduler.observe(self.TARGET, lost=True, now=5)
+        self.assertEqual(scheduler.next_due(now=5), SearchScheduler.RETRY_SPACING)
+
+    def test_token_bucket_paces_targets(self):
+        scheduler = self.scheduler(rate=1, burst=2)
+        for index in range(3):
+            scheduler.add('st-{}'.format(index), now=0)
+        self.assertEqual(scheduler.due(now=0), ['st-0', 'st-1'])
+        self.assertEqual(scheduler.stats()['throttled'], 1)
+        self.assertEqual(scheduler.next_due(now=0), 1.0)
+        self.assertEqual(scheduler.due(now=1), ['st-2'])
+        # A cost above the burst is capped, not stuck forever
+        self.assertEqual(scheduler.due(now=5, cost=10), ['st-0'])
+
+    def test_without_interval_or_retries(self):
+        scheduler = self.scheduler(interval=None, retries=0)
+        scheduler.add(self.TARGET, now=0)
+        self.assertIsNone(scheduler.next_due(now=0))
+        self.assertEqual(scheduler.due(now=1000), [])
+        scheduler.refresh(now=1000)
+        self.assertEqual(scheduler.due(now=1000), [self.TARGET])
+        scheduler.remove(self.TARGET)
+        self.assertNotIn(self.TARGET, scheduler)
+
+
+class RefreshSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry(clock=lambda: 0.0)
+        self.scheduler = RefreshScheduler(self.registry, clock=lambda: 0.0)
+
+    def announce(self, usn, now, age=100):
+        self.registry.update({'usn': usn, 'cache-control': 'max-age={}'.format(age)}, now=now)
+
+    def asked(self, now):
+        return [entry.usn for entry in self.scheduler.due(now=now)]
+
+    def test_asks_before_expiry(self):
+        self.announce('uuid:1', 0)
+        # A quarter of max-age before the expiry, then every retry up to attempts
+        self.assertEqual(self.asked(70), [])
+        self.assertEqual(self.asked(75), ['uuid:1'])
+        self.assertEqual(self.asked(80), [])
+        self.assertEqual(self.asked(85), ['uuid:1'])
+        self.assertEqual(self.asked(95), [])
+        # Heard again, a new expiry starts over
+        self.announce('uuid:1', 96)
+        self.assertEqual(self.asked(171), ['uuid:1'])
+
+    def test_token_bucket_paces_entries(self):
+        self.scheduler.bucket = TokenBucket(1, 2, 0.0)
+        for index in range(3):
+            self.announce('uuid:{}'.format(index), index)
+        self.assertEqual(self.asked(80), ['uuid:0', 'uuid:1'])
+        self.assertEqual(self.scheduler.next_due(now=80), 1.0)
+        self.assertEqual(self.asked(81), ['uuid:2'])
+        self.assertIsNone(RefreshScheduler(DeviceRegistry()).next_due())
+
+
+if __name__ == '__main__':
+    unittest.main()
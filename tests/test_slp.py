@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""slp codec round-trips, malformed input and predicates"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import unittest
+from protocols import slp
+from protocols.metrics import MetricsRegistry
+from protocols.networking import NetworkConfigurationError
+
+
+class CodecTest(unittest.TestCase):
+
+    def round_trip(self, body, flags=0):
+        message = slp.decode(slp.encode(slp.SLPMessage(body, 1234, flags)))
+        self.assertEqual((message.body, message.xid, message.flags, message.lang), (body, 1234, flags, 'en'))
+
+    def test_round_trip(self):
+        entry = slp.URLEntry('service:printer:lpr://10.0.0.2', 300)
+        self.round_trip(slp.ServiceRequest(('10.0.0.1',), 'service:printer', ('default',), '(color=true)'),
+                        slp.FLAG_MCAST)
+        self.round_trip(slp.ServiceReply(slp.OK, [entry, slp.URLEntry('service:printer:ipp://10.0.0.3', 60)]))
+        self.round_trip(slp.ServiceRegistration(entry, 'service:printer:lpr', ('default',), '(color=true)'),
+                        slp.FLAG_FRESH)
+        self.round_trip(slp.ServiceAck(slp.OK))
+        self.round_trip(slp.DAAdvert(slp.OK, 42, 'service:directory-agent://10.0.0.9', ('default',), ''))
+        self.round_trip(slp.SAAdvert('service:service-agent://10.0.0.2', ('default',), ''))
+
+    def test_malformed(self):
+        valid = slp.encode(slp.SLPMessage(slp.ServiceRequest((), 'service:printer', ('default',), '')))
+        for payload in (b'', valid[:10], valid[:-1], b'\x01' + valid[1:],
+                        # Unsupported function
+                        valid[:1] + b'\x07' + valid[2:],
+                        # String length past the end
+                        valid[:16] + b'\xff\xff' + valid[18:]):
+            self.assertRaises(slp.SLPError, slp.decode, payload)
+
+    def test_service_type_of(self):
+        self.assertEqual(slp.service_type_of('service:Printer:LPR://host'), 'service:printer:lpr')
+
+
+class PredicateTest(unittest.TestCase):
+
+    attributes = slp.parse_attributes('(color=true),(pages=10,20),(name=Office  Printer),duplex')
+
+    def test_parse_attributes(self):
+        self.assertEqual(self.attributes, {'color': ['true'], 'pages': ['10', '20'],
+                                           'name': ['Office  Printer'], 'duplex': True})
+
+    def test_matches(self):
+        for predicate, expected in (('', True), ('(color=true)', True), ('(color=false)', False),
+                                    ('(pages>=15)', True), ('(pages<=5)', False), ('(name=office*)', True),
+                                    ('(name~=office printer)', True), ('(duplex=*)', True),
+                                    ('(&(color=true)(!(pages>=30)))', True), ('(|(color=false)(fax=*))', False)):
+            self.assertEqual(slp.matches(predicate, self.attributes), expected, predicate)
+
+    def test_invalid(self):
+        for predicate in ('color=true', '(color=true', '(&)', '(color=true)x', '(color)'):
+            self.assertRaises(slp.SLPError, slp.matches, predicate, self.attributes)
+
+    def test_nesting_is_capped(self):
+        depth = slp.MAX_PREDICATE_DEPTH - 1
+        self.assertFalse(slp.matches('(!' * depth + '(color=true)' + ')' * depth, self.attributes))
+        depth = 5000
+        self.assertRaises(slp.SLPError, slp.matches, '(!' * depth + '(a=1)' + ')' * depth, self.attributes)
+
+
+def _no_route():
+    raise NetworkConfigurationError('No default route')
+
+
+class RequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.daemon = slp.SLPDaemon(metrics=MetricsRegistry())
+        self.sent = []
+        self.daemon._send = lambda sock, message, address: self.sent.append((message, address))
+
+    def tearDown(self):
+        self.daemon.join()
+
+    def request(self, service_type, predicate='', flags=0):
+        body = slp.ServiceRequest((), service_type, ('default',), predicate)
+        self.daemon.handle_request(slp.SLPMessage(body, 7, flags), '10.0.0.5', 427)
+
+    def test_reply(self):
+        self.daemon.register_service('service:printer:lpr://10.0.0.2', attributes='(color=true)')
+        self.request('service:printer', '(color=true)')
+        reply, address = self.sent[0]
+        self.assertEqual(address, ('10.0.0.5', 427))
+        self.assertEqual([entry.url for entry in reply.body.entries], ['service:printer:lpr://10.0.0.2'])
+
+    def test_deep_predicate_is_a_parse_error(self):
+        self.daemon.register_service('service:printer:lpr://10.0.0.2')
+        self.request('service:printer', '(!' * 5000 + '(a=1)' + ')' * 5000)
+        self.assertEqual(self.sent[0][0].body.error, slp.PARSE_ERROR)
+
+    def test_service_agent_without_default_route(self):
+        interfaces = self.daemon.interfaces
+        interfaces.host_address = _no_route
+        self.addCleanup(delattr, interfaces, 'host_address')
+        self.request(slp.SERVICE_AGENT, flags=slp.FLAG_MCAST)
+        self.assertEqual(self.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
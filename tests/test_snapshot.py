@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""snapshot round trip and refused files"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from protocols import snapshot
+from protocols.registry import DeviceRegistry
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'devices.snap')
+        self.registry = DeviceRegistry()
+        for index, age in enumerate((100, 1800)):
+            self.registry.update({'usn': 'uuid:{}::upnp:rootdevice'.format(index), 'nt': 'upnp:rootdevice',
+                                  'cache-control': 'max-age={}'.format(age), 'location': None,
+                                  'server': 'Linux/1.0 UPnP/1.1 test/1.0'}, now=0)
+
+    def test_round_trip(self):
+        data = snapshot.encode(self.registry, 42.5)
+        saved_at, entries = snapshot.decode(data)
+        self.assertEqual(saved_at, 42.5)
+        expected = []
+        for entry in self.registry:
+            # Missing headers (None) aren't saved
+            headers = dict((name, value) for name, value in entry.headers.items() if value is not None)
+            expected.append((entry.expires, entry.max_age, headers))
+        self.assertEqual(sorted(entries), sorted(expected))
+
+    def test_save_and_load(self):
+        self.assertEqual(snapshot.save(self.path, self.registry, 0), os.path.getsize(self.path))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        entries = snapshot.load(self.path, now=1000)
+        self.assertEqual([(expires, age, headers['usn']) for expires, age, headers in entries],
+                         [(1800, 1800, 'uuid:1::upnp:rootdevice')])
+        # Entries go back into a registry with their saved expiry
+        registry = DeviceRegistry()
+        for expires, _, headers in entries:
+            registry.restore(headers, expires, now=1000)
+        self.assertEqual(registry.get('uuid:1::upnp:rootdevice').expires, 1800)
+
+    def test_missing_or_empty_file(self):
+        self.assertEqual(snapshot.load(self.path, now=0), [])
+        open(self.path, 'wb').close()
+        self.assertEqual(snapshot.load(self.path, now=0), [])
+
+    def test_refused(self):
+        data = snapshot.encode(self.registry, 0)
+        corrupted = bytearray(data)
+        corrupted[-1] ^= 0xff
+        for bad in (data[:10], b'XXXX' + data[4:], data[:4] + struct.pack('!H', 2) + data[6:],
+                    bytes(corrupted), data[:-5]):
+            self.assertRaises(snapshot.SnapshotError, snapshot.decode, bad)
+        with open(self.path, 'wb') as handle:
+            handle.write(bytes(corrupted))
+        self.assertRaises(snapshot.SnapshotError, snapshot.load, self.path, 0)
+
+    def test_truncated_with_valid_checksum(self):
+        # Counts claiming more than the body holds
+        data = snapshot.encode(self.registry, 0)
+        magic, version, names, count, saved_at, crc = struct.unpack_from('!4sHHIdI', data)
+        header = struct.pack('!4sHHIdI', magic, version, names, count + 1, saved_at, crc)
+        self.assertRaises(snapshot.SnapshotError, snapshot.decode, header + data[len(header):])
+
+
+if __name__ == '__main__':
+    unittest.main()
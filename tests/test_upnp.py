@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""parse_message on valid and malformed SSDP messages"""
+
+__author__ = 'douglasvinter'
+__version__ = '0.1'
+
+import unittest
+from protocols import upnp
+from protocols.networking import UdpPackage
+
+NOTIFY = (b'NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nCACHE-CONTROL: max-age=1800\r\n'
+          b'LOCATION: http://10.0.0.2:8080/desc.xml\r\nNT: upnp:rootdevice\r\nNTS: ssdp:alive\r\n'
+          b'USN: uuid:1234::upnp:rootdevice\r\n\r\n')
+
+
+class ParseMessageTest(unittest.TestCase):
+
+    def parse(self, data, host='10.0.0.2', port=1900):
+        return upnp.parse_message(UdpPackage(data, host, port))
+
+    def test_m_search(self):
+        message = self.parse(upnp.m_search('ssdp:all', 2, 'test/1.0').encode(), port=50000)
+        self.assertEqual(message.method, 'M-SEARCH')
+        self.assertEqual((message.host, message.port), ('10.0.0.2', 50000))
+        self.assertEqual(message['st'], 'ssdp:all')
+        self.assertEqual(message.get('mx'), '2')
+        self.assertEqual(message.get('location', 'none'), 'none')
+
+    def test_notify(self):
+        message = self.parse(NOTIFY)
+        self.assertEqual(message.method, 'NOTIFY')
+        self.assertEqual(len(message), 6)
+        data = message.to_dict()
+        self.assertEqual(data['usn'], 'uuid:1234::upnp:rootdevice')
+        self.assertEqual(data['uuid'], '1234')
+        self.assertEqual(data['sender'], ['10.0.0.2', 1900])
+
+    def test_response(self):
+        answer = upnp.answer('device', 'upnp:rootdevice', 'uuid:1234::upnp:rootdevice')
+        message = self.parse(memoryview(answer.encode()))
+        self.assertEqual(message.method, 'HTTP')
+        self.assertEqual(message['st'], 'upnp:rootdevice')
+        self.assertEqual(message['ext'], '')
+        # Same headers as the regex parser, which misses the empty EXT
+        legacy = upnp.parse(UdpPackage(answer.encode(), '10.0.0.2', 1900))
+        data = message.to_dict()
+        self.assertEqual(data.pop('ext'), '')
+        self.assertEqual(data, legacy)
+
+    def test_headers_without_blank_line(self):
+        message = self.parse(b'NOTIFY * HTTP/1.1\r\nNT: upnp:rootdevice\r\n')
+        self.assertEqual(message['nt'], 'upnp:rootdevice')
+
+    def test_malformed(self):
+        for data in (b'', b'NOTIFY * HTTP/1.1', b'GET / HTTP/1.1\r\n\r\n', b'HTTP/1.1 404 Not Found\r\n\r\n',
+                     b'NOTIFY * HTTP/1.1\r\nNT: upnp:rootdevice',
+                     b'NOTIFY * HTTP/1.1\r\nno colon here\r\n\r\n',
+                     b'NOTIFY * HTTP/1.1\r\n: empty name\r\n\r\n',
+                     b'NOTIFY * HTTP/1.1\r\n' + b'X: y\r\n' * (upnp.MAX_HEADERS + 1) + b'\r\n',
+                     NOTIFY + b'x' * upnp.MAX_MESSAGE_SIZE):
+            self.assertIsNone(self.parse(data), data[:40])
+
+    def test_invalid_package(self):
+        self.assertIsNone(upnp.parse_message(NOTIFY))
+        self.assertIsNone(self.parse(NOTIFY, host=None))
+
+    def test_undecodable_values(self):
+        message = self.parse(b'NOTIFY * HTTP/1.1\r\nSERVER: \xff\xfe\r\n\r\n')
+        self.assertTrue(message['server'])
+
+
+if __name__ == '__main__':
+    unittest.main()